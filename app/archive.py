@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/30 下午4:20
+# @Author  : sudoskys
+# @File    : archive.py
+# @Software: PyCharm
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+import shortuuid
+from loguru import logger
+from pydantic import BaseModel
+
+from .metrics import stage
+
+
+class ArchiveStats(BaseModel):
+    queued: int = 0
+    uploaded: int = 0
+    failed: int = 0
+    retried: int = 0
+    spilled: int = 0
+    restored: int = 0
+
+
+class ArchiveItem(object):
+    __slots__ = ("uid", "key", "body", "params", "attempts", "processed")
+
+    def __init__(self,
+                 key: str,
+                 body: bytes,
+                 params: str,
+                 uid: Optional[str] = None,
+                 attempts: int = 0,
+                 processed: bool = False
+                 ):
+        self.uid = uid or shortuuid.uuid()
+        self.key = key
+        self.body = body
+        self.params = params
+        self.attempts = attempts
+        self.processed = processed
+
+
+class S3Archiver(object):
+    """
+    后台归档管道
+    有界队列 + 共享 S3 客户端 + 线程池上传，失败重试，队列满或上传失败时落盘，之后再回放
+    """
+
+    def __init__(self,
+                 *,
+                 bucket: str,
+                 aws_access_key_id: Optional[str] = None,
+                 aws_secret_access_key: Optional[str] = None,
+                 endpoint_url: Optional[str] = None,
+                 workers: int = 4,
+                 max_queue: int = 100,
+                 max_retries: int = 3,
+                 backoff: float = 1.0,
+                 spill_dir: Optional[str] = "archive_spill",
+                 drain_interval: float = 30.0,
+                 client=None,
+                 transcode: Optional[Callable[[bytes], Awaitable[Tuple[bytes, str]]]] = None,
+                 ):
+        self.bucket = bucket
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.endpoint_url = endpoint_url
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.spill_dir = spill_dir
+        self.drain_interval = drain_interval
+        self.stats = ArchiveStats()
+        self._client = client
+        self.transcode = transcode
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 落盘单独一个线程，上传卡住时不会排在上传后面
+        self._spill_executor: Optional[ThreadPoolExecutor] = None
+        self._spilling: Set[asyncio.Future] = set()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client(
+                's3',
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                endpoint_url=self.endpoint_url,
+            )
+        return self._client
+
+    @staticmethod
+    def build_key(message_date: int, uid: str, suffix: str) -> str:
+        today = time.strftime('%Y-%m-%d', time.localtime(time.time()))
+        return f"telegram/{today}/nai_tg_{uid}_{message_date}{suffix}"
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="s3-archive")
+        self._spill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="s3-spill")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.spill_dir:
+            self._tasks.append(asyncio.create_task(self._drain_loop()))
+        logger.info(f"🍺 S3 archiver started --workers {self.workers} --max_queue {self.max_queue}")
+
+    async def close(self, timeout: float = 10.0):
+        """
+        等待队列清空，超时后剩余任务落盘
+        """
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("🍺 S3 archiver close timeout, spill remaining items")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            self._spill_later(self._queue.get_nowait())
+        if self._spilling:
+            await asyncio.gather(*self._spilling, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+        self._spill_executor.shutdown(wait=True)
+
+    def submit(self, file_bytes: bytes, message_date: int, params: BaseModel) -> bool:
+        """
+        提交归档，不等待上传
+        :return: 是否进入内存队列，False 表示已落盘或丢弃
+        """
+        self.start()
+        uid = shortuuid.uuid()
+        item = ArchiveItem(
+            key=self.build_key(message_date, uid, ".png"),
+            body=file_bytes,
+            params=params.model_dump_json(),
+            uid=uid,
+        )
+        return self._enqueue(item)
+
+    def _enqueue(self, item: ArchiveItem) -> bool:
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self._spill_later(item)
+            return False
+        self.stats.queued += 1
+        return True
+
+    def _upload(self, item: ArchiveItem):
+        self.client.put_object(Body=item.body, Bucket=self.bucket, Key=item.key)
+        # 上传请求参数
+        self.client.put_object(
+            Body=item.params,
+            Bucket=self.bucket,
+            Key=f"{os.path.splitext(item.key)[0]}.json"
+        )
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            try:
+                if self.transcode is not None and not item.processed:
+                    item.body, suffix = await self.transcode(item.body)
+                    item.key = f"{os.path.splitext(item.key)[0]}{suffix}"
+                    item.processed = True
+                while True:
+                    try:
+                        with stage("archive"):
+                            await loop.run_in_executor(self._executor, self._upload, item)
+                    except Exception as e:
+                        item.attempts += 1
+                        if item.attempts > self.max_retries:
+                            logger.error(f"🍺 Upload to S3 error: {e} --key {item.key}")
+                            self.stats.failed += 1
+                            await self._spill_later(item)
+                            break
+                        self.stats.retried += 1
+                        await asyncio.sleep(self.backoff * 2 ** (item.attempts - 1))
+                    else:
+                        self.stats.uploaded += 1
+                        logger.info(f"🍺 Upload to S3 --key {item.key}")
+                        break
+            finally:
+                self.stats.queued -= 1
+                self._queue.task_done()
+
+    def _spill_later(self, item: ArchiveItem) -> asyncio.Future:
+        """
+        在落盘线程中写文件，不阻塞事件循环
+        """
+        future = asyncio.get_running_loop().run_in_executor(self._spill_executor, self._spill, item)
+        self._spilling.add(future)
+        future.add_done_callback(self._spilling.discard)
+        return future
+
+    def _spill(self, item: ArchiveItem):
+        if not self.spill_dir:
+            logger.error(f"🍺 S3 archive item dropped --key {item.key}")
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(os.path.join(self.spill_dir, f"{item.uid}.bin"), "wb") as f:
+                f.write(item.body)
+            # 元数据最后写入，作为完整性标记
+            with open(os.path.join(self.spill_dir, f"{item.uid}.json"), "w", encoding="utf-8") as f:
+                json.dump({"key": item.key, "params": item.params, "processed": item.processed}, f)
+        except OSError as e:
+            logger.error(f"🍺 S3 archive spill error: {e} --key {item.key}")
+            return
+        self.stats.spilled += 1
+
+    def _restore(self, limit: int) -> List[ArchiveItem]:
+        items = []
+        if not os.path.isdir(self.spill_dir):
+            return items
+        for name in sorted(os.listdir(self.spill_dir)):
+            if len(items) >= limit:
+                break
+            if not name.endswith(".json"):
+                continue
+            uid = name[:-5]
+            meta_path = os.path.join(self.spill_dir, name)
+            body_path = os.path.join(self.spill_dir, f"{uid}.bin")
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                with open(body_path, "rb") as f:
+                    body = f.read()
+                os.remove(meta_path)
+                os.remove(body_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"🍺 S3 archive spill entry broken --uid {uid} --error {e}")
+                continue
+            items.append(ArchiveItem(
+                key=meta["key"],
+                body=body,
+                params=meta["params"],
+                uid=uid,
+                processed=meta.get("processed", False)
+            ))
+        return items
+
+    async def _drain_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.drain_interval)
+            # 只在队列有余量时回放，避免在 S3 不可用时反复搬运
+            room = self.max_queue // 2 - self._queue.qsize()
+            if room <= 0:
+                continue
+            try:
+                items = await loop.run_in_executor(self._executor, self._restore, room)
+            except Exception as e:
+                logger.exception(f"🍺 S3 archive drain error: {e}")
+                continue
+            for item in items:
+                self.stats.restored += 1
+                self._enqueue(item)
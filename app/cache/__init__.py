@@ -3,6 +3,12 @@
 # @Author  : sudoskys
 # @File    : __init__.py.py
 # @Software: PyCharm
-from .elara import ElaraClientSyncWrapper
 
-cache = ElaraClientSyncWrapper(backend="elara.db")
+
+def __getattr__(name):
+    # 首次访问 cache 时才打开 elara.db，导入子模块不再有副作用
+    if name == "cache":
+        from .elara import ElaraClientSyncWrapper
+        globals()["cache"] = ElaraClientSyncWrapper(backend="elara.db")
+        return globals()["cache"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/12 下午4:10
+# @Author  : sudoskys
+# @File    : file_id.py
+# @Software: PyCharm
+"""
+Telegram file_id 复用，按图片内容哈希索引，相同内容不再重复上传
+file_id 只对上传它的 Bot 有效，键中包含 Bot ID
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+from pydantic import BaseModel
+
+from .sqlite import SqliteClientAsyncWrapper
+from ..cache.base import PREFIX
+
+
+class FileIdStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+
+
+class FileIdCache(object):
+    def __init__(self,
+                 bot_id: str,
+                 *,
+                 path: Optional[str] = "file_id.db",
+                 max_entries: int = 10000,
+                 ttl: Optional[float] = 30 * 24 * 3600,
+                 ):
+        """
+        :param bot_id: Bot ID，token 冒号前的部分
+        :param path: SQLite 文件，为空时只保存在内存
+        :param max_entries: 内存中保留的条目数
+        :param ttl: 持久化条目的过期时间，过期条目在落盘时清理
+        """
+        self.bot_id = bot_id
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = FileIdStats()
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._store = SqliteClientAsyncWrapper(
+            backend=path, prefix=f"{PREFIX}file_id:{bot_id}:"
+        ) if path else None
+
+    def __len__(self):
+        return len(self._memory)
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _remember(self, key: str, file_id: str):
+        self._memory[key] = file_id
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        file_id = self._memory.get(key)
+        if file_id is not None:
+            self._memory.move_to_end(key)
+        elif self._store is not None:
+            file_id = await self._store.read_data(key)
+            if file_id is not None:
+                self._remember(key, file_id)
+        if file_id is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return file_id
+
+    async def set(self, key: str, file_id: str):
+        self._remember(key, file_id)
+        if self._store is not None:
+            await self._store.set_data(key, file_id, timeout=self.ttl)
+
+    async def discard(self, key: str):
+        """
+        file_id 失效时移除，持久层写入空值覆盖
+        """
+        self._memory.pop(key, None)
+        if self._store is not None:
+            await self._store.set_data(key, None, timeout=1)
+
+    async def close(self):
+        if self._store is not None:
+            await self._store.close()
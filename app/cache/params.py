@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/14 上午11:20
+# @Author  : sudoskys
+# @File    : params.py
+# @Software: PyCharm
+"""
+记住每个会话和用户上一次的生成参数，/draw 未指定的参数沿用上一次
+只保存与默认值不同的参数，条目很小；内存按条目数和字节预算淘汰
+"""
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+from telebot.asyncio_storage import StateMemoryStorage
+
+from .sqlite import SqliteClientAsyncWrapper
+from ..cache.base import PREFIX
+
+REMEMBERED_KEYS = ("sampler", "width", "height", "negative_prompt", "seed")
+
+
+class ParamMemoryStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    memory_items: int = 0
+    memory_bytes: int = 0
+
+
+class ParamMemory(object):
+    """
+    私聊按用户记忆；群组同时记忆会话和会话内的用户，优先使用用户自己的上一次参数
+    """
+
+    def __init__(self,
+                 *,
+                 path: Optional[str] = "params.db",
+                 max_entries: int = 50000,
+                 memory_budget: int = 8 * 1024 * 1024,
+                 ttl: Optional[float] = 7 * 24 * 3600,
+                 ):
+        """
+        :param path: SQLite 文件，为空时只保存在内存
+        :param max_entries: 内存中保留的条目数，0 时不使用内存层
+        :param memory_budget: 内存条目的估算字节上限
+        :param ttl: 条目过期时间
+        """
+        self.max_entries = max_entries
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.stats = ParamMemoryStats()
+        # key -> (过期时间, 估算字节, 参数)
+        self._memory: "OrderedDict[str, Tuple[Optional[float], int, Dict[str, Any]]]" = OrderedDict()
+        self._store = SqliteClientAsyncWrapper(
+            backend=path, prefix=f"{PREFIX}params:"
+        ) if path else None
+
+    def __len__(self):
+        return len(self._memory)
+
+    @staticmethod
+    def keys(chat_id: Any, user_id: Any) -> Tuple[str, ...]:
+        """
+        :return: 按优先级排列的键
+        """
+        if chat_id == user_id:
+            return f"user:{user_id}",
+        return f"user:{chat_id}:{user_id}", f"chat:{chat_id}"
+
+    @staticmethod
+    def _size(key: str, params: Dict[str, Any]) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(params) + sum(
+            sys.getsizeof(name) + sys.getsizeof(value) for name, value in params.items()
+        )
+
+    def _expire_at(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl else None
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._memory.get(key)
+        if item is None:
+            return None
+        expire_at, _, params = item
+        if expire_at is not None and expire_at < time.time():
+            self._memory_remove(key)
+            return None
+        self._memory.move_to_end(key)
+        return params
+
+    def _memory_put(self, key: str, params: Dict[str, Any], expire_at: Optional[float]):
+        self._memory_remove(key)
+        if not self.max_entries:
+            return
+        size = self._size(key, params)
+        self._memory[key] = (expire_at, size, params)
+        self.stats.memory_bytes += size
+        while len(self._memory) > self.max_entries or self.stats.memory_bytes > self.memory_budget:
+            self._memory_remove(next(iter(self._memory)))
+            self.stats.evictions += 1
+        self.stats.memory_items = len(self._memory)
+
+    def _memory_remove(self, key: str):
+        item = self._memory.pop(key, None)
+        if item is not None:
+            self.stats.memory_bytes -= item[1]
+        self.stats.memory_items = len(self._memory)
+
+    async def get(self, chat_id: Any, user_id: Any) -> Dict[str, Any]:
+        """
+        :return: 上一次与默认值不同的参数，没有记录时为空
+        """
+        keys = self.keys(chat_id, user_id)
+        found = {key: self._memory_get(key) for key in keys}
+        missing = [key for key, params in found.items() if params is None]
+        if missing and self._store is not None:
+            # 持久层里的过期时间已经失效，读回后重新计时
+            for key, params in (await self._store.read_many(missing)).items():
+                self._memory_put(key, params, self._expire_at())
+                found[key] = params
+        for key in keys:
+            if found[key] is not None:
+                self.stats.hits += 1
+                return found[key]
+        self.stats.misses += 1
+        return {}
+
+    async def set(self, chat_id: Any, user_id: Any, params: Dict[str, Any]):
+        """
+        :param params: 只包含 REMEMBERED_KEYS 中与默认值不同的参数
+        """
+        expire_at = self._expire_at()
+        keys = self.keys(chat_id, user_id)
+        for key in keys:
+            self._memory_put(key, params, expire_at)
+        if self._store is not None:
+            await self._store.set_many({key: params for key in keys}, timeout=self.ttl)
+
+    async def close(self):
+        if self._store is not None:
+            await self._store.close()
+
+
+class _BoundedDict(OrderedDict):
+    def __init__(self, max_entries: int):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_entries:
+            self.popitem(last=False)
+
+
+class BoundedStateStorage(StateMemoryStorage):
+    """
+    条目数有上限的状态存储，超出时淘汰最早写入的
+    """
+
+    def __init__(self, max_entries: int = 10000, **kwargs):
+        super().__init__(**kwargs)
+        self.data = _BoundedDict(max_entries)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/27 下午8:16
+# @Author  : sudoskys
+# @File    : result.py
+# @Software: PyCharm
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from ..core.schema import NaiResult
+
+
+class CacheStats(BaseModel):
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    memory_bytes: int = 0
+    memory_items: int = 0
+    disk_bytes: int = 0
+    disk_items: int = 0
+
+
+class ResultCache(object):
+    """
+    确定性生成结果缓存，按请求指纹寻址
+    内存 LRU 受字节预算限制，磁盘层按 TTL 和总大小淘汰
+    """
+
+    def __init__(self,
+                 *,
+                 memory_budget: int = 64 * 1024 * 1024,
+                 disk_path: Optional[str] = "result_cache",
+                 disk_budget: int = 1024 * 1024 * 1024,
+                 ttl: Optional[float] = 7 * 24 * 3600,
+                 ):
+        self.memory_budget = memory_budget
+        self.disk_path = disk_path
+        self.disk_budget = disk_budget
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._memory: "OrderedDict[str, Tuple[float, int, NaiResult]]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_loaded = False
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _size(result: NaiResult) -> int:
+        return sum(len(file[1]) for file in result.files or [])
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and created_at + self.ttl < time.time()
+
+    async def get(self, key: str) -> Optional[NaiResult]:
+        item = self._memory.get(key)
+        if item is not None:
+            created_at, size, result = item
+            if not self._expired(created_at):
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return result
+            self._memory_remove(key)
+        if self.disk_path:
+            async with self._lock:
+                loaded = await self._run(self._disk_read, key)
+            if loaded is not None:
+                created_at, result = loaded
+                self._memory_put(key, created_at, result)
+                self.stats.disk_hits += 1
+                return result
+        self.stats.misses += 1
+        return None
+
+    async def set(self, key: str, result: NaiResult):
+        if not result.files:
+            return
+        created_at = time.time()
+        self._memory_put(key, created_at, result)
+        if self.disk_path:
+            async with self._lock:
+                await self._run(self._disk_write, key, created_at, result)
+
+    @staticmethod
+    async def _run(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _memory_put(self, key: str, created_at: float, result: NaiResult):
+        size = self._size(result)
+        if size > self.memory_budget:
+            return
+        self._memory_remove(key)
+        self._memory[key] = (created_at, size, result)
+        self.stats.memory_bytes += size
+        while self.stats.memory_bytes > self.memory_budget:
+            self._memory_remove(next(iter(self._memory)))
+        self.stats.memory_items = len(self._memory)
+
+    def _memory_remove(self, key: str):
+        item = self._memory.pop(key, None)
+        if item is not None:
+            self.stats.memory_bytes -= item[1]
+        self.stats.memory_items = len(self._memory)
+
+    def _disk_file(self, key: str, suffix: str) -> str:
+        return os.path.join(self.disk_path, key[:2], f"{key}{suffix}")
+
+    def _disk_load(self):
+        """
+        扫描磁盘层，按访问时间重建 LRU 索引
+        """
+        if self._disk_loaded:
+            return
+        self._disk_loaded = True
+        os.makedirs(self.disk_path, exist_ok=True)
+        entries = []
+        for root, _, files in os.walk(self.disk_path):
+            for name in files:
+                if not name.endswith(".bin"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self.stats.disk_bytes += size
+        self.stats.disk_items = len(self._disk)
+
+    def _disk_remove(self, key: str):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self.stats.disk_bytes -= size
+        for suffix in (".json", ".bin"):
+            try:
+                os.remove(self._disk_file(key, suffix))
+            except FileNotFoundError:
+                pass
+        self.stats.disk_items = len(self._disk)
+
+    def _disk_read(self, key: str) -> Optional[Tuple[float, NaiResult]]:
+        self._disk_load()
+        if key not in self._disk:
+            return None
+        try:
+            with open(self._disk_file(key, ".json"), "r", encoding="utf-8") as f:
+                header = json.load(f)
+            if self._expired(header["created_at"]):
+                self._disk_remove(key)
+                return None
+            files = []
+            with open(self._disk_file(key, ".bin"), "rb") as f:
+                for name, size in header["files"]:
+                    files.append((name, f.read(size)))
+            os.utime(self._disk_file(key, ".bin"))
+        except Exception as e:
+            logger.warning(f"🍺 Result cache entry broken --key {key} --error {e}")
+            self._disk_remove(key)
+            return None
+        self._disk.move_to_end(key)
+        return header["created_at"], NaiResult(
+            meta=NaiResult.RequestParams(**header["meta"]),
+            files=files
+        )
+
+    def _disk_write(self, key: str, created_at: float, result: NaiResult):
+        self._disk_load()
+        size = self._size(result)
+        if size > self.disk_budget:
+            return
+        self._disk_remove(key)
+        os.makedirs(os.path.dirname(self._disk_file(key, ".bin")), exist_ok=True)
+        with open(self._disk_file(key, ".bin"), "wb") as f:
+            for _, data in result.files:
+                f.write(data)
+        with open(self._disk_file(key, ".json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "created_at": created_at,
+                "meta": result.meta.model_dump(),
+                "files": [(name, len(data)) for name, data in result.files],
+            }, f)
+        self._disk[key] = size
+        self.stats.disk_bytes += size
+        while self.stats.disk_bytes > self.disk_budget:
+            self._disk_remove(next(iter(self._disk)))
+        self.stats.disk_items = len(self._disk)
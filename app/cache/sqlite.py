@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/28 下午9:02
+# @Author  : sudoskys
+# @File    : sqlite.py
+# @Software: PyCharm
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from loguru import logger
+
+from ..cache.base import AbstractDataClass, PREFIX
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expire_at REAL
+)
+"""
+
+
+class SqliteClientAsyncWrapper(AbstractDataClass):
+    """
+    SQLite WAL 数据基类
+    写入先进入内存缓冲，后台按间隔批量落盘，所有阻塞 I/O 都在单独线程执行
+    """
+
+    def __init__(self,
+                 backend,
+                 prefix: str = PREFIX,
+                 flush_interval: float = 1.0,
+                 max_batch: int = 1000,
+                 ):
+        self.prefix = prefix
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-cache")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.backend, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(_SCHEMA)
+            self._conn.commit()
+        return self._conn
+
+    def _ensure_flusher(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"🍺 Sqlite cache flush error: {e}")
+
+    @staticmethod
+    def _expire_at(timeout: Optional[float]) -> Optional[float]:
+        return time.time() + timeout if timeout else None
+
+    @staticmethod
+    def _decode(raw: Tuple[str, Optional[float]]) -> Any:
+        value, expire_at = raw
+        if expire_at is not None and expire_at < time.time():
+            return None
+        return json.loads(value)
+
+    async def ping(self):
+        await self._run(self._connect)
+        return True
+
+    def update_backend(self, backend):
+        if self._conn is not None:
+            self._executor.submit(self._conn.close).result()
+            self._conn = None
+        self.backend = backend
+        return True
+
+    async def read_data(self, key):
+        return (await self.read_many([key])).get(key)
+
+    async def read_many(self, keys: Iterable[Any]) -> Dict[Any, Any]:
+        """
+        批量读取，未命中或已过期的键不出现在结果中
+        """
+        _res = {}
+        missing = {}
+        for key in keys:
+            _key = self.prefix + str(key)
+            if _key in self._pending:
+                value = self._decode(self._pending[_key])
+                if value is not None:
+                    _res[key] = value
+            else:
+                missing[_key] = key
+        if missing:
+            for _key, raw in (await self._run(self._select, list(missing))).items():
+                value = self._decode(raw)
+                if value is not None:
+                    _res[missing[_key]] = value
+        return _res
+
+    async def set_data(self, key, value, timeout=None):
+        await self.set_many({key: value}, timeout=timeout)
+
+    async def set_many(self, mapping: Dict[Any, Any], timeout: Optional[float] = None):
+        """
+        批量写入，数据先进入缓冲区
+        :param mapping: 键值
+        :param timeout: 过期秒数，为空时永不过期
+        """
+        expire_at = self._expire_at(timeout)
+        for key, value in mapping.items():
+            self._pending[self.prefix + str(key)] = (json.dumps(value, ensure_ascii=False), expire_at)
+        self._ensure_flusher()
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+
+    async def flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await self._run(self._write, batch)
+            except Exception:
+                # 写入失败时放回缓冲区，保留更新的值
+                batch.update(self._pending)
+                self._pending = batch
+                raise
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    def _select(self, keys) -> Dict[str, Tuple[str, Optional[float]]]:
+        conn = self._connect()
+        _res = {}
+        # SQLite 默认最多 999 个绑定参数
+        for index in range(0, len(keys), 900):
+            chunk = keys[index:index + 900]
+            rows = conn.execute(
+                f"SELECT key, value, expire_at FROM kv WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for key, value, expire_at in rows:
+                _res[key] = (value, expire_at)
+        return _res
+
+    def _write(self, batch: Dict[str, Tuple[str, Optional[float]]]):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO kv (key, value, expire_at) VALUES (?, ?, ?)",
+                [(key, value, expire_at) for key, (value, expire_at) in batch.items()]
+            )
+            conn.execute("DELETE FROM kv WHERE expire_at IS NOT NULL AND expire_at < ?", (time.time(),))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/16 上午11:20
+# @Author  : sudoskys
+# @File    : capture.py
+# @Software: PyCharm
+"""
+/draw 流量采集，每行一个 JSON，供 benchmark.replay 按真实的到达节奏回放
+不保存提示词原文，会话和用户 ID 用 HMAC 替换，只保留标签数、长度和解析出的参数
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from telebot import types
+
+# 原样保留的参数，提示词类参数只记录形状
+CAPTURED_KEYS = ("seed", "cfg_rescale", "sampler", "width", "height", "samples")
+
+
+def prompt_shape(text: Optional[str]) -> Optional[Dict[str, int]]:
+    if not text:
+        return None
+    return {"tags": len([tag for tag in text.split(",") if tag.strip()]), "chars": len(text)}
+
+
+class TrafficRecorder(object):
+    """
+    追加写入，达到大小上限后停止记录
+    """
+
+    def __init__(self,
+                 path: str,
+                 *,
+                 salt: Optional[str] = None,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 flush_interval: float = 1.0,
+                 ):
+        """
+        :param path: JSONL 文件
+        :param salt: HMAC 密钥，未设置时每次启动随机，不同次采集之间的 ID 无法关联
+        :param max_bytes: 文件大小上限
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._key = salt.encode("utf-8") if salt else os.urandom(16)
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _anonymize(self, value: int) -> int:
+        digest = hmac.new(self._key, str(value).encode("utf-8"), hashlib.sha256).digest()
+        anonymized = int.from_bytes(digest[:6], "big") + 1
+        # 群组 ID 为负数，回放时据此区分会话类型
+        return -anonymized if value < 0 else anonymized
+
+    def start(self):
+        if self._file is not None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._task = asyncio.create_task(self._flush_loop())
+        logger.info(f"🍺 Traffic capture started --path {self.path}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._file is not None:
+                self._file.flush()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"🍺 Traffic capture closed --path {self.path} --records {self.records}")
+
+    def record(self, message: types.Message, parsed: Any, at: Optional[float] = None):
+        """
+        :param parsed: parse_draw 的结果，解析失败也记录
+        :param at: 到达时间，默认当前时间
+        """
+        if self._file is None:
+            return
+        if self._file.tell() >= self.max_bytes:
+            logger.warning(f"🍺 Traffic capture size limit reached, stop recording --path {self.path}")
+            self._file.close()
+            self._file = None
+            return
+        entry = {
+            "t": round(at if at is not None else time.time(), 4),
+            "chat": self._anonymize(message.chat.id),
+            "chat_type": message.chat.type,
+            "user": self._anonymize(message.from_user.id),
+            "matched": parsed.matched,
+        }
+        if parsed.matched:
+            entry["prompt"] = prompt_shape(parsed.query("input"))
+            entry["negative_prompt"] = prompt_shape(parsed.query("negative_prompt"))
+            entry["args"] = {key: parsed.query(key) for key in CAPTURED_KEYS if parsed.query(key) is not None}
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.records += 1
@@ -18,9 +18,10 @@ DrawCommand = Alconna(
     Option("--sampler|-sam", Args["sampler", NovelAiInference.valid_sampler()], help_text="设置采样方式"),
     Option("--width|-wi", Args['width', int], help_text="设置宽度"),
     Option("--height|-he", Args['height', int], help_text="设置高度"),
+    Option("--samples|-n", Args['samples', int], help_text="生成多张变体"),
     meta=CommandMeta(fuzzy_match=True,
                      usage="draw [prompt] [-neg negative_prompt] [-s seed] "
-                           "[-cfg cfg_rescale] [-sam sampler] [-w width] [-h height]",
+                           "[-cfg cfg_rescale] [-sam sampler] [-w width] [-h height] [-n samples]",
                      description="使用指定的prompt生成图片"
                      )
 )
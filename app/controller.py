@@ -4,72 +4,225 @@
 # @File    : controller.py
 # @Software: PyCharm
 import asyncio
+import random
 import time
-from io import BytesIO
+from functools import partial
+from typing import Optional
 
-import shortuuid
 from loguru import logger
 from pydantic import ValidationError
 from telebot import types
 from telebot import util, formatting
 from telebot.async_telebot import AsyncTeleBot
-from telebot.asyncio_storage import StateMemoryStorage
+from telebot.asyncio_helper import ApiTelegramException
 
-from .command import DrawCommand
-from .core import NovelAiInference, ServerError, NaiResult, CheckError
-from .schema import BotSetting, AwsSetting
+from .archive import S3Archiver
+from .capture import TrafficRecorder
+from .dataset import ShardArchiver
+from .cache.params import ParamMemory, REMEMBERED_KEYS
+from .cache.result import ResultCache
+from .jobqueue import SqliteJobQueue, JobWorker
+from .core import DrawRequest, ServerError, CheckError, NovelAiSession, RequestTimeout, TokenPool, \
+    RetryPolicy
+from .metrics import DRAW_OUTCOME, MetricsServer, stage, track_in_flight
+from .parser import parse_draw, draw_help
+from .postprocess import PostProcessor, PostProcessError
+from .preview import ChatThrottle, LivePreview
+from .scheduler import DrawScheduler, QueueFullError, LANE_PRIVATE, LANE_GROUP
+from .schema import BotSetting, AwsSetting, NovelAiSetting, DrawQueueSetting, ResultCacheSetting, \
+    PostProcessSetting, MetricsSetting, WebhookSetting, WorkerSetting, ParamMemorySetting, \
+    PromptCheckSetting, TrafficCaptureSetting
+from .singleflight import SingleFlight
+from .tenant import BotTenant
+from .tokenizer import check_prompt, get_tokenizer
 from .utils import parse_command
 
-StepCache = StateMemoryStorage()
-
-from asgiref.sync import sync_to_async
-
-
-@sync_to_async
-def upload_to_aws(
-        file_bytes: BytesIO,
-        message_date: int,
-        params: NaiResult.RequestParams
-):
-    import boto3
-    from botocore.exceptions import ClientError
-    s3_client = boto3.client('s3',
-                             aws_access_key_id=AwsSetting.aws_access_key_id,
-                             aws_secret_access_key=AwsSetting.aws_secret_access_key
-                             )
-    try:
-        file_uid = shortuuid.uuid()[:2]
-        today = time.strftime('%Y-%m-%d', time.localtime(time.time()))
-        s3_client.upload_fileobj(
-            file_bytes,
-            AwsSetting.aws_bucket_name,
-            f"telegram/{today}/nai_tg_{file_uid}_{message_date}.webp"
+
+class BotRunner(object):
+    """
+    一个事件循环中运行一个或多个 Bot，上游连接池、调度器、缓存和归档共享
+    """
+
+    def __init__(self):
+        profiles = BotSetting.profiles()
+        if not profiles:
+            raise ValueError("TELEGRAM_BOT_TOKEN or TELEGRAM_BOTS is required")
+        self.tenants = [BotTenant(profile) for profile in profiles]
+        self.session = NovelAiSession(
+            max_connections=NovelAiSetting.max_connections,
+            max_keepalive_connections=NovelAiSetting.max_keepalive_connections,
+            keepalive_expiry=NovelAiSetting.keepalive_expiry,
+            http2=NovelAiSetting.http2,
+            proxy=NovelAiSetting.proxy_address,
+            tokens=TokenPool(
+                NovelAiSetting.token_list,
+                max_in_flight=NovelAiSetting.token_concurrency,
+                cooldown=NovelAiSetting.token_cooldown,
+                probe_interval=NovelAiSetting.token_probe_interval,
+                endpoint=NovelAiSetting.endpoint,
+            ) if NovelAiSetting.token_list else None,
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=NovelAiSetting.retry_attempts,
+            backoff=NovelAiSetting.retry_backoff,
+            deadline=NovelAiSetting.deadline,
+            attempt_timeout=NovelAiSetting.attempt_timeout,
+            hedge_percentile=NovelAiSetting.hedge_percentile,
         )
-        # 上传请求参数
-        s3_client.put_object(
-            Body=params.model_dump_json(),
-            Bucket=AwsSetting.aws_bucket_name,
-            Key=f"telegram/{today}/nai_tg_{file_uid}_{message_date}.json"
+        concurrency = DrawQueueSetting.concurrency
+        if self.session.tokens is not None and concurrency < self.session.tokens.capacity:
+            logger.info(f"🍺 DRAW_CONCURRENCY raised to token pool capacity {self.session.tokens.capacity}")
+            concurrency = self.session.tokens.capacity
+        self.single_flight = SingleFlight()
+        self.preview_throttle = ChatThrottle(interval=DrawQueueSetting.preview_interval)
+        self.scheduler = DrawScheduler(
+            concurrency=concurrency,
+            max_queue=DrawQueueSetting.max_queue,
+            max_pending_per_user=DrawQueueSetting.max_pending_per_user,
         )
-    except ClientError as e:
-        logger.exception(f"🍺 Upload to S3 error: {e}")
-        return None
-    else:
-        logger.info(f"🍺 Upload to S3 --file_uid {file_uid}")
-        return True
+        for tenant in self.tenants:
+            self.scheduler.set_quota(tenant.name, tenant.max_queue)
+        self.result_cache = ResultCache(
+            memory_budget=ResultCacheSetting.memory_mb * 1024 * 1024,
+            disk_path=ResultCacheSetting.disk_path,
+            disk_budget=ResultCacheSetting.disk_mb * 1024 * 1024,
+            ttl=ResultCacheSetting.ttl,
+        ) if ResultCacheSetting.enable else None
+        self.param_memory = ParamMemory(
+            path=ParamMemorySetting.path,
+            # 多个工作进程共用 SQLite，进程内的内存层会读到旧参数
+            max_entries=0 if WorkerSetting.role == "worker" and ParamMemorySetting.path
+            else ParamMemorySetting.max_entries,
+            memory_budget=ParamMemorySetting.memory_budget,
+            ttl=ParamMemorySetting.ttl,
+        ) if ParamMemorySetting.enable else None
+        self.postprocessor = PostProcessor(
+            workers=PostProcessSetting.workers,
+            timeout=PostProcessSetting.timeout,
+            max_pending=PostProcessSetting.max_pending,
+            preview=PostProcessSetting.preview,
+            preview_max_side=PostProcessSetting.preview_max_side,
+            archive_webp=PostProcessSetting.archive_webp,
+            webp_quality=PostProcessSetting.webp_quality,
+            strip_metadata=PostProcessSetting.strip_metadata,
+        )
+        self.archiver = None
+        if AwsSetting.available and AwsSetting.archive_mode == "shard":
+            self.archiver = ShardArchiver(
+                bucket=AwsSetting.aws_bucket_name,
+                aws_access_key_id=AwsSetting.aws_access_key_id,
+                aws_secret_access_key=AwsSetting.aws_secret_access_key,
+                endpoint_url=AwsSetting.aws_endpoint_url,
+                directory=AwsSetting.archive_shard_dir,
+                max_bytes=AwsSetting.archive_shard_mb * 1024 * 1024,
+                max_age=AwsSetting.archive_shard_seconds,
+                key_prefix=AwsSetting.archive_shard_prefix,
+                max_queue=AwsSetting.archive_max_queue,
+                keep_local=AwsSetting.archive_keep_shards,
+                transcode=self.postprocessor.transcode,
+            )
+        elif AwsSetting.available:
+            self.archiver = S3Archiver(
+                bucket=AwsSetting.aws_bucket_name,
+                aws_access_key_id=AwsSetting.aws_access_key_id,
+                aws_secret_access_key=AwsSetting.aws_secret_access_key,
+                endpoint_url=AwsSetting.aws_endpoint_url,
+                workers=AwsSetting.archive_workers,
+                max_queue=AwsSetting.archive_max_queue,
+                max_retries=AwsSetting.archive_max_retries,
+                spill_dir=AwsSetting.archive_spill_dir,
+                transcode=self.postprocessor.transcode,
+            )
+        self.metrics = MetricsServer(
+            host=MetricsSetting.host,
+            port=MetricsSetting.port,
+        ) if MetricsSetting.enable else None
+        self.role = WorkerSetting.role
+        # 工作进程处理的是已记录过的更新
+        self.recorder = TrafficRecorder(
+            TrafficCaptureSetting.path,
+            salt=TrafficCaptureSetting.salt,
+            max_bytes=TrafficCaptureSetting.max_mb * 1024 * 1024,
+        ) if TrafficCaptureSetting.path and self.role != "worker" else None
+        self.jobs = SqliteJobQueue(
+            WorkerSetting.queue_path,
+            lease_seconds=WorkerSetting.lease_seconds,
+            max_attempts=WorkerSetting.max_attempts,
+        ) if self.role != "all" else None
+        self.webhook = None
+        if WebhookSetting.mode == "webhook" and self.role != "worker":
+            from .webhook import WebhookServer
+            routes = [self.webhook_route(tenant) for tenant in self.tenants]
+            bot, path, url, secret_token = routes[0]
+            self.webhook = WebhookServer(
+                bot,
+                host=WebhookSetting.host,
+                port=WebhookSetting.port,
+                path=path,
+                url=url,
+                secret_token=secret_token,
+                max_queue=WebhookSetting.max_queue,
+                workers=WebhookSetting.workers,
+            )
+            for bot, path, url, secret_token in routes[1:]:
+                self.webhook.add_route(bot, path, url=url, secret_token=secret_token)
 
+    @property
+    def bot(self) -> AsyncTeleBot:
+        """
+        第一个 Bot，单 Bot 部署时即唯一的 Bot
+        """
+        return self.tenants[0].bot
 
-class BotRunner(object):
-    def __init__(self):
-        self.bot = AsyncTeleBot(BotSetting.token, state_storage=StepCache)
+    def tenant(self, name: Optional[str]) -> BotTenant:
+        """
+        按名称查找 Bot，找不到时返回第一个，兼容未记录 Bot 的旧任务
+        """
+        for tenant in self.tenants:
+            if tenant.name == name:
+                return tenant
+        return self.tenants[0]
 
-    def run(self):
-        logger.info("Bot Start")
-        bot = self.bot
+    def webhook_route(self, tenant: BotTenant):
+        """
+        单个 Bot 使用 TELEGRAM_WEBHOOK_PATH / URL，多个 Bot 时默认在其后追加 Bot 名称
+        """
+        profile = tenant.profile
+        suffix = f"/{tenant.name}" if len(self.tenants) > 1 else ""
+        path = profile.webhook_path or f"{WebhookSetting.path.rstrip('/')}{suffix}"
+        url = profile.webhook_url
+        if url is None and WebhookSetting.url:
+            url = f"{WebhookSetting.url.rstrip('/')}{suffix}"
+        return tenant.bot, path, url, profile.webhook_secret or WebhookSetting.secret_token
+
+    def setup(self):
+        """
+        注册处理器
+        """
         if BotSetting.proxy_address:
             from telebot import asyncio_helper
             asyncio_helper.proxy = BotSetting.proxy_address
             logger.info("Proxy tunnels are being used!")
+        for tenant in self.tenants:
+            self.register(tenant)
+
+    def register(self, tenant: BotTenant):
+        """
+        为一个 Bot 注册处理器，共享组件来自 BotRunner，限额来自 Bot 自己的配置
+        """
+        bot = tenant.bot
+        session = self.session
+        scheduler = self.scheduler
+        retry_policy = self.retry_policy
+        single_flight = self.single_flight
+        preview_throttle = self.preview_throttle
+        result_cache = self.result_cache
+        archiver = self.archiver
+        postprocessor = self.postprocessor
+        file_ids = tenant.file_ids
+        param_memory = self.param_memory
+        recorder = self.recorder
+        jobs = self.jobs
 
         @bot.message_handler(commands='help', chat_types=['private', 'supergroup', 'group'])
         async def listen_help_command(message: types.Message):
@@ -78,21 +231,216 @@ class BotRunner(object):
                 text=formatting.format_text(
                     formatting.mbold("🥕 Help"),
                     formatting.mitalic("draw [prompt] [-neg negative_prompt] [-s seed] [-st steps] "
-                                       "[-cfg cfg_rescale] [-sam sampler] [-wi width] [-he height]"
+                                       "[-cfg cfg_rescale] [-sam sampler] [-wi width] [-he height] [-n samples]"
                                        ),
                     formatting.mbold("🥕 /draw"),
                     formatting.mitalic("Draw something and generate text. Can be used in a group chat."),
                     formatting.mitalic(
-                        "If using the bot within a group, it will use the parameters from the last generation.")
+                        "Parameters you leave out are taken from the last generation in this chat, "
+                        "use -s 0 for a new random seed.")
                 ),
                 parse_mode="MarkdownV2"
             )
 
-        @bot.message_handler(
-            commands='draw',
-            content_types=["text"],
-            chat_types=['group', 'supergroup', 'private']
-        )
+        def prompt_check(text: str) -> str:
+            checked = check_prompt(
+                text,
+                limit=PromptCheckSetting.token_limit,
+                overflow=PromptCheckSetting.overflow,
+                vocab_path=PromptCheckSetting.vocab_path,
+            )
+            if checked.dropped:
+                logger.info(f"🍺 Prompt trimmed to {checked.tokens} tokens --dropped {checked.dropped} tags")
+            return checked.text
+
+        async def send_document(message: types.Message, file):
+            """
+            相同内容已上传过时直接发送 file_id
+            """
+            digest = file_ids.digest(file[1]) if file_ids is not None else None
+            file_id = await file_ids.get(digest) if digest else None
+            if file_id is not None:
+                try:
+                    return await bot.send_document(
+                        chat_id=message.chat.id,
+                        document=file_id,
+                        reply_to_message_id=message.message_id,
+                    )
+                except ApiTelegramException as e:
+                    logger.warning(f"🍺 Cached file_id rejected, upload again --error {e}")
+                    await file_ids.discard(digest)
+            sent = await bot.send_document(
+                chat_id=message.chat.id,
+                document=file,
+                caption=None,
+                reply_to_message_id=message.message_id,
+                parse_mode="MarkdownV2"
+            )
+            if digest and sent.document is not None:
+                await file_ids.set(digest, sent.document.file_id)
+            return sent
+
+        async def send_media_group(message: types.Message, files, caption: Optional[str] = None):
+            """
+            多张图片合并为一条媒体组发送，已上传过的内容使用 file_id
+            """
+            if len(files) == 1:
+                return [await send_document(message, files[0])]
+            digests = [file_ids.digest(file[1]) if file_ids is not None else None for file in files]
+            file_id_list = [await file_ids.get(digest) if digest else None for digest in digests]
+
+            def build_media(use_file_id: bool):
+                return [
+                    types.InputMediaDocument(
+                        media=file_id if use_file_id and file_id else file,
+                        caption=caption if index == len(files) - 1 else None,
+                    )
+                    for index, (file, file_id) in enumerate(zip(files, file_id_list))
+                ]
+
+            try:
+                sent = await bot.send_media_group(
+                    chat_id=message.chat.id,
+                    media=build_media(use_file_id=True),
+                    reply_to_message_id=message.message_id,
+                )
+            except ApiTelegramException as e:
+                if not any(file_id_list):
+                    raise
+                logger.warning(f"🍺 Cached file_id rejected, upload again --error {e}")
+                for digest, file_id in zip(digests, file_id_list):
+                    if file_id:
+                        await file_ids.discard(digest)
+                file_id_list = [None] * len(files)
+                sent = await bot.send_media_group(
+                    chat_id=message.chat.id,
+                    media=build_media(use_file_id=False),
+                    reply_to_message_id=message.message_id,
+                )
+            for digest, file_id, _message in zip(digests, file_id_list, sent):
+                if digest and not file_id and _message.document is not None:
+                    await file_ids.set(digest, _message.document.file_id)
+            return sent
+
+        async def remember(message: types.Message, infer: DrawRequest):
+            """
+            生成成功后才记住参数，失败的请求不覆盖上一次的参数
+            """
+            if param_memory is not None:
+                await param_memory.set(message.chat.id, message.from_user.id, infer.overrides(REMEMBERED_KEYS))
+
+        async def draw_variations(message: types.Message, base: DrawRequest, samples: int, seeded: bool):
+            """
+            -n 多张变体：各自使用不同种子并发生成，进度实时更新，完成后一次性发送媒体组
+            """
+            if seeded:
+                # 种子为 uint32，0 表示随机，越界时回绕并跳过 0
+                seeds = []
+                seed = base.parameters["seed"]
+                while len(seeds) < samples:
+                    seed %= 2 ** 32
+                    if seed:
+                        seeds.append(seed)
+                    seed += 1
+            else:
+                seeds = [random.randint(1, 2 ** 32 - 1) for _ in range(samples)]
+            infers = [base.with_parameters(seed=seed) for seed in seeds]
+            keys = [infer.fingerprint() if result_cache is not None and seeded else None for infer in infers]
+            results = [await result_cache.get(key) if key else None for key in keys]
+            pending = [index for index, result in enumerate(results) if result is None]
+            # 全部命中缓存时不占用队列
+            tickets = scheduler.submit_many(
+                [
+                    partial(
+                        infers[index],
+                        session=session,
+                        validate_image=NovelAiSetting.validate_image,
+                        policy=retry_policy
+                    )
+                    for index in pending
+                ],
+                user_id=message.from_user.id,
+                chat_id=message.chat.id,
+                lane=LANE_PRIVATE if message.chat.type == "private" else LANE_GROUP,
+                tenant=tenant.name
+            ) if pending else []
+            status = f"🥕 Drawing {samples} variations"
+            if tickets and tickets[0].queued:
+                status += f", queued at position {tickets[0].position}, about {int(tickets[0].estimated_wait)}s"
+            progress = await bot.reply_to(message, status)
+
+            async def collect(index: int, ticket):
+                _result = await ticket
+                if keys[index]:
+                    await result_cache.set(keys[index], _result)
+                return index, _result
+
+            finished = samples - len(pending)
+            errors = []
+            try:
+                for future in asyncio.as_completed([collect(index, ticket) for index, ticket in zip(pending, tickets)]):
+                    try:
+                        index, result = await future
+                    except Exception as e:
+                        logger.exception(e)
+                        errors.append(e)
+                    else:
+                        results[index] = result
+                        finished += 1
+                    try:
+                        await bot.edit_message_text(
+                            f"🥕 {finished}/{samples} finished" + (f", {len(errors)} failed" if errors else ""),
+                            chat_id=progress.chat.id,
+                            message_id=progress.message_id,
+                        )
+                    except ApiTelegramException as e:
+                        logger.debug(f"🍺 Progress edit skipped --error {e}")
+            finally:
+                for ticket in tickets:
+                    ticket.cancel()
+            files = [(index, file) for index, result in enumerate(results) if result for file in result.files]
+            if not files:
+                await bot.delete_message(progress.chat.id, progress.message_id)
+                raise errors[0] if errors else ServerError(msg="🥕 No result")
+            with stage("send"):
+                await send_media_group(
+                    message,
+                    [file for _, file in files],
+                    caption="🥕 Seeds " + ", ".join(str(seeds[index]) for index, _ in files)
+                )
+            await bot.delete_message(progress.chat.id, progress.message_id)
+            DRAW_OUTCOME.labels(outcome="ok").inc()
+            await remember(message, base)
+            if archiver is not None:
+                for index, file in files:
+                    if index in pending:
+                        archiver.submit(
+                            file_bytes=file[1],
+                            message_date=message.date,
+                            params=results[index].meta
+                        )
+
+        async def enqueue_draw_command(message: types.Message):
+            """
+            接收进程只把 /draw 写入任务队列，由工作进程处理
+            """
+            if recorder is not None:
+                _, body = parse_command(message.text or message.caption)
+                if body:
+                    recorder.record(message, parse_draw(body))
+            if DrawQueueSetting.max_pending_per_user and \
+                    await jobs.pending(message.from_user.id) >= DrawQueueSetting.max_pending_per_user:
+                DRAW_OUTCOME.labels(outcome="queue_full").inc()
+                return await bot.reply_to(message, "🥕 Too many drawing requests, please try again later")
+            position = await jobs.queued()
+            await jobs.put(
+                {"update_id": 0, "message": message.json, "bot": tenant.name},
+                user_id=message.from_user.id
+            )
+            if position:
+                await bot.reply_to(message, f"🥕 Queued at position {position + 1}")
+
+        @track_in_flight("draw")
         async def listen_draw_command(message: types.Message):
             """
             群组命令，draw something
@@ -106,18 +454,14 @@ class BotRunner(object):
                 return await bot.reply_to(
                     message,
                     "🥕 Input something to draw\n"
-                    + DrawCommand.get_help(),
+                    + draw_help(),
                 )
-            if body.find(" -") != -1:
-                # 将 - 之前的内容用括号包裹
-                flag = body[body.find(" -"):]
-                body = body[:body.find(" -")]
-                body = f"'{body}'{flag}"
-                message_text = f"/draw {body}"
-            else:
-                message_text = f"/draw '{body}'"
-            parsed = DrawCommand.parse(message_text)
+            with stage("parse"):
+                parsed = parse_draw(body)
+            if recorder is not None:
+                recorder.record(message, parsed)
             if not parsed.matched:
+                DRAW_OUTCOME.labels(outcome="parse_error").inc()
                 return await bot.reply_to(
                     message,
                     parsed.error_info
@@ -127,38 +471,125 @@ class BotRunner(object):
                 f"--message:{message.id} --time:{int(time.time())}"
             )
             try:
-                infer = NovelAiInference.build(
-                    prompt=parsed.query("input"),
-                    negative_prompt=parsed.query("negative_prompt"),
-                    seed=parsed.query("seed"),
-                    steps=28,
-                    cfg_rescale=parsed.query("cfg_rescale"),
-                    sampler=parsed.query("sampler"),
-                    width=parsed.query("width"),
-                    height=parsed.query("height"),
-                )
-                result = await infer()
+                params = {
+                    key: parsed.query(key)
+                    for key in ("negative_prompt", "seed", "cfg_rescale", "sampler", "width", "height")
+                }
+                if param_memory is not None:
+                    # 未指定的参数沿用上一次
+                    for key, value in (await param_memory.get(message.chat.id, message.from_user.id)).items():
+                        if params.get(key) is None:
+                            params[key] = value
+                prompt = parsed.query("input")
+                if PromptCheckSetting.enable:
+                    # 超限的提示词在请求前拒绝或裁剪
+                    with stage("tokenize"):
+                        prompt = prompt_check(prompt)
+                        if params.get("negative_prompt"):
+                            params["negative_prompt"] = prompt_check(params["negative_prompt"])
+                infer = DrawRequest.build(prompt=prompt, steps=28, **params)
+                seeded = bool(infer.parameters["seed"])
+                samples = parsed.query("samples", 1)
+                if not 1 <= samples <= tenant.max_samples:
+                    raise CheckError(f"🥕 -n must be between 1 and {tenant.max_samples}")
+                if samples > 1:
+                    return await draw_variations(message, infer, samples, seeded=seeded)
+                fingerprint = infer.fingerprint()
+                # 指定种子时结果是确定的，可以直接复用
+                cache_key = None
+                if result_cache is not None and seeded:
+                    cache_key = fingerprint
+                result = await result_cache.get(cache_key) if cache_key else None
+                cached = result is not None
+                shared = False
+                live_preview = None
+                if not cached:
+                    async def generate():
+                        nonlocal live_preview
+                        if tenant.stream_preview:
+                            live_preview = LivePreview(
+                                bot, message, preview_throttle,
+                                size=(infer.parameters["width"], infer.parameters["height"]),
+                                steps=infer.parameters["steps"],
+                            )
+                        ticket = scheduler.submit(
+                            partial(
+                                infer,
+                                session=session,
+                                validate_image=NovelAiSetting.validate_image,
+                                policy=retry_policy,
+                                on_preview=live_preview.update if live_preview is not None else None
+                            ),
+                            user_id=message.from_user.id,
+                            chat_id=message.chat.id,
+                            lane=LANE_PRIVATE if message.chat.type == "private" else LANE_GROUP,
+                            tenant=tenant.name
+                        )
+                        status = None
+                        if ticket.queued:
+                            status = f"🥕 Queued at position {ticket.position}, about {int(ticket.estimated_wait)}s"
+                        try:
+                            if live_preview is not None:
+                                # 入队成功后再发占位图，生成过程中编辑为中间步骤，排队时显示排队位置
+                                await live_preview.start(caption=status or "🥕 Drawing...")
+                            elif status:
+                                await bot.reply_to(message, status)
+                            _result = await ticket
+                        except BaseException:
+                            if live_preview is not None:
+                                await asyncio.shield(live_preview.discard())
+                            raise
+                        if cache_key:
+                            await result_cache.set(cache_key, _result)
+                        return _result
+
+                    if seeded:
+                        # 进行中的相同请求只生成一次，结果回复给每条消息
+                        result, leader = await single_flight.do(fingerprint, generate)
+                        shared = not leader
+                    else:
+                        # 随机种子的相同提示词各自生成
+                        result = await generate()
+            except QueueFullError as e:
+                logger.warning(e)
+                DRAW_OUTCOME.labels(outcome="queue_full").inc()
+                return await bot.reply_to(message, "🥕 Too many drawing requests, please try again later")
             except CheckError as e:
                 logger.exception(e)
+                DRAW_OUTCOME.labels(outcome="check_error").inc()
                 return await bot.reply_to(message, str(e))
             except ValidationError as e:
                 logger.exception(e)
+                DRAW_OUTCOME.labels(outcome="validation").inc()
                 return await bot.reply_to(message, f"🥕 Invalid parameters...")
             except ServerError as e:
                 logger.exception(e)
+                DRAW_OUTCOME.labels(outcome="timeout" if isinstance(e, RequestTimeout) else "server_error").inc()
                 return await bot.reply_to(message, e.msg)
             except Exception as e:
                 logger.exception(e)
+                DRAW_OUTCOME.labels(outcome="error").inc()
                 return await bot.reply_to(message, f"🥕 Error happened...")
             if result.files:
+                DRAW_OUTCOME.labels(outcome="cached" if cached else "coalesced" if shared else "ok").inc()
                 for file in result.files:
-                    await bot.send_document(
-                        chat_id=message.chat.id,
-                        document=file,
-                        caption=None,
-                        reply_to_message_id=message.message_id,
-                        parse_mode="MarkdownV2"
-                    )
+                    if postprocessor.preview and live_preview is None:
+                        try:
+                            thumbnail = await postprocessor.make_preview(file[1])
+                        except PostProcessError as e:
+                            logger.warning(e)
+                        else:
+                            await bot.send_photo(
+                                chat_id=message.chat.id,
+                                photo=thumbnail,
+                                reply_to_message_id=message.message_id,
+                            )
+                    with stage("send"):
+                        swapped = await live_preview.finish(file) if live_preview is not None else None
+                        if swapped is None:
+                            await send_document(message, file)
+                        elif file_ids is not None and getattr(swapped, "document", None) is not None:
+                            await file_ids.set(file_ids.digest(file[1]), swapped.document.file_id)
                     """
                         formatting.format_text(
                             formatting.mbold("🥕 Sampler"),
@@ -168,23 +599,95 @@ class BotRunner(object):
                             separator="\n"
                         ),
                     """
-                    if AwsSetting.available:
-                        await upload_to_aws(
-                            file_bytes=BytesIO(file[1]),
+                    if archiver is not None and not cached and not shared:
+                        archiver.submit(
+                            file_bytes=file[1],
                             message_date=message.date,
-                            params=infer.parameters
+                            params=result.meta
                         )
+                await remember(message, infer)
                 return None
             else:
+                DRAW_OUTCOME.labels(outcome="empty").inc()
+                if live_preview is not None:
+                    await live_preview.discard()
                 return await bot.reply_to(
                     message,
                     "🥕 No result"
                 )
 
-        async def main():
-            await asyncio.gather(
-                bot.polling(non_stop=True, allowed_updates=util.update_types, skip_pending=True)
-            )
+        bot.register_message_handler(
+            enqueue_draw_command if self.role == "ingest" else listen_draw_command,
+            commands='draw',
+            content_types=["text"],
+            chat_types=['group', 'supergroup', 'private']
+        )
+
+    async def handle_job(self, payload: dict):
+        """
+        工作进程处理接收进程写入的更新，复用同一套处理器，按记录的 Bot 分发
+        """
+        await self.tenant(payload.get("bot")).bot.process_new_updates([types.Update.de_json(payload)])
+
+    async def handle_dead_job(self, payload: dict):
+        message = payload.get("message") or {}
+        await self.tenant(payload.get("bot")).bot.send_message(
+            chat_id=message["chat"]["id"],
+            text="🥕 Error happened...",
+            reply_to_message_id=message.get("message_id"),
+        )
 
+    async def serve(self):
+        """
+        启动共享组件并开始接收更新，退出时依次关闭
+        """
+        await asyncio.gather(*[tenant.resolve_identity() for tenant in self.tenants])
+        await self.session.start()
+        if PromptCheckSetting.enable and self.role != "ingest":
+            # 词表在第一条请求前加载
+            get_tokenizer(PromptCheckSetting.vocab_path)
+        # 接收进程不生成也不归档
+        if self.archiver is not None and self.role != "ingest":
+            self.archiver.start()
+        if self.metrics is not None:
+            await self.metrics.start()
+        if self.recorder is not None:
+            self.recorder.start()
+        try:
+            if self.role == "worker":
+                await JobWorker(
+                    self.jobs,
+                    self.handle_job,
+                    concurrency=WorkerSetting.concurrency,
+                    on_dead=self.handle_dead_job,
+                    retention=WorkerSetting.retention,
+                ).serve_forever()
+            elif self.webhook is not None:
+                await self.webhook.serve_forever()
+            else:
+                await asyncio.gather(*[
+                    tenant.bot.polling(non_stop=True, allowed_updates=util.update_types, skip_pending=True)
+                    for tenant in self.tenants
+                ])
+        finally:
+            await self.scheduler.close()
+            if self.archiver is not None:
+                await self.archiver.close()
+            self.postprocessor.close()
+            if self.param_memory is not None:
+                await self.param_memory.close()
+            if self.metrics is not None:
+                await self.metrics.close()
+            if self.recorder is not None:
+                await self.recorder.close()
+            await self.session.close()
+            if self.jobs is not None:
+                await self.jobs.close()
+            for tenant in self.tenants:
+                await tenant.close()
+
+    def run(self):
+        logger.info("Bot Start")
+        self.setup()
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(main())
+        loop.run_until_complete(self.serve())
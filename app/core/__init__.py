@@ -3,28 +3,72 @@
 # @Author  : sudoskys
 # @File    : __init__.py.py
 # @Software: PyCharm
+import base64
 import os
-from io import BytesIO
-from typing import Optional
-from zipfile import ZipFile
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 import httpx
 import shortuuid
-from PIL import Image
 from dotenv import load_dotenv
 from loguru import logger
 from pydantic import BaseModel, ConfigDict, model_validator, PrivateAttr
 
-from .error import ServerError
+from app.metrics import stage, IN_FLIGHT
+from .client import NovelAiSession, PoolStats
+from .error import ServerError, RequestTimeout, UpstreamError
+from .image import unpack_png, check_png_header, verify_png
+from .request import PreparedRequest, headers_for, loads
+from .resilience import RetryPolicy
 from .schema import NaiResult
+from .tokens import TokenPool, TokenLease
 
 load_dotenv()
 
+# 流式预览回调，参数为 (步数, JPEG 预览)
+PreviewCallback = Callable[[int, bytes], Awaitable[Any]]
+
+VALID_SAMPLER = ("k_euler", "k_euler_ancestral", "k_dpmpp_2m", "k_dpmpp_sde", "ddim_v3")
+VALID_WH = ((832, 1216), (1216, 832), (1024, 1024))
+# 种子为 uint32，0 表示随机
+MAX_SEED = 2 ** 32 - 1
+
 
 class CheckError(Exception):
     pass
 
 
+def check_parameters(width, height, steps, n_samples, sampler, seed=None) -> str:
+    """
+    参数检查，NovelAiInference 与 DrawRequest 共用
+    :return: 补全默认值后的采样方式
+    """
+    if steps != 28:
+        raise CheckError("steps must be 28.")
+    if (width, height) not in VALID_WH:
+        raise CheckError("Invalid size, must be one of 832x1216, 1216x832, 1024x1024")
+    if n_samples != 1:
+        raise CheckError("n_samples must be 1.")
+    if seed is not None and not 0 <= seed <= MAX_SEED:
+        raise CheckError(f"seed must be between 0 and {MAX_SEED}.")
+    if sampler is None:
+        sampler = "k_euler"
+    if sampler not in VALID_SAMPLER:
+        raise CheckError("Invalid sampler.")
+    return sampler
+
+
+def env_credentials():
+    """
+    :return: (access_token, endpoint)，令牌池模式下实际使用的账号在请求时再分配
+    """
+    access_token = os.environ.get("NOVEL_AI_TOKEN") or \
+                   os.environ.get("NOVEL_AI_TOKENS", "").split(",")[0].strip() or None
+    if access_token is None:
+        raise CheckError(".env `NOVEL_AI_TOKEN` is required.")
+    return access_token, os.environ.get("NOVEL_AI_ENDPOINT") or None
+
+
 class NovelAiInference(BaseModel):
     _endpoint: Optional[str] = PrivateAttr("https://api.novelai.net")
     _access_token: Optional[str] = PrivateAttr(None)
@@ -87,7 +131,7 @@ class NovelAiInference(BaseModel):
 
     @staticmethod
     def valid_sampler():
-        return ["k_euler", "k_euler_ancestral", "k_dpmpp_2m", "k_dpmpp_sde", "ddim_v3"]
+        return list(VALID_SAMPLER)
 
     @staticmethod
     def valid_wh():
@@ -95,37 +139,44 @@ class NovelAiInference(BaseModel):
         宽高
         :return:
         """
-        return [
-            (832, 1216),
-            (1216, 832),
-            (1024, 1024),
-        ]
+        return list(VALID_WH)
 
     @model_validator(mode="after")
     def validate_param(self):
-        if self.parameters.steps != 28:
-            raise CheckError("steps must be 28.")
-        if (self.parameters.width, self.parameters.height) not in self.valid_wh():
-            raise CheckError("Invalid size, must be one of 832x1216, 1216x832, 1024x1024")
-        if self.parameters.n_samples != 1:
-            raise CheckError("n_samples must be 1.")
-        if self.parameters.sampler is None:
-            self.parameters.sampler = "k_euler"
-        if self.parameters.sampler not in self.valid_sampler():
-            raise CheckError("Invalid sampler.")
-        if self.access_token is None and os.environ.get("NOVEL_AI_TOKEN"):
-            self.access_token = os.environ.get("NOVEL_AI_TOKEN")
-        else:
-            raise CheckError(".env `NOVEL_AI_TOKEN` is required.")
+        params = self.parameters
+        params.sampler = check_parameters(
+            params.width, params.height, params.steps, params.n_samples, params.sampler, params.seed
+        )
+        if self.access_token is None:
+            self.access_token, _ = env_credentials()
         if os.environ.get("NOVEL_AI_ENDPOINT"):
             self.endpoint = os.environ.get("NOVEL_AI_ENDPOINT")
         return self
 
+    def to_request(self) -> "DrawRequest":
+        return DrawRequest(
+            self.input,
+            self.parameters.model_dump(),
+            model=self.model,
+            action=self.action,
+            access_token=self.access_token,
+            endpoint=self.endpoint,
+            request_timeout=self.request_timeout,
+        )
+
+    def fingerprint(self) -> str:
+        """
+        请求内容的规范化哈希，相同参数得到相同结果
+        :return: sha256 hex
+        """
+        return self.to_request().fingerprint()
+
     def rebuild(self) -> "NovelAiInference":
-        return NovelAiInference(**self.model_dump())
+        return self.model_copy(deep=True)
 
     def update_params(self, **kwargs) -> "NovelAiInference":
-        return NovelAiInference(**self.model_dump(), **kwargs)
+        # 已校验的字段原样传入，只校验新值
+        return self.model_validate({**self.__dict__, **kwargs})
 
     @classmethod
     def build(cls, *,
@@ -166,54 +217,284 @@ class NovelAiInference(BaseModel):
             parameters=cls.Params(**param)
         )
 
-    async def __call__(self) -> NaiResult:
-        request_data = self.model_dump()
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-            "Origin": "https://novelai.net",
-            "Referer": "https://novelai.net/"
-        }
-        try:
-            async with httpx.AsyncClient(timeout=self.request_timeout or 30.0) as client:
-                response = await client.post(
-                    self.base_url,
-                    json=request_data,
-                    headers=headers,
-                    timeout=self.request_timeout or 30.0,
+    async def __call__(self,
+                       session: Optional[NovelAiSession] = None,
+                       *,
+                       validate_image: bool = False,
+                       policy: Optional[RetryPolicy] = None
+                       ) -> NaiResult:
+        """
+        发起推理，见 DrawRequest.__call__
+        """
+        return await self.to_request()(session, validate_image=validate_image, policy=policy)
+
+
+_PARAMS_TEMPLATE: Dict[str, Any] = NovelAiInference.Params().model_dump()
+
+
+class DrawRequest(object):
+    """
+    /draw 热路径使用的轻量请求，不经过 pydantic
+    参数在默认模板上合并，检查规则与 NovelAiInference 相同；构建后视为不可变，变体使用 with_parameters
+    """
+    __slots__ = ("input", "parameters", "model", "action", "access_token", "endpoint", "request_timeout", "_prepared")
+
+    def __init__(self,
+                 input: str,
+                 parameters: Dict[str, Any],
+                 *,
+                 model: Optional[str] = "nai-diffusion-3",
+                 action: Optional[str] = "generate",
+                 access_token: Optional[str] = None,
+                 endpoint: Optional[str] = None,
+                 request_timeout: Optional[float] = None,
+                 ):
+        self.input = input
+        self.parameters = parameters
+        self.model = model
+        self.action = action
+        self.access_token = access_token
+        self.endpoint = endpoint or "https://api.novelai.net"
+        self.request_timeout = request_timeout
+        self._prepared: Optional[PreparedRequest] = None
+
+    @classmethod
+    def build(cls, *,
+              prompt: str,
+              negative_prompt: Optional[str] = None,
+              seed: Optional[int] = None,
+              steps: Optional[int] = None,
+              cfg_rescale: Optional[int] = None,
+              sampler: Optional[str] = "k_dpmpp_2m",
+              width: Optional[int] = 832,
+              height: Optional[int] = 1216,
+              ) -> "DrawRequest":
+        """
+        参数同 NovelAiInference.build
+        """
+        param = dict(_PARAMS_TEMPLATE)
+        for key, value in (
+                ("negative_prompt", negative_prompt),
+                ("seed", seed),
+                ("steps", steps),
+                ("cfg_rescale", cfg_rescale),
+                ("sampler", sampler),
+                ("width", width),
+                ("height", height),
+        ):
+            if value is not None:
+                param[key] = value
+        param["sampler"] = check_parameters(
+            param["width"], param["height"], param["steps"], param["n_samples"], param["sampler"], param["seed"]
+        )
+        access_token, endpoint = env_credentials()
+        return cls(prompt, param, access_token=access_token, endpoint=endpoint)
+
+    @property
+    def base_url(self):
+        return f"{self.endpoint.strip('/')}/ai/generate-image"
+
+    @property
+    def stream_url(self):
+        return f"{self.endpoint.strip('/')}/ai/generate-image-stream"
+
+    def model_dump(self) -> Dict[str, Any]:
+        return {"action": self.action, "input": self.input, "model": self.model, "parameters": self.parameters}
+
+    def prepare(self) -> PreparedRequest:
+        """
+        序列化一次，重试、对冲和指纹都复用
+        """
+        if self._prepared is None:
+            self._prepared = PreparedRequest(self.base_url, self.model_dump())
+        return self._prepared
+
+    def prepare_stream(self) -> PreparedRequest:
+        """
+        流式接口的请求，只在开启预览时使用
+        """
+        data = self.model_dump()
+        data["parameters"] = {**self.parameters, "stream": "sse"}
+        return PreparedRequest(self.stream_url, data)
+
+    def fingerprint(self) -> str:
+        """
+        与 NovelAiInference.fingerprint 一致
+        :return: sha256 hex
+        """
+        return self.prepare().fingerprint
+
+    def with_parameters(self, **kwargs) -> "DrawRequest":
+        """
+        替换部分参数得到新请求，例如不同种子的变体
+        """
+        return DrawRequest(
+            self.input,
+            {**self.parameters, **kwargs},
+            model=self.model,
+            action=self.action,
+            access_token=self.access_token,
+            endpoint=self.endpoint,
+            request_timeout=self.request_timeout,
+        )
+
+    def overrides(self, keys) -> Dict[str, Any]:
+        """
+        与默认模板不同的参数
+        """
+        return {key: self.parameters[key] for key in keys if self.parameters.get(key) != _PARAMS_TEMPLATE.get(key)}
+
+    def to_params(self) -> NovelAiInference.Params:
+        """
+        归档等需要 pydantic 模型的地方使用
+        """
+        return NovelAiInference.Params(**self.parameters)
+
+    async def __call__(self,
+                       session: Optional[NovelAiSession] = None,
+                       *,
+                       validate_image: bool = False,
+                       policy: Optional[RetryPolicy] = None,
+                       on_preview: Optional[PreviewCallback] = None
+                       ) -> NaiResult:
+        """
+        发起推理
+        :param session: 共享连接池，为空时使用一次性连接；配置了令牌池时从池中分配账号
+        :param validate_image: 使用 PIL 完整校验返回的图片，默认只检查 PNG 头
+        :param policy: 重试与截止时间策略，为空时只请求一次
+        :param on_preview: 不为空时使用流式接口，每个中间步骤回调一次
+        :return: NaiResult
+        """
+        attempt = partial(self._attempt, session, validate_image=validate_image, on_preview=on_preview)
+        if policy is None:
+            return await attempt()
+        return await policy.run(attempt)
+
+    async def _attempt(self,
+                       session: Optional[NovelAiSession],
+                       timeout: Optional[float] = None,
+                       *,
+                       validate_image: bool = False,
+                       on_preview: Optional[PreviewCallback] = None
+                       ) -> NaiResult:
+        request = partial(self._request, validate_image=validate_image, timeout=timeout, on_preview=on_preview)
+        if session is not None:
+            if session.tokens is not None:
+                async with session.tokens.lease() as lease:
+                    return await request(session.client, lease=lease)
+            return await request(session.client)
+        async with httpx.AsyncClient(timeout=timeout or self.request_timeout or 30.0) as client:
+            return await request(client)
+
+    @staticmethod
+    def _raise_for_response(response: httpx.Response, content_type: str, retry_after: Optional[float]):
+        if response.headers.get('Content-Type', '').split(";")[0] != content_type:
+            logger.error(f"response: {response.text}")
+            try:
+                message = response.json()["message"]
+            except Exception:
+                raise UpstreamError(
+                    msg=f"Unexpected content type: {response.headers.get('Content-Type')}",
+                    status=response.status_code,
+                    retry_after=retry_after
                 )
-                logger.info(f"request_data: {request_data}")
-                if response.headers.get('Content-Type') != 'application/x-zip-compressed':
-                    logger.error(f"response: {response.text}")
-                    try:
-                        message = response.json()["message"]
-                    except Exception:
-                        raise ServerError(msg=f"Unexpected content type: {response.headers.get('Content-Type')}")
-                    else:
-                        raise ServerError(msg=f"[Nai Server]{message}")
-                response.raise_for_status()
-                zip_file = ZipFile(BytesIO(response.content))
-                _return_contents = []
-                with zip_file as zf:
-                    file_list = zf.namelist()
-                    if not file_list:
-                        raise ServerError(msg=f"Returned zip file is empty.")
-                    with zf.open(file_list[0]) as file:
-                        img_file = Image.open(BytesIO(file.read()), "r", formats=["PNG"])
-                        # Create a BytesIO object to store the PNG image
-                        png_bytes = BytesIO()
-                        img_file.save(png_bytes, format="PNG")
-                        png_bytes.seek(0)
-                        _return_contents.append(
-                            (f"{str(shortuuid.uuid()[:5])}.png", png_bytes.getvalue())
-                        )
-                return NaiResult(
-                    meta=NaiResult.RequestParams(
-                        endpoint=self.base_url,
-                        raw_request=request_data,
-                    ),
-                    files=_return_contents
+            else:
+                raise UpstreamError(
+                    msg=f"[Nai Server]{message}",
+                    status=response.status_code,
+                    retry_after=retry_after
                 )
+        if response.is_error:
+            raise UpstreamError(msg=f"[Nai Server]{response.status_code}", status=response.status_code)
+
+    @staticmethod
+    def _track_response(response: httpx.Response, lease: Optional[TokenLease]) -> Optional[float]:
+        retry_after = response.headers.get("Retry-After")
+        retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+        if lease is not None:
+            lease.status = response.status_code
+            lease.retry_after = retry_after
+        return retry_after
+
+    async def _read_stream(self, response: httpx.Response, on_preview: PreviewCallback) -> bytes:
+        """
+        读取 SSE 事件，中间步骤交给回调，返回最终 PNG
+        """
+        png_bytes = None
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            event = loads(line[5:])
+            event_type = event.get("event_type")
+            if event_type == "intermediate":
+                try:
+                    await on_preview(event.get("step_ix", 0), base64.b64decode(event["image"]))
+                except Exception as e:
+                    # 预览失败不影响生成
+                    logger.warning(f"🍺 Preview callback error {e}")
+            elif event_type == "final":
+                png_bytes = base64.b64decode(event["image"])
+            elif event_type == "error":
+                raise UpstreamError(msg=f"[Nai Server]{event.get('message')}", status=event.get("status", 500))
+        if png_bytes is None:
+            raise UpstreamError(msg="🥕 NovelAI stream ended without an image", status=None)
+        return png_bytes
+
+    async def _request(self,
+                       client: httpx.AsyncClient,
+                       validate_image: bool = False,
+                       lease: Optional[TokenLease] = None,
+                       timeout: Optional[float] = None,
+                       on_preview: Optional[PreviewCallback] = None
+                       ) -> NaiResult:
+        prepared = self.prepare()
+        headers = headers_for(lease.token if lease is not None else self.access_token)
+        timeout = timeout or self.request_timeout or 30.0
+        try:
+            if on_preview is None:
+                with stage("upstream"), IN_FLIGHT.labels(kind="upstream").track_inprogress():
+                    response = await client.post(
+                        prepared.url,
+                        content=prepared.body,
+                        headers=headers,
+                        timeout=timeout,
+                    )
+                retry_after = self._track_response(response, lease)
+                logger.opt(lazy=True).debug("request_data: {}", prepared.summary)
+                self._raise_for_response(response, "application/x-zip-compressed", retry_after)
+                with stage("decode"):
+                    _, png_bytes = unpack_png(response.content, validate=validate_image)
+                endpoint = prepared.url
+            else:
+                stream = self.prepare_stream()
+                with stage("upstream"), IN_FLIGHT.labels(kind="upstream").track_inprogress():
+                    async with client.stream(
+                            "POST", stream.url, content=stream.body, headers=headers, timeout=timeout
+                    ) as response:
+                        retry_after = self._track_response(response, lease)
+                        logger.opt(lazy=True).debug("request_data: {}", stream.summary)
+                        if response.is_error or not response.headers.get("Content-Type", "").startswith(
+                                "text/event-stream"):
+                            await response.aread()
+                            self._raise_for_response(response, "text/event-stream", retry_after)
+                        png_bytes = await self._read_stream(response, on_preview)
+                with stage("decode"):
+                    check_png_header(png_bytes)
+                    if validate_image:
+                        verify_png(png_bytes)
+                endpoint = stream.url
+            _return_contents = [(f"{str(shortuuid.uuid()[:5])}.png", png_bytes)]
+            return NaiResult(
+                meta=NaiResult.RequestParams(
+                    endpoint=endpoint,
+                    raw_request=prepared.data,
+                ),
+                files=_return_contents
+            )
+        except httpx.TimeoutException:
+            raise RequestTimeout(msg="🥕 NovelAI timeout, please try again later")
+        except httpx.TransportError:
+            raise UpstreamError(msg="🥕 NovelAI connection error, please try again later", status=None)
         except httpx.HTTPError as exc:
             raise RuntimeError(f"An HTTP error occurred: {exc}")
         except ServerError as e:
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/25 下午3:12
+# @Author  : sudoskys
+# @File    : client.py
+# @Software: PyCharm
+from typing import Optional
+
+import httpx
+from loguru import logger
+from pydantic import BaseModel
+
+from .tokens import TokenPool
+
+
+class PoolStats(BaseModel):
+    in_use: int = 0
+    idle: int = 0
+    waiting: int = 0
+    max_connections: Optional[int] = None
+
+
+class NovelAiSession(object):
+    """
+    共享的上游连接池，Bot 启动时创建，所有推理复用，退出时关闭
+    """
+
+    def __init__(self,
+                 *,
+                 max_connections: Optional[int] = 20,
+                 max_keepalive_connections: Optional[int] = 10,
+                 keepalive_expiry: Optional[float] = 30.0,
+                 http2: bool = False,
+                 proxy: Optional[str] = None,
+                 timeout: float = 30.0,
+                 tokens: Optional[TokenPool] = None,
+                 ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.proxy = proxy
+        self.timeout = timeout
+        self.tokens = tokens
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def started(self) -> bool:
+        return self._client is not None and not self._client.is_closed
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if not self.started:
+            self._client = self._create_client()
+        return self._client
+
+    def _create_client(self) -> httpx.AsyncClient:
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa
+            except ImportError:
+                logger.warning("🍺 HTTP/2 requires `httpx[http2]`, fallback to HTTP/1.1")
+                http2 = False
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        return httpx.AsyncClient(
+            limits=limits,
+            http2=http2,
+            proxies=self.proxy,
+            timeout=self.timeout,
+        )
+
+    async def start(self) -> "NovelAiSession":
+        if not self.started:
+            self._client = self._create_client()
+            logger.info(
+                f"🍺 NovelAi session started --max_connections {self.max_connections} --http2 {self.http2}"
+            )
+        if self.tokens is not None:
+            self.tokens.start(self)
+        return self
+
+    async def close(self):
+        if self.tokens is not None:
+            await self.tokens.close()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("🍺 NovelAi session closed")
+
+    async def __aenter__(self) -> "NovelAiSession":
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def _transports(self) -> list:
+        """
+        默认传输和代理挂载的传输，设置代理时请求走 _mounts 中的连接池
+        """
+        transports = [getattr(self._client, "_transport", None)]
+        mounts = getattr(self._client, "_mounts", None) or {}
+        transports.extend(mounts.values())
+        return [transport for transport in transports if transport is not None]
+
+    def stats(self) -> PoolStats:
+        """
+        读取连接池状态，依赖 httpcore 的连接池实现，内部结构变化时对应字段保持为 0
+        :return: PoolStats
+        """
+        _stats = PoolStats(max_connections=self.max_connections)
+        if not self.started:
+            return _stats
+        for transport in self._transports():
+            pool = getattr(transport, "_pool", None)
+            if pool is None:
+                continue
+            for connection in getattr(pool, "connections", None) or []:
+                is_closed = getattr(connection, "is_closed", None)
+                is_idle = getattr(connection, "is_idle", None)
+                if is_closed is None or is_idle is None or is_closed():
+                    continue
+                if is_idle():
+                    _stats.idle += 1
+                else:
+                    _stats.in_use += 1
+            for request in getattr(pool, "_requests", None) or []:
+                is_queued = getattr(request, "is_queued", None)
+                if is_queued is not None and is_queued():
+                    _stats.waiting += 1
+        return _stats
+        pool = getattr(self._client._transport, "_pool", None)
+        if pool is None:
+            return _stats
+        for connection in getattr(pool, "connections", []):
+            if connection.is_closed():
+                continue
+            if connection.is_idle():
+                _stats.idle += 1
+            else:
+                _stats.in_use += 1
+        for request in getattr(pool, "_requests", []):
+            is_queued = getattr(request, "is_queued", None)
+            if is_queued is not None and is_queued():
+                _stats.waiting += 1
+        return _stats
@@ -13,9 +13,28 @@ class ServerError(Exception):
         return f"ServerError: {self.msg}"
 
 
+class RequestTimeout(ServerError):
+    def __str__(self):
+        return f"RequestTimeout: {self.msg}"
+
+
 class ValidationError(Exception):
     def __init__(self, msg: str = None):
         self.msg = msg
 
     def __str__(self):
         return f"ValidationError: {self.msg}"
+
+
+class UpstreamError(ServerError):
+    """
+    上游返回的错误，带状态码，用于判断是否可重试
+    """
+
+    def __init__(self, msg: str = None, status: int = None, retry_after: float = None):
+        super().__init__(msg=msg)
+        self.status = status
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return f"UpstreamError {self.status}: {self.msg}"
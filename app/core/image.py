@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/25 下午5:40
+# @Author  : sudoskys
+# @File    : image.py
+# @Software: PyCharm
+import struct
+from functools import lru_cache
+from io import BytesIO
+from typing import Tuple
+from zipfile import ZipFile
+
+from .error import ServerError
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def check_png_header(data: bytes) -> Tuple[int, int]:
+    """
+    只检查 PNG 签名和 IHDR 块，不解码像素
+    :param data: PNG 数据
+    :return: (width, height)
+    """
+    if len(data) < 24 or data[:8] != PNG_SIGNATURE or data[12:16] != b"IHDR":
+        raise ServerError(msg="Returned file is not a valid PNG.")
+    width, height = struct.unpack(">II", data[16:24])
+    return width, height
+
+
+def verify_png(data: bytes) -> Tuple[int, int]:
+    """
+    使用 PIL 完整校验 PNG，代价较高，按需开启
+    :param data: PNG 数据
+    :return: (width, height)
+    """
+    from PIL import Image
+    try:
+        with Image.open(BytesIO(data), "r", formats=["PNG"]) as img_file:
+            img_file.verify()
+            return img_file.size
+    except Exception as e:
+        raise ServerError(msg=f"Returned file is not a valid PNG: {e}")
+
+
+def unpack_png(content: bytes, validate: bool = False) -> Tuple[str, bytes]:
+    """
+    从返回的压缩包中直接取出 PNG，不做解码和重新编码
+    :param content: 压缩包数据
+    :param validate: 是否使用 PIL 完整校验
+    :return: (文件名, PNG 数据)
+    """
+    with ZipFile(BytesIO(content)) as zf:
+        file_list = zf.namelist()
+        if not file_list:
+            raise ServerError(msg=f"Returned zip file is empty.")
+        data = zf.read(file_list[0])
+    check_png_header(data)
+    if validate:
+        verify_png(data)
+    return file_list[0], data
+
+
+# PNG 中可丢弃的文本和元数据块，NovelAI 会在这里写入生成参数
+_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"tIME"}
+
+
+def strip_png_metadata(data: bytes) -> bytes:
+    """
+    按块过滤 PNG 元数据，不解码像素
+    :param data: PNG 数据
+    :return: 去除元数据后的 PNG 数据
+    """
+    check_png_header(data)
+    view = memoryview(data)
+    chunks = [view[:8]]
+    offset = 8
+    while offset + 8 <= len(data):
+        length, = struct.unpack(">I", view[offset:offset + 4])
+        chunk_type = bytes(view[offset + 4:offset + 8])
+        end = offset + 12 + length
+        if chunk_type not in _METADATA_CHUNKS:
+            chunks.append(view[offset:end])
+        offset = end
+        if chunk_type == b"IEND":
+            break
+    return b"".join(chunks)
+
+
+def make_preview(data: bytes, max_side: int = 1024, quality: int = 80) -> bytes:
+    """
+    生成 JPEG 预览图，运行在进程池中
+    :param data: PNG 数据
+    :param max_side: 最长边
+    :param quality: JPEG 质量
+    :return: JPEG 数据
+    """
+    from PIL import Image
+    with Image.open(BytesIO(data), formats=["PNG"]) as img_file:
+        img_file = img_file.convert("RGB")
+        img_file.thumbnail((max_side, max_side))
+        output = BytesIO()
+        img_file.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+
+@lru_cache(maxsize=8)
+def make_placeholder(width: int, height: int) -> bytes:
+    """
+    流式预览的占位图，按比例缩小的灰色 JPEG
+    :return: JPEG 数据
+    """
+    from PIL import Image
+    output = BytesIO()
+    Image.new("RGB", (max(1, width // 8), max(1, height // 8)), (200, 200, 200)).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def transcode_webp(data: bytes, quality: int = 90, lossless: bool = False, strip: bool = True) -> bytes:
+    """
+    转码为 WebP，运行在进程池中
+    :param data: PNG 数据
+    :param quality: WebP 质量
+    :param lossless: 是否无损
+    :param strip: 是否去除元数据，否则保留 EXIF
+    :return: WebP 数据
+    """
+    from PIL import Image
+    with Image.open(BytesIO(data), formats=["PNG"]) as img_file:
+        params = {"quality": quality, "lossless": lossless, "method": 4}
+        if not strip and img_file.getexif():
+            params["exif"] = img_file.getexif().tobytes()
+        output = BytesIO()
+        img_file.save(output, format="WEBP", **params)
+        return output.getvalue()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/13 下午8:05
+# @Author  : sudoskys
+# @File    : request.py
+# @Software: PyCharm
+"""
+推理请求的预序列化，一次构建后在重试和对冲之间复用
+"""
+import hashlib
+import json
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+BASE_HEADERS = {
+    "Content-Type": "application/json",
+    "Origin": "https://novelai.net",
+    "Referer": "https://novelai.net/",
+}
+
+LOG_TRUNCATE = 120
+
+
+def dumps(data: Any) -> bytes:
+    """
+    请求体编码，有 orjson 时使用 orjson
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def canonical(data: Any) -> bytes:
+    """
+    键排序的紧凑编码，两种实现输出一致，已有的指纹不受影响
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+@lru_cache(maxsize=64)
+def headers_for(access_token: str) -> Dict[str, str]:
+    """
+    每个账号的请求头只构建一次，调用方不要修改返回值
+    """
+    return {"Authorization": f"Bearer {access_token}", **BASE_HEADERS}
+
+
+def _truncate(value: Any, limit: int = LOG_TRUNCATE) -> Any:
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}...(+{len(value) - limit})"
+    return value
+
+
+class PreparedRequest(object):
+    """
+    url、请求数据和编码后的请求体
+    """
+    __slots__ = ("url", "data", "body", "_fingerprint")
+
+    def __init__(self, url: str, data: Dict[str, Any]):
+        self.url = url
+        self.data = data
+        self.body = dumps(data)
+        self._fingerprint: Optional[str] = None
+
+    @property
+    def fingerprint(self) -> str:
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha256(canonical(self.data)).hexdigest()
+        return self._fingerprint
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        日志用，长文本截断
+        """
+        parameters = self.data.get("parameters") or {}
+        return {
+            "model": self.data.get("model"),
+            "input": _truncate(self.data.get("input")),
+            "parameters": {key: _truncate(value) for key, value in parameters.items()},
+        }
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/11 上午10:26
+# @Author  : sudoskys
+# @File    : resilience.py
+# @Software: PyCharm
+"""
+上游调用的重试、整体截止时间和对冲请求
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, Set
+
+from loguru import logger
+
+from app.metrics import REGISTRY, Counter
+from .error import RequestTimeout, UpstreamError
+
+UPSTREAM_RETRY = REGISTRY.register(Counter(
+    "naidrawer_upstream_retry", "Retried upstream attempts by reason", ("reason",)
+))
+UPSTREAM_HEDGE = REGISTRY.register(Counter(
+    "naidrawer_upstream_hedge", "Hedged upstream attempts, fired and won", ("result",)
+))
+
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504, 520, 522, 524})
+
+
+def retry_reason(exc: BaseException) -> Optional[str]:
+    """
+    可重试时返回原因，否则返回 None
+    """
+    if isinstance(exc, RequestTimeout):
+        return "timeout"
+    if isinstance(exc, UpstreamError):
+        if exc.status is None:
+            return "transport"
+        if exc.status in RETRYABLE_STATUS:
+            return str(exc.status)
+    return None
+
+
+class LatencyWindow(object):
+    """
+    最近成功请求的耗时，用于计算对冲阈值
+    """
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def observe(self, value: float):
+        self._samples.append(value)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RetryPolicy(object):
+    def __init__(self,
+                 *,
+                 max_attempts: int = 3,
+                 backoff: float = 0.5,
+                 max_backoff: float = 8.0,
+                 deadline: float = 75.0,
+                 attempt_timeout: float = 30.0,
+                 hedge_percentile: Optional[float] = None,
+                 hedge_min_samples: int = 20,
+                 ):
+        """
+        :param max_attempts: 最多尝试次数，包含第一次
+        :param backoff: 退避基数，第 n 次重试等待 uniform(0, backoff * 2^n)
+        :param max_backoff: 单次退避上限
+        :param deadline: 一次 /draw 的总时间预算
+        :param attempt_timeout: 单次请求的超时，不超过剩余预算
+        :param hedge_percentile: 请求耗时超过该分位数时发起对冲请求，为空时关闭
+        :param hedge_min_samples: 样本不足时不对冲
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency = LatencyWindow()
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge_percentile or len(self.latency) < self.hedge_min_samples:
+            return None
+        return self.latency.percentile(self.hedge_percentile)
+
+    def delay(self, attempt: int, exc: BaseException) -> float:
+        retry_after = getattr(exc, "retry_after", None)
+        if retry_after:
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    async def run(self, attempt: Callable[[float], Awaitable]):
+        """
+        :param attempt: 接收本次超时秒数，返回一次上游请求
+        :raise RequestTimeout: 预算耗尽
+        """
+        deadline = time.monotonic() + self.deadline
+        for index in range(self.max_attempts):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                return await self._attempt(attempt, deadline)
+            except Exception as exc:
+                reason = retry_reason(exc)
+                if reason is None or index + 1 >= self.max_attempts:
+                    raise
+                delay = self.delay(index, exc)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                UPSTREAM_RETRY.labels(reason=reason).inc()
+                logger.warning(f"🍺 Upstream attempt {index + 1} failed, retry in {delay:.2f}s --reason {reason}")
+                await asyncio.sleep(delay)
+        raise RequestTimeout(msg="🥕 NovelAI timeout, please try again later")
+
+    async def _timed(self, attempt: Callable[[float], Awaitable], deadline: float):
+        start = time.monotonic()
+        result = await attempt(min(self.attempt_timeout, max(0.1, deadline - start)))
+        self.latency.observe(time.monotonic() - start)
+        return result
+
+    async def _attempt(self, attempt: Callable[[float], Awaitable], deadline: float):
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None:
+            return await self._timed(attempt, deadline)
+        primary = asyncio.ensure_future(self._timed(attempt, deadline))
+        tasks: Set[asyncio.Future] = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done and deadline - time.monotonic() > 0:
+                UPSTREAM_HEDGE.labels(result="fired").inc()
+                tasks.add(asyncio.ensure_future(self._timed(attempt, deadline)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            UPSTREAM_HEDGE.labels(result="won").inc()
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/10 下午2:05
+# @Author  : sudoskys
+# @File    : tokens.py
+# @Software: PyCharm
+"""
+多账号令牌池，按账号限制并发，选择负载最低的账号
+429/401/5xx 后熔断冷却，冷却结束后由探测或单个试探请求恢复
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+from app.metrics import REGISTRY, Gauge
+from .error import ServerError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+TOKEN_IN_FLIGHT = REGISTRY.register(Gauge(
+    "naidrawer_token_in_flight", "Upstream requests in flight per NovelAI account", ("token",)
+))
+TOKEN_OPEN = REGISTRY.register(Gauge(
+    "naidrawer_token_open", "Whether the NovelAI account circuit is open", ("token",)
+))
+
+
+class TokenStats(BaseModel):
+    name: str
+    state: str
+    in_flight: int
+    max_in_flight: int
+    failures: int
+    served: int
+    retry_in: float = 0.0
+
+
+class TokenState(object):
+    __slots__ = ("name", "token", "max_in_flight", "in_flight", "state", "failures", "open_until", "served")
+
+    def __init__(self, name: str, token: str, max_in_flight: int):
+        self.name = name
+        self.token = token
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.served = 0
+
+    def available(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return self.in_flight < self.max_in_flight
+        # 冷却结束后只放行一个试探请求
+        return self.state == OPEN and now >= self.open_until and self.in_flight == 0
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.max_in_flight
+
+
+class TokenLease(object):
+    """
+    一次上游请求占用的账号，请求方写回状态码用于健康判断
+    """
+    __slots__ = ("state", "status", "retry_after")
+
+    def __init__(self, state: TokenState):
+        self.state = state
+        self.status: Optional[int] = None
+        self.retry_after: Optional[float] = None
+
+    @property
+    def token(self) -> str:
+        return self.state.token
+
+
+class TokenPool(object):
+    def __init__(self,
+                 tokens: List[str],
+                 *,
+                 max_in_flight: int = 1,
+                 cooldown: float = 30.0,
+                 auth_cooldown: float = 600.0,
+                 failure_threshold: int = 3,
+                 probe_interval: Optional[float] = 60.0,
+                 endpoint: str = "https://api.novelai.net",
+                 ):
+        """
+        :param tokens: 账号令牌
+        :param max_in_flight: 单个账号的并发上限
+        :param cooldown: 429/5xx 熔断时长
+        :param auth_cooldown: 401/403 熔断时长
+        :param failure_threshold: 连续失败多少次后熔断
+        :param probe_interval: 熔断账号的探测间隔，为空时只依赖试探请求恢复
+        :param endpoint: 探测使用的 API 地址
+        """
+        tokens = [token.strip() for token in tokens if token and token.strip()]
+        if not tokens:
+            raise ValueError("TokenPool requires at least one token")
+        self.states = [
+            TokenState(f"{index}:{token[-4:]}", token, max_in_flight) for index, token in enumerate(tokens)
+        ]
+        self.cooldown = cooldown
+        self.auth_cooldown = auth_cooldown
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.endpoint = endpoint
+        self._cond: Optional[asyncio.Condition] = None
+        self._probe_task: Optional[asyncio.Task] = None
+        for state in self.states:
+            TOKEN_IN_FLIGHT.labels(token=state.name).set_function(lambda s=state: s.in_flight)
+            TOKEN_OPEN.labels(token=state.name).set_function(lambda s=state: int(s.state != CLOSED))
+
+    @property
+    def capacity(self) -> int:
+        return sum(state.max_in_flight for state in self.states)
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _pick(self, now: float) -> Optional[TokenState]:
+        candidates = [state for state in self.states if state.available(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda state: (state.load, state.served))
+
+    @asynccontextmanager
+    async def lease(self):
+        """
+        占用一个账号
+        async with pool.lease() as lease: ...
+        :raise ServerError: 所有账号都在冷却
+        """
+        async with self.cond:
+            while True:
+                now = time.monotonic()
+                state = self._pick(now)
+                if state is not None:
+                    break
+                if not any(item.state == CLOSED for item in self.states):
+                    retry_in = min(item.open_until for item in self.states) - now
+                    if retry_in > 0:
+                        raise ServerError(
+                            msg=f"🥕 All NovelAI accounts are cooling down, please try again in {int(retry_in) + 1}s"
+                        )
+                # 全部繁忙，等待释放
+                try:
+                    await asyncio.wait_for(self.cond.wait(), timeout=self.cooldown)
+                except asyncio.TimeoutError:
+                    pass
+            if state.state != CLOSED:
+                state.state = HALF_OPEN
+            state.in_flight += 1
+            state.served += 1
+        lease = TokenLease(state)
+        try:
+            yield lease
+        except asyncio.CancelledError:
+            await self._release(lease, cancelled=True)
+            raise
+        except BaseException:
+            await self._release(lease, failed=True)
+            raise
+        else:
+            await self._release(lease)
+
+    async def _release(self, lease: TokenLease, *, failed: bool = False, cancelled: bool = False):
+        state = lease.state
+        async with self.cond:
+            state.in_flight -= 1
+            status = lease.status
+            if cancelled:
+                if state.state == HALF_OPEN:
+                    state.state = OPEN
+            elif status == 429:
+                self._trip(state, lease.retry_after or self.cooldown, "rate limited")
+            elif status in (401, 403):
+                self._trip(state, self.auth_cooldown, f"unauthorized {status}")
+            elif (status is not None and status >= 500) or (status is None and failed):
+                state.failures += 1
+                if state.state == HALF_OPEN or state.failures >= self.failure_threshold:
+                    self._trip(state, self.cooldown, f"{state.failures} failures")
+            else:
+                self._recover(state)
+            self.cond.notify_all()
+
+    def _trip(self, state: TokenState, duration: float, reason: str):
+        state.state = OPEN
+        state.open_until = time.monotonic() + duration
+        logger.warning(f"🍺 NovelAI token {state.name} circuit open for {duration:.0f}s --reason {reason}")
+
+    def _recover(self, state: TokenState):
+        if state.state != CLOSED:
+            logger.info(f"🍺 NovelAI token {state.name} recovered")
+        state.state = CLOSED
+        state.failures = 0
+
+    async def probe(self, client):
+        """
+        用不消耗点数的订阅接口探测冷却结束的账号
+        """
+        now = time.monotonic()
+        for state in self.states:
+            if state.state != OPEN or now < state.open_until or state.in_flight:
+                continue
+            state.state = HALF_OPEN
+            state.in_flight += 1
+            try:
+                response = await client.get(
+                    f"{self.endpoint.strip('/')}/user/subscription",
+                    headers={"Authorization": f"Bearer {state.token}"},
+                    timeout=10,
+                )
+                status = response.status_code
+            except Exception as e:
+                logger.debug(f"🍺 NovelAI token {state.name} probe failed --error {e}")
+                status = None
+            async with self.cond:
+                state.in_flight -= 1
+                if status == 200:
+                    self._recover(state)
+                elif status in (401, 403):
+                    self._trip(state, self.auth_cooldown, f"probe unauthorized {status}")
+                else:
+                    self._trip(state, self.cooldown, f"probe status {status}")
+                self.cond.notify_all()
+
+    async def _probe_loop(self, session):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await self.probe(session.client)
+            except Exception as e:
+                logger.exception(f"🍺 NovelAI token probe error {e}")
+
+    def start(self, session):
+        if self.probe_interval and self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop(session))
+        logger.info(f"🍺 NovelAI token pool started --tokens {len(self.states)} --capacity {self.capacity}")
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+
+    def stats(self) -> List[TokenStats]:
+        now = time.monotonic()
+        return [
+            TokenStats(
+                name=state.name,
+                state=state.state,
+                in_flight=state.in_flight,
+                max_in_flight=state.max_in_flight,
+                failures=state.failures,
+                served=state.served,
+                retry_in=max(0.0, state.open_until - now) if state.state != CLOSED else 0.0,
+            )
+            for state in self.states
+        ]
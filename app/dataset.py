@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/15 下午5:30
+# @Author  : sudoskys
+# @File    : dataset.py
+# @Software: PyCharm
+"""
+数据集归档：图片和请求参数按 WebDataset 布局追加到本地滚动 tar 分片，封存后整片上传
+同一样本的 {key}.png / {key}.webp 与 {key}.json 相邻存放，每个分片附带一个紧凑索引
+- 写入中：name.tar.part / name.idx.part
+- 已封存：name.tar / name.idx，可以上传
+- 上传中：name.tar.uploading，上传成功后删除或移入 uploaded/
+"""
+import asyncio
+import io
+import os
+import socket
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import shortuuid
+from loguru import logger
+from pydantic import BaseModel
+
+from .metrics import stage
+
+BLOCK = tarfile.BLOCKSIZE
+INDEX_HEADER = "key\text\toffset\tsize\tmeta_offset\tmeta_size\n"
+
+
+class ShardStats(BaseModel):
+    queued: int = 0
+    written: int = 0
+    dropped: int = 0
+    sealed: int = 0
+    uploaded: int = 0
+    failed: int = 0
+    recovered: int = 0
+    released: int = 0
+    bytes_written: int = 0
+
+
+class ShardWriter(object):
+    """
+    单线程使用的分片写入器
+    每个样本写完后刷新 tar 和索引，进程崩溃时可以按索引截断恢复
+    """
+
+    def __init__(self,
+                 directory: str,
+                 *,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 max_age: float = 3600.0,
+                 ):
+        """
+        :param directory: 分片目录，多个进程可以共用
+        :param max_bytes: 分片达到该大小后封存
+        :param max_age: 分片打开超过该时长后封存
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._seq = 0
+        self._base: Optional[str] = None
+        self._file = None
+        self._tar: Optional[tarfile.TarFile] = None
+        self._index = None
+        self._opened_at = 0.0
+        self._count = 0
+
+    @property
+    def size(self) -> int:
+        return self._file.tell() if self._file is not None else 0
+
+    def due(self) -> bool:
+        return self._tar is not None and time.time() - self._opened_at >= self.max_age
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._seq += 1
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.worker_id}-{self._seq:05d}"
+        self._base = os.path.join(self.directory, name)
+        self._file = open(f"{self._base}.tar.part", "wb")
+        self._tar = tarfile.open(fileobj=self._file, mode="w", format=tarfile.USTAR_FORMAT)
+        self._index = open(f"{self._base}.idx.part", "w", encoding="utf-8")
+        self._index.write(INDEX_HEADER)
+        self._opened_at = time.time()
+        self._count = 0
+
+    def _add(self, name: str, data: bytes, mtime: float) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+        # 写入时 offset_data 不会更新，从流位置倒推数据起点
+        return self._tar.offset - -(-len(data) // BLOCK) * BLOCK
+
+    def write(self, key: str, ext: str, body: bytes, meta: bytes) -> Optional[str]:
+        """
+        :param key: 样本名，不含点号
+        :param ext: 图片后缀，例如 .png
+        :return: 因大小封存时返回分片路径
+        """
+        if self._tar is None:
+            self._open()
+        now = time.time()
+        offset = self._add(f"{key}{ext}", body, now)
+        meta_offset = self._add(f"{key}.json", meta, now)
+        self._file.flush()
+        # 索引在数据之后写入，恢复时以索引为准
+        self._index.write(f"{key}\t{ext}\t{offset}\t{len(body)}\t{meta_offset}\t{len(meta)}\n")
+        self._index.flush()
+        self._count += 1
+        if self.size >= self.max_bytes:
+            return self.seal()
+        return None
+
+    def seal(self) -> Optional[str]:
+        """
+        写入结束块并改名，改名后的分片可以上传
+        :return: 分片路径，没有打开的分片时返回 None
+        """
+        if self._tar is None:
+            return None
+        self._tar.close()
+        self._file.close()
+        self._index.close()
+        base, self._base = self._base, None
+        self._tar = self._file = self._index = None
+        os.replace(f"{base}.idx.part", f"{base}.idx")
+        os.replace(f"{base}.tar.part", f"{base}.tar")
+        logger.info(f"🍺 Dataset shard sealed --shard {base}.tar --samples {self._count}")
+        return f"{base}.tar"
+
+    @staticmethod
+    def recover(directory: str, stale: float) -> List[str]:
+        """
+        封存崩溃进程留下的分片：按索引截断到最后一个完整样本并补上结束块
+        :param stale: 超过该时长未修改的 .part 视为无人写入
+        :return: 恢复的分片路径
+        """
+        recovered = []
+        if not os.path.isdir(directory):
+            return recovered
+        now = time.time()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".tar.part"):
+                continue
+            base = os.path.join(directory, name[:-len(".tar.part")])
+            tar_path = f"{base}.tar.part"
+            index_path = f"{base}.idx.part"
+            try:
+                if now - os.path.getmtime(tar_path) < stale:
+                    continue
+                end = 0
+                lines = []
+                if os.path.exists(index_path):
+                    with open(index_path, "r", encoding="utf-8") as f:
+                        for line in f.read().split("\n")[1:]:
+                            fields = line.split("\t")
+                            # 最后一行可能只写了一半
+                            if len(fields) != 6:
+                                continue
+                            meta_offset, meta_size = int(fields[4]), int(fields[5])
+                            end = max(end, meta_offset + -(-meta_size // BLOCK) * BLOCK)
+                            lines.append(line)
+                if not lines:
+                    os.remove(tar_path)
+                    if os.path.exists(index_path):
+                        os.remove(index_path)
+                    continue
+                with open(tar_path, "r+b") as f:
+                    f.truncate(end)
+                    f.seek(end)
+                    f.write(b"\0" * BLOCK * 2)
+                with open(index_path, "w", encoding="utf-8") as f:
+                    f.write(INDEX_HEADER + "\n".join(lines) + "\n")
+                os.replace(index_path, f"{base}.idx")
+                os.replace(tar_path, f"{base}.tar")
+            except (OSError, ValueError) as e:
+                logger.warning(f"🍺 Dataset shard recover error --shard {tar_path} --error {e}")
+                continue
+            logger.info(f"🍺 Dataset shard recovered --shard {base}.tar --samples {len(lines)}")
+            recovered.append(f"{base}.tar")
+        return recovered
+
+
+class _Sample(object):
+    __slots__ = ("key", "body", "meta")
+
+    def __init__(self, key: str, body: bytes, meta: bytes):
+        self.key = key
+        self.body = body
+        self.meta = meta
+
+
+class ShardArchiver(object):
+    """
+    与 S3Archiver 相同的提交接口
+    写入在单独线程中进行，上传只处理已封存的分片，失败的分片留在本地等待下次扫描
+    """
+
+    def __init__(self,
+                 *,
+                 bucket: str,
+                 aws_access_key_id: Optional[str] = None,
+                 aws_secret_access_key: Optional[str] = None,
+                 endpoint_url: Optional[str] = None,
+                 directory: str = "dataset",
+                 max_bytes: int = 256 * 1024 * 1024,
+                 max_age: float = 3600.0,
+                 key_prefix: str = "telegram",
+                 max_queue: int = 100,
+                 upload_interval: float = 30.0,
+                 keep_local: bool = False,
+                 upload_stale: float = 3600.0,
+                 client=None,
+                 transcode: Optional[Callable[[bytes], Awaitable[Tuple[bytes, str]]]] = None,
+                 ):
+        """
+        :param directory: 本地分片目录
+        :param max_bytes: 分片封存大小
+        :param max_age: 分片封存时长
+        :param key_prefix: 上传的键前缀
+        :param max_queue: 等待写入的样本数，超出时丢弃
+        :param upload_interval: 扫描已封存分片的间隔
+        :param keep_local: 上传后保留到 uploaded/ 而不是删除
+        :param upload_stale: .uploading 超过该秒数未完成视为上传进程已崩溃，交还重新上传
+        """
+        self.bucket = bucket
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.endpoint_url = endpoint_url
+        self.directory = directory
+        self.key_prefix = key_prefix.strip("/")
+        self.max_queue = max_queue
+        self.upload_interval = upload_interval
+        self.keep_local = keep_local
+        self.upload_stale = upload_stale
+        self.transcode = transcode
+        self.stats = ShardStats()
+        self.writer = ShardWriter(directory, max_bytes=max_bytes, max_age=max_age)
+        self._client = client
+        self._queue: Optional[asyncio.Queue] = None
+        self._sealed: Optional[asyncio.Event] = None
+        # 写入和上传各用一个线程，大分片上传不阻塞写入
+        self._write_executor: Optional[ThreadPoolExecutor] = None
+        self._upload_executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client(
+                's3',
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                endpoint_url=self.endpoint_url,
+            )
+        return self._client
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._sealed = asyncio.Event()
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dataset-write")
+        self._upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dataset-upload")
+        self._tasks = [
+            asyncio.create_task(self._write_loop()),
+            asyncio.create_task(self._seal_loop()),
+            asyncio.create_task(self._upload_loop()),
+        ]
+        logger.info(f"🍺 Dataset archiver started --directory {self.directory} --max_queue {self.max_queue}")
+
+    async def close(self, timeout: float = 10.0):
+        """
+        写完队列中的样本并封存当前分片，在超时内尽量上传
+        """
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("🍺 Dataset archiver close timeout, write remaining items untranscoded")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        loop = asyncio.get_running_loop()
+        while not self._queue.empty():
+            await loop.run_in_executor(self._write_executor, self._write, self._queue.get_nowait(), ".png")
+        if await loop.run_in_executor(self._write_executor, self.writer.seal):
+            self.stats.sealed += 1
+        try:
+            await asyncio.wait_for(self._upload_all(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("🍺 Dataset upload timeout, sealed shards stay on disk")
+        self._write_executor.shutdown(wait=True)
+        self._upload_executor.shutdown(wait=False)
+
+    def submit(self, file_bytes: bytes, message_date: int, params: BaseModel) -> bool:
+        """
+        提交归档，不等待写入
+        :return: 是否进入队列
+        """
+        self.start()
+        key = f"nai_tg_{shortuuid.uuid()}_{message_date}"
+        sample = _Sample(key, file_bytes, params.model_dump_json().encode("utf-8"))
+        try:
+            self._queue.put_nowait(sample)
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            logger.error(f"🍺 Dataset archive queue full, sample dropped --key {key}")
+            return False
+        self.stats.queued += 1
+        return True
+
+    def _write(self, sample: _Sample, ext: str) -> Optional[str]:
+        sealed = self.writer.write(sample.key, ext, sample.body, sample.meta)
+        self.stats.written += 1
+        self.stats.bytes_written += len(sample.body) + len(sample.meta)
+        return sealed
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sample = await self._queue.get()
+            try:
+                ext = ".png"
+                if self.transcode is not None:
+                    sample.body, ext = await self.transcode(sample.body)
+                with stage("archive"):
+                    sealed = await loop.run_in_executor(self._write_executor, self._write, sample, ext)
+                if sealed:
+                    self.stats.sealed += 1
+                    self._sealed.set()
+            except Exception as e:
+                self.stats.failed += 1
+                logger.exception(f"🍺 Dataset write error: {e} --key {sample.key}")
+            finally:
+                self.stats.queued -= 1
+                self._queue.task_done()
+
+    async def _seal_loop(self):
+        loop = asyncio.get_running_loop()
+        interval = max(1.0, min(60.0, self.writer.max_age / 4))
+        # 崩溃进程留下的分片在打开超过 max_age 且一段时间没有写入后接管
+        stale = self.writer.max_age + interval * 2
+        while True:
+            try:
+                recovered = await loop.run_in_executor(
+                    self._write_executor, ShardWriter.recover, self.directory, stale
+                )
+                self.stats.recovered += len(recovered)
+                if self.writer.due() and await loop.run_in_executor(self._write_executor, self.writer.seal):
+                    self.stats.sealed += 1
+                    recovered.append(True)
+                if recovered:
+                    self._sealed.set()
+            except Exception as e:
+                logger.exception(f"🍺 Dataset seal error: {e}")
+            await asyncio.sleep(interval)
+
+    def _release_stale(self):
+        """
+        上传中崩溃的分片停留在 .uploading，超过 upload_stale 后改回 .tar 重新上传
+        """
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".tar.uploading"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) < self.upload_stale:
+                    continue
+                os.rename(path, path[:-len(".uploading")])
+            except OSError:
+                continue
+            self.stats.released += 1
+            logger.warning(f"🍺 Dataset shard upload stalled, released for retry --shard {path}")
+
+    def _claim(self) -> List[str]:
+        """
+        改名为 .uploading 占有分片，多个进程共用目录时不会重复上传
+        """
+        claimed = []
+        if not os.path.isdir(self.directory):
+            return claimed
+        self._release_stale()
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".tar"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                os.rename(path, f"{path}.uploading")
+                # 改名不更新修改时间，记录占有时间供 _release_stale 判断
+                os.utime(f"{path}.uploading")
+            except OSError:
+                continue
+            claimed.append(path)
+        return claimed
+
+    def _upload(self, path: str):
+        base = path[:-len(".tar")]
+        name = os.path.basename(base)
+        self.client.upload_file(f"{path}.uploading", self.bucket, f"{self.key_prefix}/{name}.tar")
+        if os.path.exists(f"{base}.idx"):
+            self.client.upload_file(f"{base}.idx", self.bucket, f"{self.key_prefix}/{name}.idx")
+        if self.keep_local:
+            uploaded = os.path.join(self.directory, "uploaded")
+            os.makedirs(uploaded, exist_ok=True)
+            os.replace(f"{path}.uploading", os.path.join(uploaded, f"{name}.tar"))
+            if os.path.exists(f"{base}.idx"):
+                os.replace(f"{base}.idx", os.path.join(uploaded, f"{name}.idx"))
+        else:
+            os.remove(f"{path}.uploading")
+            if os.path.exists(f"{base}.idx"):
+                os.remove(f"{base}.idx")
+
+    async def _upload_all(self):
+        loop = asyncio.get_running_loop()
+        for path in await loop.run_in_executor(self._upload_executor, self._claim):
+            try:
+                with stage("archive_upload"):
+                    await loop.run_in_executor(self._upload_executor, self._upload, path)
+            except Exception as e:
+                self.stats.failed += 1
+                logger.error(f"🍺 Dataset shard upload error: {e} --shard {path}")
+                # 交还，下次扫描重试
+                try:
+                    os.replace(f"{path}.uploading", path)
+                except OSError:
+                    pass
+            else:
+                self.stats.uploaded += 1
+                logger.info(f"🍺 Dataset shard uploaded --shard {path}")
+
+    async def _upload_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._sealed.wait(), timeout=self.upload_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._sealed.clear()
+            try:
+                await self._upload_all()
+            except Exception as e:
+                logger.exception(f"🍺 Dataset upload loop error: {e}")
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/13 下午2:36
+# @Author  : sudoskys
+# @File    : jobqueue.py
+# @Software: PyCharm
+"""
+多进程模式下的本地持久任务队列
+接收进程写入，工作进程租用任务，完成后确认；租约过期未确认的任务会被重新租用
+"""
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    worker TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, status);
+"""
+
+
+class JobQueueStats(BaseModel):
+    queued: int = 0
+    leased: int = 0
+    done: int = 0
+    failed: int = 0
+
+
+class LeasedJob(object):
+    __slots__ = ("id", "payload", "attempts")
+
+    def __init__(self, id: int, payload: Dict[str, Any], attempts: int):
+        self.id = id
+        self.payload = payload
+        self.attempts = attempts
+
+
+class SqliteJobQueue(object):
+    """
+    SQLite WAL 任务队列，多个进程可以同时打开同一个文件
+    """
+
+    def __init__(self,
+                 path: str = "jobs.db",
+                 *,
+                 lease_seconds: float = 300.0,
+                 max_attempts: int = 3,
+                 ):
+        """
+        :param path: 数据库文件
+        :param lease_seconds: 租约时长，处理中的任务需要定期续约
+        :param max_attempts: 最多租用次数，超过后标记为失败
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # 自己控制事务，BEGIN IMMEDIATE 保证租用时只有一个进程写入
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def _put(self, payload: str, user_id: Optional[str]) -> int:
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO jobs (user_id, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, payload, QUEUED, now, now)
+        )
+        return cursor.lastrowid
+
+    def _lease(self, worker: str) -> Optional[LeasedJob]:
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs "
+                "WHERE (status = ? OR (status = ? AND lease_until < ?)) AND attempts < ? "
+                "ORDER BY id LIMIT 1",
+                (QUEUED, LEASED, now, self.max_attempts)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            job_id, payload, attempts = row
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, lease_until = ?, worker = ?, updated_at = ? WHERE id = ?",
+                (LEASED, attempts + 1, now + self.lease_seconds, worker, now, job_id)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return LeasedJob(job_id, json.loads(payload), attempts + 1)
+
+    def _extend(self, job_id: int, worker: str) -> bool:
+        now = time.time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = ? AND worker = ?",
+            (now + self.lease_seconds, now, job_id, LEASED, worker)
+        )
+        return cursor.rowcount == 1
+
+    def _finish(self, job_id: int, worker: str, status: str, error: Optional[str]) -> bool:
+        """
+        只有仍持有租约的进程可以确认或交还，租约过期后被其他进程租用时返回 False
+        """
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND status = ? AND worker = ?",
+            (status, error, time.time(), job_id, LEASED, worker)
+        )
+        return cursor.rowcount == 1
+
+    def _reap(self) -> List[Dict[str, Any]]:
+        """
+        租约过期且已用完次数的任务标记为失败
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, payload FROM jobs WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                (LEASED, now, self.max_attempts)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                [(FAILED, "lease expired", now, job_id) for job_id, _ in rows]
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return [json.loads(payload) for _, payload in rows]
+
+    def _count(self, user_id: Optional[str], statuses: tuple) -> int:
+        sql = f"SELECT COUNT(*) FROM jobs WHERE status IN ({','.join('?' * len(statuses))})"
+        args = statuses
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            args += (user_id,)
+        return self._connect().execute(sql, args).fetchone()[0]
+
+    def _stats(self) -> JobQueueStats:
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return JobQueueStats(**{status: count for status, count in rows})
+
+    def _purge(self, older_than: float) -> int:
+        cursor = self._connect().execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (DONE, FAILED, time.time() - older_than)
+        )
+        return cursor.rowcount
+
+    async def put(self, payload: Dict[str, Any], user_id: Optional[Any] = None) -> int:
+        return await self._run(
+            self._put, json.dumps(payload, ensure_ascii=False), str(user_id) if user_id is not None else None
+        )
+
+    async def lease(self) -> Optional[LeasedJob]:
+        return await self._run(self._lease, self.worker_id)
+
+    async def extend(self, job: LeasedJob) -> bool:
+        return await self._run(self._extend, job.id, self.worker_id)
+
+    async def ack(self, job: LeasedJob) -> bool:
+        """
+        :return: 租约已失效时为 False
+        """
+        return await self._run(self._finish, job.id, self.worker_id, DONE, None)
+
+    async def fail(self, job: LeasedJob, error: str, retry: bool = True) -> Optional[str]:
+        """
+        :param retry: 仍有次数时重新入队
+        :return: 任务的新状态 QUEUED / FAILED，租约已失效时为 None
+        """
+        status = QUEUED if retry and job.attempts < self.max_attempts else FAILED
+        if await self._run(self._finish, job.id, self.worker_id, status, error):
+            return status
+        return None
+
+    async def reap(self) -> List[Dict[str, Any]]:
+        return await self._run(self._reap)
+
+    async def queued(self) -> int:
+        """
+        等待租用的任务数
+        """
+        return await self._run(self._count, None, (QUEUED,))
+
+    async def pending(self, user_id: Any) -> int:
+        """
+        用户未完成的任务数，包含处理中的
+        """
+        return await self._run(self._count, str(user_id), (QUEUED, LEASED))
+
+    async def stats(self) -> JobQueueStats:
+        return await self._run(self._stats)
+
+    async def purge(self, older_than: float = 24 * 3600) -> int:
+        """
+        删除完成或失败超过 older_than 秒的任务
+        """
+        return await self._run(self._purge, older_than)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+class JobWorker(object):
+    """
+    工作进程：租用任务并交给 handler 处理，处理期间定期续约
+    handler 正常返回即确认，抛出异常则按次数重试，最终失败的任务交给 on_dead
+    """
+
+    def __init__(self,
+                 queue: SqliteJobQueue,
+                 handler,
+                 *,
+                 concurrency: int = 2,
+                 poll_interval: float = 0.5,
+                 on_dead=None,
+                 retention: Optional[float] = 24 * 3600,
+                 ):
+        """
+        :param on_dead: 任务最终失败时的回调，参数为任务内容
+        :param retention: 完成或失败的任务保留秒数，None 时不清理
+        """
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.on_dead = on_dead
+        self.retention = retention
+        self._tasks: List[asyncio.Task] = []
+
+    async def _heartbeat(self, job: LeasedJob):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not await self.queue.extend(job):
+                logger.warning(f"🍺 Job {job.id} lease lost")
+                return
+
+    async def _dead(self, payload: Dict[str, Any]):
+        if self.on_dead is None:
+            return
+        try:
+            await self.on_dead(payload)
+        except Exception as e:
+            logger.exception(f"🍺 Job dead callback error {e}")
+
+    async def _fail(self, job: LeasedJob, error: str):
+        status = await self.queue.fail(job, error)
+        if status is None:
+            logger.warning(f"🍺 Job {job.id} lease lost before fail")
+        elif status == FAILED:
+            logger.error(f"🍺 Job {job.id} dropped after {job.attempts} attempts --error {error}")
+            await self._dead(job.payload)
+
+    async def _process(self, job: LeasedJob):
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            await self.handler(job.payload)
+        except asyncio.CancelledError:
+            # 进程退出，交还任务
+            await asyncio.shield(self._fail(job, "worker stopped"))
+            raise
+        except Exception as e:
+            logger.exception(f"🍺 Job {job.id} failed --attempts {job.attempts} --error {e}")
+            await self._fail(job, str(e))
+        else:
+            if not await self.queue.ack(job):
+                logger.warning(f"🍺 Job {job.id} lease lost before ack")
+        finally:
+            heartbeat.cancel()
+
+    async def _loop(self):
+        while True:
+            try:
+                job = await self.queue.lease()
+            except sqlite3.OperationalError as e:
+                logger.warning(f"🍺 Job lease error {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self._process(job)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 2)
+            try:
+                for payload in await self.queue.reap():
+                    logger.error(f"🍺 Job dropped after {self.queue.max_attempts} attempts")
+                    await self._dead(payload)
+                if self.retention is not None:
+                    purged = await self.queue.purge(self.retention)
+                    if purged:
+                        logger.info(f"🍺 Job queue purged --rows {purged}")
+            except Exception as e:
+                logger.exception(f"🍺 Job reap error {e}")
+
+    async def serve_forever(self):
+        logger.info(f"🍺 Job worker started --worker {self.queue.worker_id} --concurrency {self.concurrency}")
+        self._tasks = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._reap_loop()))
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
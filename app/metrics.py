@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/7 下午8:14
+# @Author  : sudoskys
+# @File    : metrics.py
+# @Software: PyCharm
+"""
+Prometheus 文本格式指标，不依赖 prometheus_client，默认关闭 HTTP 导出
+"""
+import asyncio
+import bisect
+import functools
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._new_child()
+            self._children[values] = child
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if self.labelnames:
+            for values, child in sorted(self._children.items()):
+                lines.extend(child._render(self.name, self.labelnames, values))
+        else:
+            lines.extend(self._render(self.name, (), ()))
+        return lines
+
+    def _render(self, name, labelnames, values) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def _new_child(self):
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _render(self, name, labelnames, values):
+        return [f"{name}_total{_format_labels(labelnames, values)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def _new_child(self):
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        读取时再计算，例如队列长度
+        """
+        self._function = function
+
+    @contextmanager
+    def track_inprogress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def _render(self, name, labelnames, values):
+        value = self.value
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                value = float("nan")
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets[:-1])
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _render(self, name, labelnames, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            labels = _format_labels(labelnames, values, ("le", _format_value(bound)))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_value(self.sum)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {cumulative}")
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    "naidrawer_stage_seconds", "Latency of each /draw stage", ("stage",)
+))
+DRAW_OUTCOME = REGISTRY.register(Counter(
+    "naidrawer_draw", "Finished /draw requests by outcome", ("outcome",)
+))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "naidrawer_in_flight", "Work currently in progress", ("kind",)
+))
+LOOP_LAG = REGISTRY.register(Histogram(
+    "naidrawer_event_loop_lag_seconds", "Event loop scheduling lag",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+))
+
+
+def stage(name: str):
+    """
+    记录某个阶段的耗时
+    with stage("upstream"): ...
+    """
+    return STAGE_LATENCY.labels(stage=name).time()
+
+
+def track_in_flight(kind: str):
+    """
+    协程处理器的在途数量
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with IN_FLIGHT.labels(kind=kind).track_inprogress():
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class LoopLagProbe(object):
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class MetricsServer(object):
+    """
+    /metrics HTTP 导出
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9464, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.probe = LoopLagProbe()
+        self._runner = None
+
+    async def handle(self, request):
+        from aiohttp import web
+        return web.Response(
+            text=self.registry.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    async def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.probe.start()
+        logger.info(f"🍺 Metrics exporter listening on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        await self.probe.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/3 下午7:45
+# @Author  : sudoskys
+# @File    : parser.py
+# @Software: PyCharm
+"""
+/draw 参数快速解析
+只识别已知的选项，提示词中出现的 " -" 不会被误切分，解析失败或请求帮助时才交给 Alconna
+"""
+import re
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+from app.core import NovelAiInference
+
+# 选项名 -> (参数名, 类型)
+FLAGS: Dict[str, Tuple[str, type]] = {
+    "--negative_prompt": ("negative_prompt", str),
+    "-neg": ("negative_prompt", str),
+    "--seed": ("seed", int),
+    "-s": ("seed", int),
+    "--cfg_rescale": ("cfg_rescale", int),
+    "-cfg": ("cfg_rescale", int),
+    "--sampler": ("sampler", str),
+    "-sam": ("sampler", str),
+    "--width": ("width", int),
+    "-wi": ("width", int),
+    "--height": ("height", int),
+    "-he": ("height", int),
+    "--samples": ("samples", int),
+    "-n": ("samples", int),
+}
+HELP_FLAGS = {"--help", "-h"}
+# 形似选项但不认识的词，交给 Alconna 给出错误提示
+_FLAG_LIKE = re.compile(r"^--?[A-Za-z][\w-]*$")
+_SPACES = re.compile(r"\s+")
+
+
+class DrawArgs(object):
+    """
+    解析结果，接口与 Alconna 的 Arparma 保持一致，会被 LRU 共享，不要修改
+    """
+    __slots__ = ("matched", "error_info", "_args")
+
+    def __init__(self, args: Optional[Dict[str, Any]] = None, error_info: Optional[str] = None):
+        self._args = args or {}
+        self.matched = error_info is None
+        self.error_info = error_info
+
+    @property
+    def all_matched_args(self) -> Dict[str, Any]:
+        return dict(self._args)
+
+    def query(self, key: str, default: Any = None) -> Any:
+        return self._args.get(key, default)
+
+    def __repr__(self):
+        return f"DrawArgs(matched={self.matched}, args={self._args}, error_info={self.error_info!r})"
+
+
+def _unquote(text: str) -> str:
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in ("'", '"'):
+        return text[1:-1]
+    return text
+
+
+def tokenize(body: str) -> Optional[Dict[str, Any]]:
+    """
+    快速切分提示词和选项
+    :param body: 去掉 /draw 之后的内容
+    :return: 参数字典，无法处理时返回 None
+    """
+    tokens = body.split(" ")
+    prompt = []
+    args: Dict[str, Any] = {}
+    index = 0
+    # 提示词直到第一个已知选项为止
+    while index < len(tokens):
+        token = tokens[index]
+        if token in FLAGS or token in HELP_FLAGS:
+            break
+        if _FLAG_LIKE.match(token) and prompt:
+            return None
+        prompt.append(token)
+        index += 1
+    while index < len(tokens):
+        token = tokens[index]
+        if token not in FLAGS:
+            return None
+        name, kind = FLAGS[token]
+        index += 1
+        value = []
+        while index < len(tokens) and tokens[index] not in FLAGS:
+            if tokens[index] in HELP_FLAGS or _FLAG_LIKE.match(tokens[index]):
+                return None
+            value.append(tokens[index])
+            index += 1
+        if not value or (kind is not str and len(value) != 1):
+            return None
+        if kind is int:
+            try:
+                args[name] = int(value[0])
+            except ValueError:
+                return None
+        else:
+            args[name] = _unquote(" ".join(value))
+    prompt = _unquote(" ".join(prompt))
+    if not prompt:
+        return None
+    if "sampler" in args and args["sampler"] not in NovelAiInference.valid_sampler():
+        return None
+    args["input"] = prompt
+    return args
+
+
+def _alconna_parse(body: str) -> DrawArgs:
+    """
+    回退到 Alconna，用于帮助信息和错误提示
+    """
+    from app.command import DrawCommand
+    tokens = body.split(" ")
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token in FLAGS or token in HELP_FLAGS or (_FLAG_LIKE.match(token) and index > 0):
+            break
+        index += 1
+    prompt = " ".join(tokens[:index])
+    quote = "'" if "'" not in prompt else '"'
+    flag = " ".join(tokens[index:])
+    message_text = f"/draw {quote}{prompt}{quote} {flag}".strip()
+    parsed = DrawCommand.parse(message_text)
+    if parsed.matched:
+        return DrawArgs(args=dict(parsed.all_matched_args))
+    if parsed.error_info is not None and type(parsed.error_info).__name__ == "SpecialOptionTriggered":
+        return DrawArgs(error_info=DrawCommand.get_help())
+    return DrawArgs(error_info=f"🥕 {parsed.error_info}")
+
+
+@lru_cache(maxsize=1)
+def draw_help() -> str:
+    """
+    帮助文本，首次使用时才导入 Alconna
+    """
+    from app.command import DrawCommand
+    return DrawCommand.get_help()
+
+
+def normalize(body: str) -> str:
+    return _SPACES.sub(" ", body).strip()
+
+
+@lru_cache(maxsize=1024)
+def _parse(body: str) -> DrawArgs:
+    args = tokenize(body)
+    if args is not None:
+        return DrawArgs(args=args)
+    return _alconna_parse(body)
+
+
+def parse_draw(body: str) -> DrawArgs:
+    """
+    解析 /draw 参数
+    :param body: 去掉 /draw 之后的内容
+    :return: DrawArgs
+    """
+    return _parse(normalize(body))
+
+
+def legacy_parse(body: str):
+    """
+    旧的解析方式，仅用于基准对比
+    """
+    from app.command import DrawCommand
+    if body.find(" -") != -1:
+        # 将 - 之前的内容用括号包裹
+        flag = body[body.find(" -"):]
+        body = body[:body.find(" -")]
+        body = f"'{body}'{flag}"
+        message_text = f"/draw {body}"
+    else:
+        message_text = f"/draw '{body}'"
+    return DrawCommand.parse(message_text)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/2 下午3:31
+# @Author  : sudoskys
+# @File    : postprocess.py
+# @Software: PyCharm
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Optional, Tuple
+
+from loguru import logger
+
+from .core.image import make_preview, transcode_webp, strip_png_metadata
+
+
+class PostProcessError(Exception):
+    def __init__(self, msg: str = None):
+        self.msg = msg
+
+    def __str__(self):
+        return f"PostProcessError: {self.msg}"
+
+
+class PostProcessor(object):
+    """
+    图片后处理，编码工作在进程池中执行，不占用事件循环
+    """
+
+    def __init__(self,
+                 *,
+                 workers: int = 2,
+                 timeout: float = 20.0,
+                 max_pending: int = 16,
+                 preview: bool = False,
+                 preview_max_side: int = 1024,
+                 preview_quality: int = 80,
+                 archive_webp: bool = True,
+                 webp_quality: int = 90,
+                 strip_metadata: bool = False,
+                 ):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.preview = preview
+        self.preview_max_side = preview_max_side
+        self.preview_quality = preview_quality
+        self.archive_webp = archive_webp
+        self.webp_quality = webp_quality
+        self.strip_metadata = strip_metadata
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"🍺 PostProcessor started --workers {self.workers}")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def run(self, func: Callable[[], bytes]) -> bytes:
+        """
+        在进程池中执行编码任务
+        :param func: 可序列化的无参函数
+        :raise PostProcessError: 队列已满、超时或编码失败
+        """
+        if self.pending >= self.max_pending:
+            raise PostProcessError(msg="Post process queue is full")
+        self.start()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(func)
+        except Exception as e:
+            raise PostProcessError(msg=f"Post process failed: {e}")
+        # 超时后进程池中的任务仍在执行，等它真正结束再归还名额
+        self.pending += 1
+        future.add_done_callback(partial(self._release, loop))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise PostProcessError(msg=f"Post process timeout after {self.timeout}s")
+        except Exception as e:
+            raise PostProcessError(msg=f"Post process failed: {e}")
+
+    def _release(self, loop: asyncio.AbstractEventLoop, _future):
+        def _done():
+            self.pending -= 1
+
+        try:
+            loop.call_soon_threadsafe(_done)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    async def make_preview(self, data: bytes) -> bytes:
+        return await self.run(
+            partial(make_preview, data, max_side=self.preview_max_side, quality=self.preview_quality)
+        )
+
+    async def strip(self, data: bytes) -> bytes:
+        if not self.strip_metadata:
+            return data
+        return await self.run(partial(strip_png_metadata, data))
+
+    async def transcode(self, data: bytes) -> Tuple[bytes, str]:
+        """
+        归档转码，失败时保留原始 PNG
+        :return: (数据, 后缀)
+        """
+        try:
+            if self.archive_webp:
+                webp = await self.run(
+                    partial(transcode_webp, data, quality=self.webp_quality, strip=self.strip_metadata)
+                )
+                return webp, ".webp"
+            return await self.strip(data), ".png"
+        except PostProcessError as e:
+            logger.warning(f"🍺 Archive transcode skipped: {e}")
+            return data, ".png"
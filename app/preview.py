@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/14 下午4:15
+# @Author  : sudoskys
+# @File    : preview.py
+# @Software: PyCharm
+"""
+流式生成的实时预览：先发占位图，生成过程中编辑为中间步骤，完成后替换为最终文档
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from loguru import logger
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from .core.image import make_placeholder
+from .metrics import REGISTRY, Counter
+
+PREVIEW_EDITS = REGISTRY.register(Counter(
+    "naidrawer_preview_edits", "Preview message edits, sent or skipped by the throttle", ("result",)
+))
+
+
+class ChatThrottle(object):
+    """
+    同一会话的编辑频率限制，多条预览共享
+    """
+
+    def __init__(self, interval: float = 1.0, max_entries: int = 10000):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._last: "OrderedDict[Any, float]" = OrderedDict()
+
+    def acquire(self, chat_id: Any) -> bool:
+        """
+        :return: 距离上次编辑已超过间隔时占用本次机会
+        """
+        now = time.monotonic()
+        last = self._last.get(chat_id)
+        if last is not None and now - last < self.interval:
+            return False
+        self._last[chat_id] = now
+        self._last.move_to_end(chat_id)
+        while len(self._last) > self.max_entries:
+            self._last.popitem(last=False)
+        return True
+
+
+class LivePreview(object):
+    """
+    一次生成对应一条占位消息，预览帧来不及发送时直接丢弃
+    """
+
+    def __init__(self,
+                 bot: AsyncTeleBot,
+                 message: types.Message,
+                 throttle: ChatThrottle,
+                 *,
+                 size: Tuple[int, int] = (832, 1216),
+                 steps: int = 28,
+                 ):
+        self.bot = bot
+        self.message = message
+        self.throttle = throttle
+        self.size = size
+        self.steps = steps
+        self.placeholder: Optional[types.Message] = None
+        self._editing: Optional[asyncio.Task] = None
+
+    async def start(self, caption: str = "🥕 Drawing..."):
+        try:
+            self.placeholder = await self.bot.send_photo(
+                chat_id=self.message.chat.id,
+                photo=make_placeholder(*self.size),
+                caption=caption,
+                reply_to_message_id=self.message.message_id,
+            )
+        except Exception as e:
+            logger.warning(f"🍺 Preview placeholder failed --error {e}")
+
+    async def _edit(self, step: int, image: bytes):
+        try:
+            await self.bot.edit_message_media(
+                media=types.InputMediaPhoto(image, caption=f"🥕 Step {step + 1}/{self.steps}"),
+                chat_id=self.placeholder.chat.id,
+                message_id=self.placeholder.message_id,
+            )
+        except Exception as e:
+            logger.debug(f"🍺 Preview edit failed --error {e}")
+
+    async def update(self, step: int, image: bytes):
+        """
+        流式回调，不等待编辑完成
+        """
+        if self.placeholder is None:
+            return
+        if (self._editing is not None and not self._editing.done()) or not self.throttle.acquire(
+                self.placeholder.chat.id):
+            PREVIEW_EDITS.labels(result="skipped").inc()
+            return
+        PREVIEW_EDITS.labels(result="sent").inc()
+        self._editing = asyncio.create_task(self._edit(step, image))
+
+    async def _settle(self):
+        if self._editing is not None and not self._editing.done():
+            self._editing.cancel()
+            await asyncio.gather(self._editing, return_exceptions=True)
+
+    async def finish(self, file) -> Optional[types.Message]:
+        """
+        占位消息替换为最终文档
+        :return: 替换后的消息，失败时返回 None，由调用方另行发送
+        """
+        await self._settle()
+        if self.placeholder is None:
+            return None
+        try:
+            return await self.bot.edit_message_media(
+                media=types.InputMediaDocument(file),
+                chat_id=self.placeholder.chat.id,
+                message_id=self.placeholder.message_id,
+            )
+        except Exception as e:
+            logger.warning(f"🍺 Preview swap failed, send document instead --error {e}")
+            await self.discard()
+            return None
+
+    async def discard(self):
+        await self._settle()
+        if self.placeholder is None:
+            return
+        placeholder, self.placeholder = self.placeholder, None
+        try:
+            await self.bot.delete_message(placeholder.chat.id, placeholder.message_id)
+        except Exception as e:
+            logger.debug(f"🍺 Preview delete failed --error {e}")
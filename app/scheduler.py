@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/26 下午2:05
+# @Author  : sudoskys
+# @File    : scheduler.py
+# @Software: PyCharm
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+from loguru import logger
+
+from .metrics import STAGE_LATENCY, IN_FLIGHT
+
+LANE_PRIVATE = 0
+LANE_GROUP = 1
+
+
+class QueueFullError(Exception):
+    def __init__(self, msg: str = None):
+        self.msg = msg
+
+    def __str__(self):
+        return f"QueueFullError: {self.msg}"
+
+
+class Job(object):
+    __slots__ = ("func", "user_id", "chat_id", "lane", "tenant", "future", "created_at", "queued", "task")
+
+    def __init__(self,
+                 func: Callable[[], Awaitable[Any]],
+                 user_id: Hashable,
+                 chat_id: Hashable,
+                 lane: int,
+                 tenant: Optional[Hashable] = None):
+        self.func = func
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.lane = lane
+        self.tenant = tenant
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.created_at = time.monotonic()
+        self.queued = True
+        self.task: Optional[asyncio.Task] = None
+
+
+class Ticket(object):
+    """
+    提交结果，position 为排队位置，0 表示立即执行
+    """
+
+    def __init__(self, job: Job, position: int, estimated_wait: float):
+        self.job = job
+        self.position = position
+        self.estimated_wait = estimated_wait
+
+    @property
+    def queued(self) -> bool:
+        return self.position > 0
+
+    def cancel(self):
+        self.job.future.cancel()
+
+    def __await__(self):
+        return self.job.future.__await__()
+
+
+class Lane(object):
+    """
+    单个优先级通道，按会话轮转，会话内按用户轮转
+    """
+
+    def __init__(self):
+        self.chats: "OrderedDict[Hashable, OrderedDict[Hashable, Deque[Job]]]" = OrderedDict()
+        self.size = 0
+
+    def push(self, job: Job):
+        users = self.chats.setdefault(job.chat_id, OrderedDict())
+        users.setdefault(job.user_id, deque()).append(job)
+        self.size += 1
+
+    def pop(self) -> Job:
+        chat_id, users = next(iter(self.chats.items()))
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        self.size -= 1
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            self.chats.move_to_end(chat_id)
+        else:
+            del self.chats[chat_id]
+        return job
+
+    def remove(self, job: Job):
+        """
+        取消的任务直接出队
+        """
+        users = self.chats.get(job.chat_id)
+        jobs = users.get(job.user_id) if users is not None else None
+        if not jobs:
+            return
+        try:
+            jobs.remove(job)
+        except ValueError:
+            return
+        self.size -= 1
+        if not jobs:
+            del users[job.user_id]
+        if not users:
+            del self.chats[job.chat_id]
+
+    def order(self) -> List[Job]:
+        """
+        模拟出队顺序，不修改队列
+        """
+        chats = OrderedDict(
+            (chat_id, OrderedDict((user_id, deque(jobs)) for user_id, jobs in users.items()))
+            for chat_id, users in self.chats.items()
+        )
+        _order = []
+        while chats:
+            chat_id, users = next(iter(chats.items()))
+            user_id, jobs = next(iter(users.items()))
+            _order.append(jobs.popleft())
+            if jobs:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if users:
+                chats.move_to_end(chat_id)
+            else:
+                del chats[chat_id]
+        return _order
+
+
+class DrawScheduler(object):
+    """
+    生成任务调度器
+    全局并发限制，优先级通道，通道内按会话和用户公平轮转，队列满时拒绝
+    多个 Bot 共享时可以为每个 Bot 设置排队上限，避免一个 Bot 占满队列
+    """
+
+    def __init__(self,
+                 *,
+                 concurrency: int = 2,
+                 max_queue: int = 50,
+                 max_pending_per_user: Optional[int] = 3,
+                 lanes: int = 2,
+                 default_duration: float = 10.0,
+                 ):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_pending_per_user = max_pending_per_user
+        self.lanes = [Lane() for _ in range(lanes)]
+        self.running = 0
+        self.avg_duration = default_duration
+        self._pending_per_user: Dict[Hashable, int] = {}
+        self.tenant_quota: Dict[Hashable, int] = {}
+        self._pending_per_tenant: Dict[Hashable, int] = {}
+        self._wakeup: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def size(self) -> int:
+        return sum(lane.size for lane in self.lanes)
+
+    def position(self, job: Job) -> int:
+        """
+        任务在待执行队列中的位置，从 1 开始，不在队列中返回 0
+        """
+        ahead = 0
+        for lane in self.lanes[:job.lane]:
+            ahead += lane.size
+        for index, _job in enumerate(self.lanes[job.lane].order()):
+            if _job is job:
+                return ahead + index + 1
+        return 0
+
+    def set_quota(self, tenant: Hashable, max_queue: Optional[int]):
+        """
+        :param tenant: Bot 名称
+        :param max_queue: 该 Bot 最多排队的任务数，None 时只受全局上限限制
+        """
+        if max_queue:
+            self.tenant_quota[tenant] = max_queue
+        else:
+            self.tenant_quota.pop(tenant, None)
+
+    def _admit(self, count: int, user_id: Hashable, tenant: Optional[Hashable]):
+        if self.size + count > self.max_queue:
+            raise QueueFullError(msg="Draw queue is full")
+        quota = self.tenant_quota.get(tenant)
+        if quota and self._pending_per_tenant.get(tenant, 0) + count > quota:
+            raise QueueFullError(msg=f"Draw queue is full for bot {tenant}")
+        if self.max_pending_per_user and self._pending_per_user.get(user_id, 0) >= self.max_pending_per_user:
+            raise QueueFullError(msg="Too many pending draws for this user")
+
+    def estimate_wait(self, position: int) -> float:
+        if position <= 0:
+            return 0.0
+        return math.ceil(position / self.concurrency) * self.avg_duration
+
+    def start(self):
+        if self._workers:
+            return
+        self._wakeup = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        IN_FLIGHT.labels(kind="queued").set_function(lambda: self.size)
+        logger.info(f"🍺 DrawScheduler started --concurrency {self.concurrency} --max_queue {self.max_queue}")
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for lane in self.lanes:
+            while lane.size:
+                job = lane.pop()
+                job.queued = False
+                job.future.cancel()
+        self._pending_per_user.clear()
+        self._pending_per_tenant.clear()
+
+    def submit(self,
+               func: Callable[[], Awaitable[Any]],
+               *,
+               user_id: Hashable,
+               chat_id: Hashable,
+               lane: int = LANE_GROUP,
+               tenant: Optional[Hashable] = None
+               ) -> Ticket:
+        """
+        提交任务
+        :param func: 无参协程函数，例如 functools.partial(infer, session=session)
+        :param user_id: 用户
+        :param chat_id: 会话
+        :param lane: 优先级通道，越小越优先
+        :param tenant: 提交任务的 Bot，用于按 Bot 限额
+        :return: Ticket，可直接 await 获取结果
+        :raise QueueFullError: 队列已满、Bot 限额已满或用户待处理任务过多
+        """
+        self.start()
+        self._admit(1, user_id, tenant)
+        return self._push(func, user_id=user_id, chat_id=chat_id, lane=lane, tenant=tenant)
+
+    def submit_many(self,
+                    funcs: List[Callable[[], Awaitable[Any]]],
+                    *,
+                    user_id: Hashable,
+                    chat_id: Hashable,
+                    lane: int = LANE_GROUP,
+                    tenant: Optional[Hashable] = None
+                    ) -> List[Ticket]:
+        """
+        提交同一条消息的多个任务，全部入队或全部拒绝
+        用户待处理配额按一次请求检查，任务仍按用户轮转，不会挤占其他人
+        :raise QueueFullError: 队列放不下或用户待处理任务过多
+        """
+        self.start()
+        self._admit(len(funcs), user_id, tenant)
+        return [self._push(func, user_id=user_id, chat_id=chat_id, lane=lane, tenant=tenant) for func in funcs]
+
+    def _push(self, func, *, user_id: Hashable, chat_id: Hashable, lane: int,
+              tenant: Optional[Hashable] = None) -> Ticket:
+        lane = min(max(lane, 0), len(self.lanes) - 1)
+        job = Job(func, user_id=user_id, chat_id=chat_id, lane=lane, tenant=tenant)
+        self.lanes[lane].push(job)
+        self._pending_per_user[user_id] = self._pending_per_user.get(user_id, 0) + 1
+        if tenant is not None:
+            self._pending_per_tenant[tenant] = self._pending_per_tenant.get(tenant, 0) + 1
+        job.future.add_done_callback(partial(self._on_done, job))
+        # 空闲的并发槽位会直接取走前面的任务
+        position = max(self.position(job) - (self.concurrency - self.running), 0)
+        ticket = Ticket(job, position=position, estimated_wait=self.estimate_wait(position))
+        self._wakeup.put_nowait(None)
+        return ticket
+
+    def _release(self, job: Job):
+        """
+        任务离开队列，归还用户和 Bot 的排队配额
+        """
+        job.queued = False
+        pending = self._pending_per_user.get(job.user_id, 1) - 1
+        if pending > 0:
+            self._pending_per_user[job.user_id] = pending
+        else:
+            self._pending_per_user.pop(job.user_id, None)
+        if job.tenant is not None:
+            pending = self._pending_per_tenant.get(job.tenant, 1) - 1
+            if pending > 0:
+                self._pending_per_tenant[job.tenant] = pending
+            else:
+                self._pending_per_tenant.pop(job.tenant, None)
+
+    def _on_done(self, job: Job, future: asyncio.Future):
+        """
+        Ticket 被取消时：排队中的任务立即出队，执行中的任务取消上游调用
+        """
+        if not future.cancelled():
+            return
+        if job.queued:
+            self.lanes[job.lane].remove(job)
+            self._release(job)
+        elif job.task is not None and not job.task.done():
+            job.task.cancel()
+
+    def _pop(self) -> Optional[Job]:
+        for lane in self.lanes:
+            if lane.size:
+                job = lane.pop()
+                self._release(job)
+                return job
+        return None
+
+    async def _worker(self):
+        while True:
+            await self._wakeup.get()
+            job = self._pop()
+            if job is None or job.future.done():
+                continue
+            self.running += 1
+            start_at = time.monotonic()
+            STAGE_LATENCY.labels(stage="queue_wait").observe(start_at - job.created_at)
+            # 单独的任务执行，Ticket 取消时可以中断上游调用并释放并发槽位
+            job.task = asyncio.ensure_future(job.func())
+            try:
+                await asyncio.wait((job.task,))
+            except asyncio.CancelledError:
+                job.task.cancel()
+                job.future.cancel()
+                raise
+            finally:
+                self.running -= 1
+                self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - start_at)
+            if job.future.done():
+                continue
+            if job.task.cancelled():
+                job.future.cancel()
+            elif job.task.exception() is not None:
+                job.future.set_exception(job.task.exception())
+            else:
+                job.future.set_result(job.task.result())
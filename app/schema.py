@@ -3,14 +3,24 @@
 # @Author  : sudoskys
 # @File    : schema.py
 # @Software: PyCharm
-from typing import Optional
+import os
+from typing import List, Optional
 
 from dotenv import load_dotenv
 from loguru import logger
-from pydantic import Field, model_validator
+from pydantic import BaseModel, Field, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+def instance_path(path: Optional[str]) -> Optional[str]:
+    """
+    pm2 多实例运行时路径中的 {instance} 替换为 NODE_APP_INSTANCE，各实例使用自己的目录
+    """
+    if not path:
+        return path
+    return path.replace("{instance}", os.environ.get("NODE_APP_INSTANCE", "0"))
+
+
 class AwsS3(BaseSettings):
     """
     AWS_SECRET_ACCESS_KEY
@@ -19,55 +29,319 @@ class AwsS3(BaseSettings):
     aws_access_key_id: Optional[str] = Field(None, validation_alias='AWS_ACCESS_KEY_ID')
     aws_secret_access_key: Optional[str] = Field(None, validation_alias='AWS_SECRET_ACCESS_KEY')
     aws_bucket_name: Optional[str] = Field("dataset-novelai", validation_alias='AWS_BUCKET_NAME')
+    aws_endpoint_url: Optional[str] = Field(None, validation_alias='AWS_ENDPOINT_URL')
+    archive_workers: int = Field(4, validation_alias='ARCHIVE_WORKERS')
+    archive_max_queue: int = Field(100, validation_alias='ARCHIVE_MAX_QUEUE')
+    archive_max_retries: int = Field(3, validation_alias='ARCHIVE_MAX_RETRIES')
+    archive_spill_dir: Optional[str] = Field("archive_spill", validation_alias='ARCHIVE_SPILL_DIR')
+    # shard 写入本地滚动分片后整片上传，object 每张图一次 put
+    archive_mode: str = Field("object", validation_alias='ARCHIVE_MODE')
+    archive_shard_dir: str = Field("dataset", validation_alias='ARCHIVE_SHARD_DIR')
+    archive_shard_mb: int = Field(256, validation_alias='ARCHIVE_SHARD_MB')
+    archive_shard_seconds: float = Field(3600.0, validation_alias='ARCHIVE_SHARD_SECONDS')
+    archive_shard_prefix: str = Field("telegram", validation_alias='ARCHIVE_SHARD_PREFIX')
+    archive_keep_shards: bool = Field(False, validation_alias='ARCHIVE_KEEP_SHARDS')
+
+    @model_validator(mode='after')
+    def check_mode(self):
+        if self.archive_mode not in ("shard", "object"):
+            raise ValueError("ARCHIVE_MODE must be shard or object")
+        self.archive_shard_dir = instance_path(self.archive_shard_dir)
+        self.archive_spill_dir = instance_path(self.archive_spill_dir)
+        return self
 
     @property
     def available(self):
         return self.aws_access_key_id is not None and self.aws_secret_access_key is not None
 
 
+class NovelAiClient(BaseSettings):
+    """
+    上游连接池设置
+    """
+    max_connections: Optional[int] = Field(20, validation_alias='NOVEL_AI_MAX_CONNECTIONS')
+    max_keepalive_connections: Optional[int] = Field(10, validation_alias='NOVEL_AI_MAX_KEEPALIVE_CONNECTIONS')
+    keepalive_expiry: Optional[float] = Field(30.0, validation_alias='NOVEL_AI_KEEPALIVE_EXPIRY')
+    http2: bool = Field(False, validation_alias='NOVEL_AI_HTTP2')
+    proxy_address: Optional[str] = Field(None, validation_alias='NOVEL_AI_PROXY_ADDRESS')  # "http://127.0.0.1:7890"
+    validate_image: bool = Field(False, validation_alias='NOVEL_AI_VALIDATE_IMAGE')
+    endpoint: str = Field("https://api.novelai.net", validation_alias='NOVEL_AI_ENDPOINT')
+    tokens: Optional[str] = Field(None, validation_alias='NOVEL_AI_TOKENS')  # "token1,token2"
+    token_concurrency: int = Field(1, validation_alias='NOVEL_AI_TOKEN_CONCURRENCY')
+    token_cooldown: float = Field(30.0, validation_alias='NOVEL_AI_TOKEN_COOLDOWN')
+    token_probe_interval: Optional[float] = Field(60.0, validation_alias='NOVEL_AI_TOKEN_PROBE_INTERVAL')
+    retry_attempts: int = Field(3, validation_alias='NOVEL_AI_RETRY_ATTEMPTS')
+    retry_backoff: float = Field(0.5, validation_alias='NOVEL_AI_RETRY_BACKOFF')
+    deadline: float = Field(75.0, validation_alias='NOVEL_AI_DEADLINE')
+    attempt_timeout: float = Field(30.0, validation_alias='NOVEL_AI_ATTEMPT_TIMEOUT')
+    hedge_percentile: Optional[float] = Field(None, validation_alias='NOVEL_AI_HEDGE_PERCENTILE')  # 0.95
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+    @property
+    def token_list(self) -> List[str]:
+        if not self.tokens:
+            return []
+        return [token.strip() for token in self.tokens.split(",") if token.strip()]
+
+
+class DrawQueue(BaseSettings):
+    """
+    生成任务调度设置
+    """
+    concurrency: int = Field(2, validation_alias='DRAW_CONCURRENCY')
+    max_queue: int = Field(50, validation_alias='DRAW_MAX_QUEUE')
+    max_pending_per_user: Optional[int] = Field(3, validation_alias='DRAW_MAX_PENDING_PER_USER')
+    max_samples: int = Field(4, validation_alias='DRAW_MAX_SAMPLES')
+    stream_preview: bool = Field(False, validation_alias='DRAW_STREAM_PREVIEW')
+    preview_interval: float = Field(1.0, validation_alias='DRAW_PREVIEW_INTERVAL')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+
+class WorkerConfig(BaseSettings):
+    """
+    多进程模式：all 单进程，ingest 只接收更新并写入任务队列，worker 从队列租用任务处理
+    """
+    role: str = Field("all", validation_alias='BOT_ROLE')
+    queue_path: str = Field("jobs.db", validation_alias='JOB_QUEUE_PATH')
+    lease_seconds: float = Field(300.0, validation_alias='JOB_LEASE_SECONDS')
+    max_attempts: int = Field(3, validation_alias='JOB_MAX_ATTEMPTS')
+    concurrency: int = Field(2, validation_alias='WORKER_CONCURRENCY')
+    # 完成或失败的任务保留时间，为空时不清理
+    retention: Optional[float] = Field(24 * 3600, validation_alias='JOB_RETENTION_SECONDS')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+    @model_validator(mode='after')
+    def role_validator(self):
+        self.role = self.role.lower()
+        if self.role not in ("all", "ingest", "worker"):
+            raise ValueError(f"BOT_ROLE must be all, ingest or worker, got {self.role}")
+        return self
+
+
+class PromptCheckConfig(BaseSettings):
+    """
+    请求前的本地分词检查，trim 从末尾删除标签直到不超限，reject 直接拒绝
+    没有 CLIP 词表时词元数是估算值，超限只告警
+    """
+    enable: bool = Field(True, validation_alias='PROMPT_CHECK_ENABLE')
+    token_limit: int = Field(225, validation_alias='PROMPT_TOKEN_LIMIT')
+    overflow: str = Field("reject", validation_alias='PROMPT_OVERFLOW')
+    vocab_path: Optional[str] = Field(None, validation_alias='PROMPT_TOKENIZER_VOCAB')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+    @model_validator(mode='after')
+    def overflow_validator(self):
+        self.overflow = self.overflow.lower()
+        if self.overflow not in ("reject", "trim"):
+            raise ValueError(f"PROMPT_OVERFLOW must be reject or trim, got {self.overflow}")
+        return self
+
+
+class ResultCacheConfig(BaseSettings):
+    """
+    确定性生成结果缓存设置
+    """
+    enable: bool = Field(True, validation_alias='RESULT_CACHE_ENABLE')
+    memory_mb: int = Field(64, validation_alias='RESULT_CACHE_MEMORY_MB')
+    disk_path: Optional[str] = Field("result_cache", validation_alias='RESULT_CACHE_DIR')
+    disk_mb: int = Field(1024, validation_alias='RESULT_CACHE_DISK_MB')
+    ttl: Optional[float] = Field(7 * 24 * 3600, validation_alias='RESULT_CACHE_TTL')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+    @model_validator(mode='after')
+    def disk_path_validator(self):
+        # 磁盘层的索引在进程内，多进程不能共用目录
+        self.disk_path = instance_path(self.disk_path)
+        return self
+
+
+class FileIdCacheConfig(BaseSettings):
+    """
+    Telegram file_id 复用设置
+    内存层在进程内，多进程时其他进程作废的 file_id 可能仍被使用，发送失败后会重新上传
+    """
+    enable: bool = Field(True, validation_alias='FILE_ID_CACHE_ENABLE')
+    path: Optional[str] = Field("file_id.db", validation_alias='FILE_ID_CACHE_PATH')
+    max_entries: int = Field(10000, validation_alias='FILE_ID_CACHE_SIZE')
+    ttl: Optional[float] = Field(30 * 24 * 3600, validation_alias='FILE_ID_CACHE_TTL')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+
+class ParamMemoryConfig(BaseSettings):
+    """
+    上次生成参数记忆设置
+    SQLite 可以多进程共用，内存层在进程内，worker 模式下不启用，每次从 SQLite 读取
+    """
+    enable: bool = Field(True, validation_alias='PARAM_MEMORY_ENABLE')
+    path: Optional[str] = Field("params.db", validation_alias='PARAM_MEMORY_PATH')
+    max_entries: int = Field(50000, validation_alias='PARAM_MEMORY_SIZE')
+    memory_budget: int = Field(8 * 1024 * 1024, validation_alias='PARAM_MEMORY_BUDGET')
+    ttl: Optional[float] = Field(7 * 24 * 3600, validation_alias='PARAM_MEMORY_TTL')
+    state_max_entries: int = Field(10000, validation_alias='STATE_STORAGE_SIZE')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+
+class PostProcessConfig(BaseSettings):
+    """
+    图片后处理设置
+    """
+    workers: int = Field(2, validation_alias='POSTPROCESS_WORKERS')
+    timeout: float = Field(20.0, validation_alias='POSTPROCESS_TIMEOUT')
+    max_pending: int = Field(16, validation_alias='POSTPROCESS_MAX_PENDING')
+    preview: bool = Field(False, validation_alias='POSTPROCESS_PREVIEW')
+    preview_max_side: int = Field(1024, validation_alias='POSTPROCESS_PREVIEW_MAX_SIDE')
+    archive_webp: bool = Field(True, validation_alias='POSTPROCESS_ARCHIVE_WEBP')
+    webp_quality: int = Field(90, validation_alias='POSTPROCESS_WEBP_QUALITY')
+    strip_metadata: bool = Field(False, validation_alias='POSTPROCESS_STRIP_METADATA')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+
+class MetricsConfig(BaseSettings):
+    """
+    Prometheus 指标导出
+    """
+    enable: bool = Field(False, validation_alias='METRICS_ENABLE')
+    host: str = Field("127.0.0.1", validation_alias='METRICS_HOST')
+    port: int = Field(9464, validation_alias='METRICS_PORT')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+
+class TrafficCaptureConfig(BaseSettings):
+    """
+    /draw 流量采集，路径为空时不采集
+    """
+    path: Optional[str] = Field(None, validation_alias='TRAFFIC_CAPTURE_PATH')  # "capture/draw.jsonl"
+    salt: Optional[str] = Field(None, validation_alias='TRAFFIC_CAPTURE_SALT')
+    max_mb: int = Field(256, validation_alias='TRAFFIC_CAPTURE_MAX_MB')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+
+class WebhookConfig(BaseSettings):
+    """
+    更新接收方式，polling 或 webhook
+    """
+    mode: str = Field("polling", validation_alias='TELEGRAM_BOT_MODE')
+    url: Optional[str] = Field(None, validation_alias='TELEGRAM_WEBHOOK_URL')  # "https://example.com/telegram/webhook"
+    secret_token: Optional[str] = Field(None, validation_alias='TELEGRAM_WEBHOOK_SECRET')
+    host: str = Field("0.0.0.0", validation_alias='TELEGRAM_WEBHOOK_HOST')
+    port: int = Field(8443, validation_alias='TELEGRAM_WEBHOOK_PORT')
+    path: str = Field("/telegram/webhook", validation_alias='TELEGRAM_WEBHOOK_PATH')
+    max_queue: int = Field(1000, validation_alias='TELEGRAM_WEBHOOK_MAX_QUEUE')
+    workers: int = Field(8, validation_alias='TELEGRAM_WEBHOOK_WORKERS')
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
+
+    @model_validator(mode='after')
+    def mode_validator(self):
+        self.mode = self.mode.lower()
+        if self.mode not in ("polling", "webhook"):
+            raise ValueError(f"TELEGRAM_BOT_MODE must be polling or webhook, got {self.mode}")
+        if self.mode == "webhook" and not self.secret_token:
+            logger.warning("🍀Webhook secret token is empty, any request to the webhook path will be accepted")
+        return self
+
+
+class BotProfile(BaseModel):
+    """
+    单个 Bot 的配置，同一进程中的多个 Bot 共享上游连接池、缓存和归档
+    未设置的项沿用全局配置
+    """
+    token: str
+    name: Optional[str] = None
+    bot_id: Optional[str] = None
+    bot_username: Optional[str] = None
+    bot_link: Optional[str] = None
+    webhook_path: Optional[str] = None
+    webhook_url: Optional[str] = None
+    webhook_secret: Optional[str] = None
+    # 该 Bot 在共享调度队列中最多占用的任务数
+    max_queue: Optional[int] = None
+    max_samples: Optional[int] = None
+    stream_preview: Optional[bool] = None
+
+    @model_validator(mode='after')
+    def name_validator(self):
+        if not self.name:
+            self.name = self.token.split(":")[0]
+        return self
+
+    async def resolve_identity(self, bot) -> bool:
+        """
+        启动时异步获取 Bot 身份，已配置 bot_id 时跳过
+        :param bot: AsyncTeleBot
+        :return: 是否成功
+        """
+        if self.bot_id is not None:
+            return True
+        try:
+            _bot = await bot.get_me()
+        except Exception as e:
+            logger.error(f"\n🍀TelegramBot Token Not Set --name {self.name} --error {e}")
+            return False
+        self.bot_id = str(_bot.id)
+        self.bot_username = _bot.username
+        self.bot_link = f"https://t.me/{self.bot_username}"
+        logger.success(
+            f"🍀TelegramBot Init Connection Success --bot_name {self.bot_username} --bot_id {self.bot_id}"
+        )
+        return True
+
+
 class TelegramBot(BaseSettings):
     """
     代理设置
+    TELEGRAM_BOTS 为 JSON 列表时在一个进程中运行多个 Bot，否则只使用 TELEGRAM_BOT_TOKEN
     """
     token: Optional[str] = Field(None, validation_alias='TELEGRAM_BOT_TOKEN')
     proxy_address: Optional[str] = Field(None, validation_alias="TELEGRAM_BOT_PROXY_ADDRESS")  # "all://127.0.0.1:7890"
     bot_link: Optional[str] = Field(None, validation_alias='TELEGRAM_BOT_LINK')
     bot_id: Optional[str] = Field(None, validation_alias="TELEGRAM_BOT_ID")
     bot_username: Optional[str] = Field(None, validation_alias="TELEGRAM_BOT_USERNAME")
+    # '[{"name": "a", "token": "123:xxx"}, {"name": "b", "token": "456:yyy", "max_queue": 10}]'
+    bots: List[BotProfile] = Field(default_factory=list, validation_alias='TELEGRAM_BOTS')
     model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra="ignore")
 
     @model_validator(mode='after')
     def bot_validator(self):
         if self.proxy_address:
             logger.success(f"TelegramBot proxy was set to {self.proxy_address}")
-        if self.token is None:
+        if self.token is None and not self.bots:
             logger.info(f"\n🍀Check:Telegrambot token is empty")
-        if self.bot_id is None and self.token:
-            try:
-                from telebot import TeleBot
-                # 创建 Bot
-                if self.proxy_address is not None:
-                    from telebot import apihelper
-                    if "socks5://" in self.proxy_address:
-                        self.proxy_address = self.proxy_address.replace("socks5://", "socks5h://")
-                    apihelper.proxy = {'https': self.proxy_address}
-                _bot = TeleBot(token=self.token).get_me()
-                self.bot_id = str(_bot.id)
-                self.bot_username = _bot.username
-                self.bot_link = f"https://t.me/{self.bot_username}"
-            except Exception as e:
-                logger.error(f"\n🍀TelegramBot Token Not Set --error {e}")
-            else:
-                logger.success(
-                    f"🍀TelegramBot Init Connection Success --bot_name {self.bot_username} --bot_id {self.bot_id}"
-                )
+        names = [profile.name for profile in self.bots]
+        if len(set(names)) != len(names):
+            raise ValueError(f"TELEGRAM_BOTS names must be unique, got {names}")
         return self
 
+    def profiles(self) -> List[BotProfile]:
+        """
+        配置了 TELEGRAM_BOTS 时返回其中的 Bot，否则由 TELEGRAM_BOT_* 组成单个 Bot
+        """
+        if self.bots:
+            return self.bots
+        if not self.token:
+            return []
+        return [BotProfile(
+            token=self.token,
+            bot_id=self.bot_id,
+            bot_username=self.bot_username,
+            bot_link=self.bot_link,
+        )]
+
     @property
     def available(self):
-        return self.token is not None
+        return self.token is not None or bool(self.bots)
 
 
 load_dotenv()
 BotSetting = TelegramBot()
 AwsSetting = AwsS3()
+NovelAiSetting = NovelAiClient()
+DrawQueueSetting = DrawQueue()
+WorkerSetting = WorkerConfig()
+ResultCacheSetting = ResultCacheConfig()
+FileIdCacheSetting = FileIdCacheConfig()
+ParamMemorySetting = ParamMemoryConfig()
+PromptCheckSetting = PromptCheckConfig()
+PostProcessSetting = PostProcessConfig()
+MetricsSetting = MetricsConfig()
+TrafficCaptureSetting = TrafficCaptureConfig()
+WebhookSetting = WebhookConfig()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/11 下午4:40
+# @Author  : sudoskys
+# @File    : singleflight.py
+# @Software: PyCharm
+"""
+相同请求合并，进行中的相同请求共享一次上游调用
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from app.metrics import REGISTRY, Counter
+
+COALESCED = REGISTRY.register(Counter(
+    "naidrawer_coalesced", "Requests served by an identical in-flight request"
+))
+
+
+class _Flight(object):
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    第一个请求执行 func，之后到达的相同 key 等待同一个结果
+    单个等待者取消不影响其他人，所有等待者都离开时才取消执行
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def __contains__(self, key: str):
+        return key in self._flights
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        :param key: 请求指纹
+        :param func: 实际执行，只会被调用一次
+        :return: (结果, 是否由本次调用执行)
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight(asyncio.ensure_future(func()))
+            self._flights[key] = flight
+            # 完成后立即移除，之后的请求重新执行
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            COALESCED.inc()
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), leader
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/16 下午8:40
+# @Author  : sudoskys
+# @File    : tenant.py
+# @Software: PyCharm
+"""
+同一进程中的多个 Bot
+每个 Bot 有自己的会话状态、file_id 缓存和限额，上游连接池、调度器、结果缓存和归档由 BotRunner 共享
+"""
+from typing import Optional
+
+from telebot.async_telebot import AsyncTeleBot
+
+from .cache.file_id import FileIdCache
+from .cache.params import BoundedStateStorage
+from .schema import BotProfile, DrawQueueSetting, FileIdCacheSetting, ParamMemorySetting
+
+
+class BotTenant(object):
+    def __init__(self, profile: BotProfile):
+        self.profile = profile
+        self.name = profile.name
+        self.bot = AsyncTeleBot(
+            profile.token,
+            state_storage=BoundedStateStorage(max_entries=ParamMemorySetting.state_max_entries)
+        )
+        # file_id 只对上传它的 Bot 有效，同一个文件中按 Bot ID 区分
+        self.file_ids: Optional[FileIdCache] = FileIdCache(
+            bot_id=profile.token.split(":")[0],
+            path=FileIdCacheSetting.path,
+            max_entries=FileIdCacheSetting.max_entries,
+            ttl=FileIdCacheSetting.ttl,
+        ) if FileIdCacheSetting.enable else None
+
+    @property
+    def max_queue(self) -> Optional[int]:
+        return self.profile.max_queue
+
+    @property
+    def max_samples(self) -> int:
+        if self.profile.max_samples is not None:
+            return self.profile.max_samples
+        return DrawQueueSetting.max_samples
+
+    @property
+    def stream_preview(self) -> bool:
+        if self.profile.stream_preview is not None:
+            return self.profile.stream_preview
+        return DrawQueueSetting.stream_preview
+
+    async def resolve_identity(self) -> bool:
+        return await self.profile.resolve_identity(self.bot)
+
+    async def close(self):
+        if self.file_ids is not None:
+            await self.file_ids.close()
+        await self.bot.close_session()
+
+    def __repr__(self):
+        return f"BotTenant(name={self.name!r})"
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/15 上午10:40
+# @Author  : sudoskys
+# @File    : tokenizer.py
+# @Software: PyCharm
+"""
+请求前的本地提示词检查：规范化标签、去重、按 CLIP 分词计数，超限时拒绝或裁剪
+词表使用 OpenAI CLIP 的 bpe_simple_vocab_16e6.txt.gz，未配置时按字符数估算，估算值只告警不拒绝也不裁剪
+"""
+import gzip
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.core import CheckError
+
+VOCAB_FILE = "bpe_simple_vocab_16e6.txt.gz"
+
+# CLIP simple_tokenizer 的预分词规则，\p{L} / \p{N} 用标准库可表达的形式代替
+_PATTERN = re.compile(
+    r"<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|(?:[^\s\w]|_)+",
+    re.IGNORECASE
+)
+_SPACES = re.compile(r"\s+")
+# 只替换词内的下划线，^_^ >_< 这类颜文字标签保持原样
+_WORD_UNDERSCORE = re.compile(r"(?<=[^\W_])_(?=[^\W_])")
+# NovelAI 的 {} [] 是权重记号，不计入词元
+_EMPHASIS = str.maketrans("", "", "{}[]")
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+@lru_cache(maxsize=1)
+def bytes_to_unicode() -> Dict[int, str]:
+    """
+    字节到可见字符的映射，与 GPT-2 / CLIP 一致
+    """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+class ClipTokenizer(object):
+    """
+    只计数不输出 ID 的 CLIP BPE
+    """
+    exact = True
+
+    def __init__(self, merges: List[Tuple[str, str]], cache_size: int = 50000):
+        self.bpe_ranks = {merge: rank for rank, merge in enumerate(merges)}
+        self.byte_encoder = bytes_to_unicode()
+        self._pieces = lru_cache(maxsize=cache_size)(self._bpe)
+
+    @classmethod
+    def from_file(cls, path: str) -> "ClipTokenizer":
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+        # 与 CLIP 相同：跳过首行版本号，取前 49152 - 256 - 2 条合并规则
+        merges = [tuple(line.split()) for line in lines[1:49152 - 256 - 2 + 1] if line]
+        return cls(merges)
+
+    def _bpe(self, token: str) -> int:
+        word = tuple(token[:-1]) + (token[-1] + "</w>",)
+        while len(word) > 1:
+            pairs = set(zip(word, word[1:]))
+            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            merged = []
+            index = 0
+            while index < len(word):
+                if index < len(word) - 1 and word[index] == first and word[index + 1] == second:
+                    merged.append(first + second)
+                    index += 2
+                else:
+                    merged.append(word[index])
+                    index += 1
+            word = tuple(merged)
+        return len(word)
+
+    def count(self, text: str) -> int:
+        encoder = self.byte_encoder
+        return sum(
+            self._pieces("".join(encoder[b] for b in token.encode("utf-8")))
+            for token in _PATTERN.findall(text.lower())
+        )
+
+
+class EstimateTokenizer(object):
+    """
+    没有词表时的估算：字母串每 5 个字符记一个词元，数字和符号逐个计数
+    常见英文标签大多是一个词元，估算值通常偏大
+    """
+    exact = False
+
+    @staticmethod
+    def count(text: str) -> int:
+        total = 0
+        for token in _PATTERN.findall(text):
+            total += -(-len(token) // 5) if token[0].isalpha() else len(token)
+        return total
+
+
+@lru_cache(maxsize=4)
+def get_tokenizer(vocab_path: Optional[str] = None):
+    """
+    词表只加载一次；未指定时查找模块目录下的 bpe_simple_vocab_16e6.txt.gz
+    """
+    path = vocab_path or os.path.join(os.path.dirname(__file__), VOCAB_FILE)
+    if os.path.exists(path):
+        logger.info(f"🍺 Prompt tokenizer vocab loaded --path {path}")
+        return ClipTokenizer.from_file(path)
+    if vocab_path:
+        logger.warning(
+            f"🍺 Prompt tokenizer vocab not found, token counts are estimated and only warned --path {vocab_path}"
+        )
+    return EstimateTokenizer()
+
+
+class PromptCheck(object):
+    __slots__ = ("text", "tokens", "dropped")
+
+    def __init__(self, text: str, tokens: int, dropped: int = 0):
+        self.text = text
+        self.tokens = tokens
+        self.dropped = dropped
+
+
+def _tag_key(tag: str) -> str:
+    return tag.translate(_EMPHASIS).strip().lower()
+
+
+def _balanced(tag: str) -> bool:
+    return tag.count("{") == tag.count("}") and tag.count("[") == tag.count("]")
+
+
+def normalize_tags(text: str) -> List[str]:
+    """
+    逗号分隔的标签：合并空白，词内下划线换成空格，去掉括号内侧空白和空标签
+    括号自身闭合且完全相同的重复标签只保留第一次出现，权重不同的同名标签和跨标签的权重括号原样保留
+    """
+    tags = []
+    seen = set()
+    for tag in text.split(","):
+        tag = _SPACES.sub(" ", _WORD_UNDERSCORE.sub(" ", tag)).strip()
+        tag = re.sub(r"([{\[])\s+", r"\1", re.sub(r"\s+([}\]])", r"\1", tag))
+        key = _tag_key(tag)
+        if not key:
+            if tag and not _balanced(tag):
+                tags.append(tag)
+            continue
+        if _balanced(tag):
+            # 按带括号的原文去重，smile 与 {smile} 的权重不同，都保留
+            if tag.lower() in seen:
+                continue
+            seen.add(tag.lower())
+        tags.append(tag)
+    return tags
+
+
+def _close_emphasis(text: str) -> str:
+    stack = []
+    for char in text:
+        if char in _CLOSERS:
+            stack.append(_CLOSERS[char])
+        elif stack and char == stack[-1]:
+            stack.pop()
+    return text + "".join(reversed(stack))
+
+
+@lru_cache(maxsize=4096)
+def check_prompt(text: str,
+                 *,
+                 limit: int = 225,
+                 overflow: str = "reject",
+                 vocab_path: Optional[str] = None,
+                 ) -> PromptCheck:
+    """
+    :param text: 提示词
+    :param limit: 词元上限，NovelAI V3 为 225
+    :param overflow: reject 抛出 CheckError，trim 从末尾删除标签，只在加载了词表时生效
+    :param vocab_path: CLIP 词表
+    :raise CheckError: 超限且 overflow 为 reject
+    """
+    tokenizer = get_tokenizer(vocab_path)
+    tags = normalize_tags(text)
+    counts = [tokenizer.count(tag.translate(_EMPHASIS)) for tag in tags]
+    # 逗号各占一个词元
+    total = sum(counts) + max(0, len(tags) - 1)
+    if total <= limit:
+        return PromptCheck(", ".join(tags), total)
+    if not tokenizer.exact:
+        # 估算值偏大，NovelAI 可能可以接受，只告警
+        logger.warning(f"🍺 Prompt may be too long: about {total} tokens, limit {limit}")
+        return PromptCheck(", ".join(tags), total)
+    if overflow != "trim":
+        raise CheckError(f"🥕 Prompt is too long: {total} tokens, limit {limit}")
+    kept = 0
+    used = 0
+    for count in counts:
+        cost = count + (1 if kept else 0)
+        if used + cost > limit:
+            break
+        used += cost
+        kept += 1
+    if not kept:
+        raise CheckError(f"🥕 Prompt is too long: {total} tokens, limit {limit}")
+    return PromptCheck(_close_emphasis(", ".join(tags[:kept])), used, dropped=len(tags) - kept)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/9 下午3:18
+# @Author  : sudoskys
+# @File    : webhook.py
+# @Software: PyCharm
+import asyncio
+import hmac
+from functools import partial
+from typing import List, Optional
+
+from aiohttp import web
+from loguru import logger
+from telebot import types, util
+from telebot.async_telebot import AsyncTeleBot
+
+from .metrics import IN_FLIGHT
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookRoute(object):
+    __slots__ = ("bot", "path", "url", "secret_token")
+
+    def __init__(self, bot: AsyncTeleBot, path: str, url: Optional[str], secret_token: Optional[str]):
+        self.bot = bot
+        self.path = path
+        self.url = url
+        self.secret_token = secret_token
+
+
+class WebhookServer(object):
+    """
+    Webhook 接收更新
+    请求只做校验和入队，立即返回 200，由后台消费者调用与轮询模式相同的处理器
+    多个 Bot 共用一个端口和消费者，按路径区分
+    """
+
+    def __init__(self,
+                 bot: AsyncTeleBot,
+                 *,
+                 host: str = "0.0.0.0",
+                 port: int = 8443,
+                 path: str = "/telegram/webhook",
+                 url: Optional[str] = None,
+                 secret_token: Optional[str] = None,
+                 max_queue: int = 1000,
+                 workers: int = 8,
+                 ):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.url = url
+        self.secret_token = secret_token
+        self.routes: List[WebhookRoute] = [WebhookRoute(bot, path, url, secret_token)]
+        self.max_queue = max_queue
+        self.workers = workers
+        self.received = 0
+        self.rejected = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def add_route(self,
+                  bot: AsyncTeleBot,
+                  path: str,
+                  *,
+                  url: Optional[str] = None,
+                  secret_token: Optional[str] = None):
+        """
+        追加一个 Bot，需在 start 之前调用
+        """
+        if any(route.path == path for route in self.routes):
+            raise ValueError(f"Webhook path {path} is already used")
+        self.routes.append(WebhookRoute(bot, path, url, secret_token))
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        for route in self.routes:
+            app.router.add_post(route.path, partial(self.handle, route=route))
+        return app
+
+    async def handle(self, request: web.Request, route: Optional[WebhookRoute] = None) -> web.Response:
+        route = route or self.routes[0]
+        if route.secret_token is not None:
+            token = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(token, route.secret_token):
+                self.rejected += 1
+                return web.Response(status=403)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait((route.bot, update))
+        except asyncio.QueueFull:
+            # 非 2xx 时 Telegram 会稍后重试，积压由服务端保留
+            logger.warning("🍺 Webhook queue is full, ask Telegram to retry later")
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            bot, update = await self._queue.get()
+            try:
+                await bot.process_new_updates([types.Update.de_json(update)])
+            except Exception as e:
+                logger.exception(f"🍺 Webhook update process error: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        IN_FLIGHT.labels(kind="webhook_queue").set_function(lambda: self._queue.qsize())
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        for route in self.routes:
+            logger.info(f"🍺 Webhook listening on {self.host}:{self.port}{route.path}")
+            if route.url:
+                await route.bot.set_webhook(
+                    url=route.url,
+                    secret_token=route.secret_token,
+                    allowed_updates=util.update_types,
+                )
+                logger.info(f"🍺 Webhook registered --url {route.url}")
+
+    async def close(self, timeout: float = 10.0):
+        """
+        先停止接收，再等待队列中的更新处理完
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"🍺 Webhook close timeout, {self._queue.qsize()} updates dropped")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.close()
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/28 下午10:11
+# @Author  : sudoskys
+# @File    : __init__.py
+# @Software: PyCharm
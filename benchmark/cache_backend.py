@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/11/28 下午10:12
+# @Author  : sudoskys
+# @File    : cache_backend.py
+# @Software: PyCharm
+"""
+缓存后端基准，python -m benchmark.cache_backend --keys 10000
+Elara 每次写入都会重写整个文件，耗时随键数平方增长，可用 --elara-keys 缩小规模
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from app.cache.elara import ElaraClientAsyncWrapper
+from app.cache.sqlite import SqliteClientAsyncWrapper
+
+
+async def bench(client, keys: int, bulk: bool = False) -> dict:
+    value = {"sampler": "k_euler", "seed": 123456, "prompt": "1girl, best quality, amazing quality"}
+    start = time.perf_counter()
+    if bulk:
+        await client.set_many({f"user:{i}": value for i in range(keys)})
+    else:
+        for i in range(keys):
+            await client.set_data(f"user:{i}", value)
+    write = time.perf_counter() - start
+    if hasattr(client, "flush"):
+        await client.flush()
+    flush = time.perf_counter() - start - write
+    start = time.perf_counter()
+    if bulk:
+        await client.read_many([f"user:{i}" for i in range(keys)])
+    else:
+        for i in range(keys):
+            await client.read_data(f"user:{i}")
+    read = time.perf_counter() - start
+    return {
+        "write_ops": round(keys / write),
+        "flush_s": round(flush, 4),
+        "read_ops": round(keys / read),
+    }
+
+
+async def main(keys: int, elara_keys: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        elara_client = ElaraClientAsyncWrapper(backend=os.path.join(tmp, "elara.db"))
+        print("elara", await bench(elara_client, elara_keys))
+        sqlite_client = SqliteClientAsyncWrapper(backend=os.path.join(tmp, "sqlite.db"))
+        print("sqlite", await bench(sqlite_client, keys))
+        await sqlite_client.close()
+        sqlite_client = SqliteClientAsyncWrapper(backend=os.path.join(tmp, "sqlite_bulk.db"))
+        print("sqlite bulk", await bench(sqlite_client, keys, bulk=True))
+        await sqlite_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--elara-keys", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.keys, args.elara_keys or args.keys))
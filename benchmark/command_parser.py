@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/3 下午9:10
+# @Author  : sudoskys
+# @File    : command_parser.py
+# @Software: PyCharm
+"""
+/draw 解析基准，python -m benchmark.command_parser
+对比旧的字符串拼接 + Alconna 解析与 app.parser 的快速解析（冷启动和 LRU 命中）
+"""
+import argparse
+import random
+import timeit
+
+from app.parser import legacy_parse, parse_draw, tokenize, _parse
+
+CORPUS = [
+    "1girl, best quality, amazing quality, very aesthetic, absurdres",
+    "1girl, solo, long hair, looking at viewer, smile -s 123456",
+    "1boy, armor, sword, night sky, full moon -neg lowres, bad anatomy -s 42 -sam k_dpmpp_2m",
+    "cat ears, maid, -_- expression, cafe, window light -wi 1216 -he 832",
+    "scenery, no humans, mountain, lake, reflection, cloud -cfg 0 -sam k_euler_ancestral",
+    "2girls, yuri, holding hands, cherry blossoms, school uniform -s 7 -wi 1024 -he 1024",
+    "chibi, {{{masterpiece}}}, [sketch], monochrome -neg 'nsfw, text' -s 99",
+    "1girl, witch hat, magic circle, glowing, dark background --seed 31415 --sampler k_euler",
+]
+
+
+def build_corpus(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        base = rng.choice(CORPUS)
+        corpus.append(f"{base.split(' -')[0]}, {rng.choice(['smile', 'blush', 'wind', 'rain'])}"
+                      f"{base[len(base.split(' -')[0]):]}")
+    return corpus
+
+
+def main(size: int, repeat: int):
+    corpus = build_corpus(size)
+    legacy = timeit.timeit(lambda: [legacy_parse(body) for body in corpus], number=repeat)
+    fast = timeit.timeit(lambda: [tokenize(body) for body in corpus], number=repeat)
+    _parse.cache_clear()
+    [parse_draw(body) for body in corpus]
+    cached = timeit.timeit(lambda: [parse_draw(body) for body in corpus], number=repeat)
+    total = size * repeat
+    for name, cost in (("legacy alconna", legacy), ("fast tokenizer", fast), ("fast + lru", cached)):
+        print(f"{name:<16} {cost / total * 1e6:8.2f} us/parse  {total / cost:10.0f} parse/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.size, args.repeat)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/5 下午5:02
+# @Author  : sudoskys
+# @File    : harness.py
+# @Software: PyCharm
+"""
+端到端离线压测，python -m benchmark.harness --users 20 --requests 5 --output bench/result.json
+在本地启动 NovelAI 与 Telegram 桩服务，N 个模拟用户通过 getUpdates 驱动 listen_draw_command
+--bots 大于 1 时同一进程运行多个 Bot（TELEGRAM_BOTS），用户按序分配到各个 Bot
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Optional
+
+from loguru import logger
+
+from .stub_novelai import StubNovelAi
+from .stub_telegram import StubTelegram
+from .utils import LoopLagMonitor, peak_rss_mb, summarize, write_report
+
+PROMPTS = [
+    "1girl, solo, long hair, smile",
+    "1boy, armor, night sky, full moon -neg lowres, bad anatomy",
+    "scenery, no humans, mountain, lake -sam k_euler_ancestral",
+    "cat ears, maid, cafe, window light -wi 1216 -he 832",
+    "2girls, cherry blossoms, school uniform -wi 1024 -he 1024",
+]
+
+
+def prepare_env(novelai: StubNovelAi, telegram: StubTelegram, concurrency: int, stream: bool = False):
+    """
+    必须在导入 app 之前调用，配置类在导入时读取环境变量
+    """
+    os.environ["NOVEL_AI_TOKEN"] = "stub"
+    os.environ["NOVEL_AI_ENDPOINT"] = novelai.url
+    os.environ["TELEGRAM_BOT_TOKEN"] = telegram.token
+    os.environ["TELEGRAM_BOT_ID"] = str(telegram.bot_id)
+    os.environ["TELEGRAM_BOT_USERNAME"] = telegram.username
+    os.environ["DRAW_CONCURRENCY"] = str(concurrency)
+    os.environ["RESULT_CACHE_ENABLE"] = "false"
+    os.environ["FILE_ID_CACHE_PATH"] = ""
+    os.environ["PARAM_MEMORY_PATH"] = ""
+    os.environ["DRAW_STREAM_PREVIEW"] = "true" if stream else "false"
+    if len(telegram.tokens) > 1:
+        os.environ["TELEGRAM_BOTS"] = json.dumps([
+            {"name": f"bot{index}", "token": token, "bot_id": token.split(":")[0]}
+            for index, token in enumerate(telegram.tokens)
+        ])
+    else:
+        os.environ.pop("TELEGRAM_BOTS", None)
+
+
+def build_runner(telegram: StubTelegram, result_cache=None):
+    from telebot import asyncio_helper
+    from app.controller import BotRunner
+    asyncio_helper.API_URL = telegram.api_url
+    runner = BotRunner()
+    # 压测不归档，默认也不命中结果缓存
+    runner.archiver = None
+    runner.result_cache = result_cache
+    runner.setup()
+    return runner
+
+
+async def drive_user(telegram: StubTelegram, user_id: int, chat_id: int, chat_type: str,
+                     requests: int, think_time: float, timeout: float, rng: random.Random,
+                     token: Optional[str] = None):
+    deliveries = []
+    for _ in range(requests):
+        prompt = rng.choice(PROMPTS)
+        delivery = telegram.push_message(
+            f"/draw {prompt}", chat_id=chat_id, user_id=user_id, chat_type=chat_type, token=token
+        )
+        deliveries.append(delivery)
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(delivery.done), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        if think_time:
+            await asyncio.sleep(rng.uniform(0, think_time * 2))
+    return deliveries
+
+
+async def run(args) -> dict:
+    novelai = StubNovelAi(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    telegram = StubTelegram(bots=args.bots)
+    novelai.start()
+    telegram.start()
+    prepare_env(novelai, telegram, args.concurrency, stream=args.stream)
+    runner = build_runner(telegram)
+    serve = asyncio.create_task(runner.serve())
+    lag = LoopLagMonitor()
+    lag.start()
+    await asyncio.get_running_loop().run_in_executor(None, telegram.polled.wait, 10)
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        drive_user(
+            telegram,
+            user_id=1000 + index,
+            chat_id=-100 - index % args.groups if index % args.groups != args.groups - 1 else 1000 + index,
+            chat_type="group" if index % args.groups != args.groups - 1 else "private",
+            requests=args.requests,
+            think_time=args.think_time,
+            timeout=args.timeout,
+            rng=random.Random(rng.random()),
+            token=telegram.tokens[index % len(telegram.tokens)],
+        )
+        for index in range(args.users)
+    ])
+    elapsed = time.perf_counter() - start
+    await lag.stop()
+    serve.cancel()
+    await asyncio.gather(serve, return_exceptions=True)
+    telegram.stop()
+    novelai.stop()
+    deliveries = [delivery for user in results for delivery in user]
+    outcomes = {}
+    for delivery in deliveries:
+        outcome = delivery.outcome or "timeout"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    latencies = [delivery.latency for delivery in deliveries if delivery.outcome == "document"]
+    feedback = [delivery.first_feedback for delivery in deliveries if delivery.first_feedback is not None]
+    # 同一会话相邻两次编辑的间隔，检查预览限流
+    edit_gaps = []
+    last_edit = {}
+    for chat_id, at in sorted(telegram.edits, key=lambda item: item[1]):
+        if chat_id in last_edit:
+            edit_gaps.append(at - last_edit[chat_id])
+        last_edit[chat_id] = at
+    return {
+        "config": vars(args),
+        "elapsed_s": round(elapsed, 3),
+        "requests": len(deliveries),
+        "bots": len(telegram.tokens),
+        "throughput_rps": round(outcomes.get("document", 0) / elapsed, 3),
+        "outcomes": outcomes,
+        "latency_s": summarize(latencies),
+        "first_feedback_s": summarize(feedback),
+        "preview_edits": len(telegram.edits),
+        "min_edit_gap_s": round(min(edit_gaps), 4) if edit_gaps else None,
+        "loop_lag_s": summarize(lag.samples),
+        "peak_rss_mb": peak_rss_mb(),
+        "upstream": {
+            "requests": novelai.requests,
+            "errors": novelai.errors,
+            "peak_in_flight": novelai.peak_in_flight,
+        },
+        "telegram_calls": telegram.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=5, help="每个用户的请求数")
+    parser.add_argument("--groups", type=int, default=4, help="用户分布的会话数，最后一组为私聊")
+    parser.add_argument("--concurrency", type=int, default=4, help="DRAW_CONCURRENCY")
+    parser.add_argument("--latency", type=float, default=1.0, help="桩服务平均生成耗时")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--think-time", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stream", action="store_true", help="开启流式预览 DRAW_STREAM_PREVIEW")
+    parser.add_argument("--bots", type=int, default=1, help="同一进程中的 Bot 数")
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--log-level", type=str, default="WARNING")
+    args = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    report = asyncio.run(run(args))
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/16 下午2:10
+# @Author  : sudoskys
+# @File    : replay.py
+# @Software: PyCharm
+"""
+按采集的真实到达节奏回放 /draw，python -m benchmark.replay capture.jsonl --speed 10
+采集文件由 TRAFFIC_CAPTURE_PATH 生成，提示词按记录的标签数重新合成
+--speed 1 原速，10 十倍速，max 不等待直接投递
+报告按 --window 秒分段，给出每段的到达、完成、队列深度和延迟分位
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from .harness import build_runner, prepare_env
+from .stub_novelai import StubNovelAi
+from .stub_telegram import StubTelegram
+from .utils import LoopLagMonitor, peak_rss_mb, summarize, write_report
+
+TAGS = [
+    "1girl", "solo", "long hair", "looking at viewer", "smile", "blush", "open mouth", "bangs", "blue eyes",
+    "skirt", "shirt", "long sleeves", "hair ornament", "holding", "jewelry", "school uniform", "white background",
+    "best quality", "amazing quality", "very aesthetic", "absurdres", "cherry blossoms", "night sky", "full moon",
+    "cinematic lighting", "depth of field", "cat ears", "maid headdress", "from above", "dutch angle", "wind",
+]
+FLAGS = {"seed": "-s", "cfg_rescale": "-cfg", "sampler": "-sam", "width": "-wi", "height": "-he", "samples": "-n"}
+
+
+def load_capture(path: str, limit: Optional[int] = None) -> List[dict]:
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 采集进程被杀时最后一行可能不完整
+                continue
+            if limit and len(entries) >= limit:
+                break
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def synthesize(shape: Optional[dict], rng: random.Random) -> str:
+    count = max(1, (shape or {}).get("tags", 1))
+    return ", ".join(rng.choice(TAGS) for _ in range(count))
+
+
+def build_text(entry: dict, rng: random.Random) -> str:
+    """
+    按记录的参数还原一条 /draw
+    """
+    if not entry.get("matched", True):
+        # 解析失败的请求同样占用处理器
+        return "/draw 1girl --unknown 1"
+    parts = ["/draw", synthesize(entry.get("prompt"), rng)]
+    for key, value in (entry.get("args") or {}).items():
+        if key in FLAGS:
+            parts += [FLAGS[key], str(value)]
+    if entry.get("negative_prompt"):
+        parts += ["-neg", f"'{synthesize(entry['negative_prompt'], rng)}'"]
+    return " ".join(parts)
+
+
+class QueueSampler(object):
+    """
+    定时记录调度器的排队数和执行数
+    """
+
+    def __init__(self, scheduler, interval: float = 0.25):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.samples: List[tuple] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        start = time.perf_counter()
+        while True:
+            self.samples.append((time.perf_counter() - start, self.scheduler.size, self.scheduler.running))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def slope(points) -> Optional[float]:
+    """
+    最小二乘斜率
+    """
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var:
+        return None
+    return round(sum((x - mean_x) * (y - mean_y) for x, y in points) / var, 3)
+
+
+def timeline(deliveries, queue_samples, start: float, window: float) -> List[dict]:
+    """
+    按投递开始后的时间分段统计
+    """
+    end = max(
+        [delivery.sent_at - start for delivery in deliveries]
+        + [delivery.sent_at + delivery.latency - start for delivery in deliveries if delivery.latency is not None]
+        + [0.0]
+    )
+    rows = []
+    for index in range(int(end // window) + 1):
+        low, high = index * window, (index + 1) * window
+        arrived = [delivery for delivery in deliveries if low <= delivery.sent_at - start < high]
+        finished = [
+            delivery for delivery in deliveries
+            if delivery.latency is not None and low <= delivery.sent_at + delivery.latency - start < high
+        ]
+        depth = [size for at, size, _ in queue_samples if low <= at < high]
+        backlog = sum(
+            1 for delivery in deliveries
+            if delivery.sent_at - start < high
+            and (delivery.latency is None or delivery.sent_at + delivery.latency - start >= high)
+        )
+        latency = summarize([delivery.latency for delivery in finished if delivery.outcome != "error"], digits=3)
+        rows.append({
+            "t": round(low, 1),
+            "arrived": len(arrived),
+            "finished": len(finished),
+            "throughput_rps": round(len(finished) / window, 3),
+            "queue_max": max(depth) if depth else 0,
+            "backlog": backlog,
+            "latency_p50": latency["p50"],
+            "latency_p95": latency["p95"],
+        })
+    return rows
+
+
+async def run(args) -> dict:
+    entries = load_capture(args.capture, args.limit)
+    if not entries:
+        raise SystemExit(f"empty capture: {args.capture}")
+    speed = None if args.speed == "max" else float(args.speed)
+    novelai = StubNovelAi(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    telegram = StubTelegram()
+    novelai.start()
+    telegram.start()
+    prepare_env(novelai, telegram, args.concurrency, stream=args.stream)
+    # 回放时不再采集
+    os.environ["TRAFFIC_CAPTURE_PATH"] = ""
+    runner = build_runner(telegram)
+    serve = asyncio.create_task(runner.serve())
+    lag = LoopLagMonitor()
+    lag.start()
+    await asyncio.get_running_loop().run_in_executor(None, telegram.polled.wait, 10)
+    queue = QueueSampler(runner.scheduler)
+    queue.start()
+    rng = random.Random(args.seed)
+    first = entries[0]["t"]
+    deliveries = []
+    start = time.perf_counter()
+    for entry in entries:
+        if speed:
+            delay = (entry["t"] - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        deliveries.append(telegram.push_message(
+            build_text(entry, rng),
+            chat_id=entry["chat"],
+            user_id=entry["user"],
+            chat_type=entry.get("chat_type", "group"),
+        ))
+    arrival_s = time.perf_counter() - start
+    pending = [asyncio.wrap_future(delivery.done) for delivery in deliveries if not delivery.done.done()]
+    if pending:
+        await asyncio.wait(pending, timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    await queue.stop()
+    await lag.stop()
+    serve.cancel()
+    await asyncio.gather(serve, return_exceptions=True)
+    telegram.stop()
+    novelai.stop()
+    outcomes = {}
+    for delivery in deliveries:
+        outcome = delivery.outcome or "timeout"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    completed = [delivery for delivery in deliveries if delivery.outcome in ("document", "media_group")]
+    depth = [size for _, size, _ in queue.samples]
+    return {
+        "config": vars(args),
+        "records": len(entries),
+        "capture_span_s": round(entries[-1]["t"] - first, 3),
+        "arrival_s": round(arrival_s, 3),
+        "elapsed_s": round(elapsed, 3),
+        "offered_rps": round(len(entries) / arrival_s, 3) if arrival_s else None,
+        "throughput_rps": round(len(completed) / elapsed, 3),
+        "outcomes": outcomes,
+        "latency_s": summarize([delivery.latency for delivery in completed]),
+        "queue_depth": summarize(depth, digits=1),
+        # 投递期间排队数的平均增长，持续为正说明容量不足
+        "queue_growth_per_s": slope([(at, size) for at, size, _ in queue.samples if at <= arrival_s]),
+        "timeline": timeline(deliveries, queue.samples, start, args.window),
+        "loop_lag_s": summarize(lag.samples),
+        "peak_rss_mb": peak_rss_mb(),
+        "upstream": {
+            "requests": novelai.requests,
+            "errors": novelai.errors,
+            "peak_in_flight": novelai.peak_in_flight,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", type=str, help="TRAFFIC_CAPTURE_PATH 生成的 JSONL")
+    parser.add_argument("--speed", type=str, default="1", help="回放倍速，max 为不等待")
+    parser.add_argument("--limit", type=int, default=None, help="只回放前 N 条")
+    parser.add_argument("--window", type=float, default=10.0, help="时间线分段秒数")
+    parser.add_argument("--concurrency", type=int, default=4, help="DRAW_CONCURRENCY")
+    parser.add_argument("--latency", type=float, default=1.0, help="桩服务平均生成耗时")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="投递结束后等待完成的时间")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stream", action="store_true", help="开启流式预览 DRAW_STREAM_PREVIEW")
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--log-level", type=str, default="WARNING")
+    args = parser.parse_args()
+    if args.speed != "max" and float(args.speed) <= 0:
+        parser.error("--speed must be positive or max")
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    report = asyncio.run(run(args))
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/13 下午9:30
+# @Author  : sudoskys
+# @File    : request_build.py
+# @Software: PyCharm
+"""
+推理请求构建基准，python -m benchmark.request_build
+对比旧路径（pydantic 校验构建 + model_dump + 请求头 + json 编码 + 完整日志格式化）
+和 DrawRequest（__slots__ + 默认参数模板 + 一次编码 + 缓存请求头 + 惰性日志），单位 请求/秒
+"""
+import argparse
+import json
+import os
+import random
+import timeit
+
+from app.core import DrawRequest, NovelAiInference
+from app.core.request import headers_for, orjson
+
+PROMPTS = [
+    "1girl, best quality, amazing quality, very aesthetic, absurdres",
+    "1boy, armor, sword, night sky, full moon, cinematic lighting, depth of field",
+    "scenery, no humans, mountain, lake, reflection, cloud, sunset, wide shot",
+    "cat ears, maid, cafe, window light, steam, cup, smile, looking at viewer",
+]
+
+
+def build_corpus(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        {
+            "prompt": rng.choice(PROMPTS),
+            "seed": rng.randint(1, 2 ** 32 - 1),
+            "sampler": rng.choice(NovelAiInference.valid_sampler()),
+            "width": 832,
+            "height": 1216,
+        }
+        for _ in range(size)
+    ]
+
+
+def legacy(kwargs: dict):
+    prompt = kwargs["prompt"]
+    param = {k: v for k, v in kwargs.items() if k != "prompt"}
+    infer = NovelAiInference(input=prompt, parameters=NovelAiInference.Params(**param))
+    request_data = infer.model_dump()
+    headers = {
+        "Authorization": f"Bearer {infer.access_token}",
+        "Content-Type": "application/json",
+        "Origin": "https://novelai.net",
+        "Referer": "https://novelai.net/"
+    }
+    body = json.dumps(request_data).encode("utf-8")
+    log = f"request_data: {request_data}"
+    return body, headers, log
+
+
+def fast(kwargs: dict):
+    infer = DrawRequest.build(**kwargs)
+    prepared = infer.prepare()
+    return prepared.body, headers_for(infer.access_token)
+
+
+def main(size: int, repeat: int):
+    os.environ.setdefault("NOVEL_AI_TOKEN", "pst-benchmark")
+    corpus = build_corpus(size)
+    # 输出一致
+    for kwargs in corpus[:10]:
+        assert json.loads(legacy(kwargs)[0]) == json.loads(fast(kwargs)[0])
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    total = size * repeat
+    for name, func in (("legacy", legacy), ("slots", fast)):
+        cost = timeit.timeit(lambda: [func(kwargs) for kwargs in corpus], number=repeat)
+        print(f"{name:<10} {cost / total * 1e6:8.2f} us/request  {total / cost:10.0f} request/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.size, args.repeat)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/12 上午11:20
+# @Author  : sudoskys
+# @File    : startup.py
+# @Software: PyCharm
+"""
+启动耗时，python -m benchmark.startup --runs 3 --output bench/startup.json
+- import: python -X importtime -c "import app.controller" 的总耗时和最重的模块
+- ready: 启动子进程到第一次 getUpdates
+- first_update: 就绪后投递一条 /draw 到收到文档
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from .harness import prepare_env
+from .stub_novelai import StubNovelAi
+from .stub_telegram import StubTelegram
+from .utils import summarize, write_report
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """
+    :return: [(模块, 自身微秒, 累计微秒)]，按累计耗时降序
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def measure_import(module: str) -> Dict:
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env
+    )
+    rows = parse_importtime(result.stderr)
+    # 顶层导入只缩进一个空格
+    top = [row for row in rows if row[0].startswith(" ") and not row[0].startswith("  ")]
+    return {
+        "total_s": round(sum(row[2] for row in top) / 1e6, 4),
+        "heaviest": [
+            {"module": name.strip(), "self_s": round(self_us / 1e6, 4), "cumulative_s": round(cumulative_us / 1e6, 4)}
+            for name, self_us, cumulative_us in rows[:15]
+        ],
+    }
+
+
+async def measure_first_update(telegram: StubTelegram, timeout: float) -> Dict:
+    telegram.polled.clear()
+    env = dict(os.environ, BENCH_TELEGRAM_API_URL=telegram.api_url)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "benchmark.startup", "--child"], env=env)
+    try:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, telegram.polled.wait, timeout):
+            return {"ready_s": None, "first_update_s": None}
+        ready = time.perf_counter() - start
+        delivery = telegram.push_message("/draw 1girl, solo", chat_id=1, user_id=1, chat_type="private")
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(delivery.done), timeout=timeout)
+        except asyncio.TimeoutError:
+            return {"ready_s": ready, "first_update_s": None}
+        return {"ready_s": ready, "first_update_s": time.perf_counter() - start}
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def child():
+    from telebot import asyncio_helper
+    from app.controller import BotRunner
+    asyncio_helper.API_URL = os.environ["BENCH_TELEGRAM_API_URL"]
+    BotRunner().run()
+
+
+async def run(args) -> dict:
+    novelai = StubNovelAi(latency=0.0, jitter=0.0)
+    telegram = StubTelegram()
+    novelai.start()
+    telegram.start()
+    prepare_env(novelai, telegram, concurrency=1)
+    # 走异步 getMe
+    os.environ.pop("TELEGRAM_BOT_ID", None)
+    imports = [measure_import(args.module) for _ in range(args.runs)]
+    runs = [await measure_first_update(telegram, args.timeout) for _ in range(args.runs)]
+    telegram.stop()
+    novelai.stop()
+    return {
+        "config": vars(args),
+        "import_s": summarize([item["total_s"] for item in imports]),
+        "heaviest_imports": imports[-1]["heaviest"],
+        "ready_s": summarize([item["ready_s"] for item in runs if item["ready_s"] is not None]),
+        "first_update_s": summarize([item["first_update_s"] for item in runs if item["first_update_s"] is not None]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--module", type=str, default="app.controller")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+    write_report(asyncio.run(run(args)), args.output)
+
+
+if __name__ == "__main__":
+    main()
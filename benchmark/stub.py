@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/5 下午2:30
+# @Author  : sudoskys
+# @File    : stub.py
+# @Software: PyCharm
+"""
+本地桩服务基类，在独立线程的事件循环中运行，不干扰被测进程的主循环
+"""
+import asyncio
+import socket
+import threading
+from typing import Optional
+
+from aiohttp import web
+
+
+def free_port(host: str = "127.0.0.1") -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class StubServer(object):
+    def __init__(self, host: str = "127.0.0.1", port: Optional[int] = None):
+        self.host = host
+        self.port = port or free_port(host)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def build_app(self) -> web.Application:
+        raise NotImplementedError
+
+    async def _serve(self):
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._ready.set()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._serve())
+        self.loop.run_forever()
+        self.loop.run_until_complete(self._runner.cleanup())
+        self.loop.close()
+
+    def start(self) -> "StubServer":
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=10)
+        return self
+
+    def stop(self):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=10)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
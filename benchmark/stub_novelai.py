@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/5 下午2:52
+# @Author  : sudoskys
+# @File    : stub_novelai.py
+# @Software: PyCharm
+"""
+NovelAI 桩服务，返回 application/x-zip-compressed 的 PNG，可配置延迟和错误率
+/ai/generate-image-stream 以 SSE 推送合成的中间步骤，最后一个事件为 PNG
+通过 NOVEL_AI_ENDPOINT 指向 StubNovelAi.url 使用
+"""
+import asyncio
+import base64
+import json
+import random
+import zipfile
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+from .stub import StubServer
+
+
+def make_png(width: int, height: int) -> bytes:
+    from PIL import Image
+    channels = [Image.effect_noise((width // 8, height // 8), 64).resize((width, height)) for _ in range(3)]
+    output = BytesIO()
+    Image.merge("RGB", channels).save(output, format="PNG")
+    return output.getvalue()
+
+
+def make_jpeg(width: int, height: int, step: int) -> bytes:
+    from PIL import Image
+    output = BytesIO()
+    level = 255 * step // 28
+    Image.new("RGB", (width // 8, height // 8), (level, level, level)).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def make_zip(png: bytes) -> bytes:
+    output = BytesIO()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr("image_0.png", png)
+    return output.getvalue()
+
+
+class StubNovelAi(StubServer):
+    def __init__(self,
+                 *,
+                 latency: float = 1.0,
+                 jitter: float = 0.2,
+                 error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0,
+                 stream_steps: int = 8,
+                 seed: Optional[int] = None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.stream_steps = stream_steps
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.errors = 0
+        self._payloads: Dict[Tuple[int, int], bytes] = {}
+        self._pngs: Dict[Tuple[int, int], bytes] = {}
+
+    def png(self, width: int, height: int) -> bytes:
+        key = (width, height)
+        if key not in self._pngs:
+            self._pngs[key] = make_png(width, height)
+        return self._pngs[key]
+
+    def payload(self, width: int, height: int) -> bytes:
+        key = (width, height)
+        if key not in self._payloads:
+            self._payloads[key] = make_zip(self.png(width, height))
+        return self._payloads[key]
+
+    def delay(self) -> float:
+        return max(0.0, self.random.gauss(self.latency, self.jitter))
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/ai/generate-image", self.generate_image)
+        app.router.add_post("/ai/generate-image-stream", self.generate_image_stream)
+        return app
+
+    async def generate_image(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            body = await request.json()
+            if not request.headers.get("Authorization", "").startswith("Bearer "):
+                return web.json_response({"statusCode": 401, "message": "Unauthorized"}, status=401)
+            await asyncio.sleep(self.delay())
+            dice = self.random.random()
+            if dice < self.rate_limit_rate:
+                self.errors += 1
+                return web.json_response(
+                    {"statusCode": 429, "message": "Concurrent generation is locked"}, status=429
+                )
+            if dice < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                return web.json_response({"statusCode": 500, "message": "Stub server error"}, status=500)
+            parameters = body.get("parameters", {})
+            payload = self.payload(parameters.get("width", 832), parameters.get("height", 1216))
+            return web.Response(body=payload, headers={"Content-Type": "application/x-zip-compressed"})
+        finally:
+            self.in_flight -= 1
+
+    async def generate_image_stream(self, request: web.Request) -> web.StreamResponse:
+        """
+        与 generate_image 相同的延迟和错误分布，延迟平均分布到每个中间步骤
+        """
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            body = await request.json()
+            if not request.headers.get("Authorization", "").startswith("Bearer "):
+                return web.json_response({"statusCode": 401, "message": "Unauthorized"}, status=401)
+            dice = self.random.random()
+            if dice < self.rate_limit_rate + self.error_rate:
+                await asyncio.sleep(self.delay())
+                self.errors += 1
+                if dice < self.rate_limit_rate:
+                    return web.json_response(
+                        {"statusCode": 429, "message": "Concurrent generation is locked"}, status=429
+                    )
+                return web.json_response({"statusCode": 500, "message": "Stub server error"}, status=500)
+            parameters = body.get("parameters", {})
+            width, height = parameters.get("width", 832), parameters.get("height", 1216)
+            total = parameters.get("steps", 28)
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            interval = self.delay() / max(1, self.stream_steps)
+            for index in range(self.stream_steps):
+                await asyncio.sleep(interval)
+                step = (index + 1) * total // self.stream_steps - 1
+                event = {
+                    "event_type": "intermediate", "samp_ix": 0, "step_ix": step,
+                    "image": base64.b64encode(make_jpeg(width, height, step)).decode(),
+                }
+                await response.write(f"event: intermediate\ndata: {json.dumps(event)}\n\n".encode())
+            event = {"event_type": "final", "samp_ix": 0, "image": base64.b64encode(self.png(width, height)).decode()}
+            await response.write(f"event: final\ndata: {json.dumps(event)}\n\n".encode())
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    with StubNovelAi(port=args.port, latency=args.latency, error_rate=args.error_rate) as stub:
+        print(f"NOVEL_AI_ENDPOINT={stub.url}")
+        while True:
+            time.sleep(3600)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/5 下午3:40
+# @Author  : sudoskys
+# @File    : stub_telegram.py
+# @Software: PyCharm
+"""
+Telegram Bot API 桩服务，支持 getUpdates 长轮询和常用的发送接口
+每条回复都会按 reply_to_message_id 记录，供压测统计延迟
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+from .stub import StubServer
+
+# 这些回复视为一次请求处理结束，流式预览中占位消息被替换为文档时也记为 document
+FINAL_KINDS = {"document", "media_group", "error"}
+# 以这些前缀开头的文本是排队或进度提示，其余文本视为错误
+STATUS_PREFIXES = ("🥕 Queued", "🥕 Drawing")
+
+
+class Reply(object):
+    __slots__ = ("kind", "method", "at", "text")
+
+    def __init__(self, kind: str, method: str, at: float, text: Optional[str] = None):
+        self.kind = kind
+        self.method = method
+        self.at = at
+        self.text = text
+
+
+class Delivery(object):
+    """
+    一条模拟消息的生命周期
+    """
+
+    def __init__(self, message_id: int, chat_id: int, user_id: int, text: str, sent_at: float):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.text = text
+        self.sent_at = sent_at
+        self.replies: List[Reply] = []
+        self.done: Future = Future()
+
+    @property
+    def outcome(self) -> Optional[str]:
+        for reply in self.replies:
+            if reply.kind in FINAL_KINDS:
+                return reply.kind
+        return None
+
+    @property
+    def latency(self) -> Optional[float]:
+        for reply in self.replies:
+            if reply.kind in FINAL_KINDS:
+                return reply.at - self.sent_at
+        return None
+
+    @property
+    def first_feedback(self) -> Optional[float]:
+        if not self.replies:
+            return None
+        return self.replies[0].at - self.sent_at
+
+
+class StubTelegram(StubServer):
+    """
+    bots 大于 1 时接受多个 token，每个 token 有独立的更新队列，ID 和用户名依次递增
+    """
+
+    def __init__(self,
+                 token: str = "123456:stub",
+                 bot_id: int = 123456,
+                 username: str = "stub_bot",
+                 bots: int = 1,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.token = token
+        self.bot_id = bot_id
+        self.username = username
+        self.tokens = [token] + [f"{bot_id + index}:stub" for index in range(1, bots)]
+        self.deliveries: Dict[int, Delivery] = {}
+        self.calls: Dict[str, int] = {}
+        self.polled = threading.Event()
+        self._updates: Dict[str, List[Dict[str, Any]]] = {token: [] for token in self.tokens}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._new_update: Dict[str, asyncio.Event] = {}
+        # 占位消息 -> 被回复的用户消息，编辑时按此记录
+        self._placeholders: Dict[int, int] = {}
+        # 预览编辑 (会话, 时间)，不含最终替换为文档
+        self.edits: List[Tuple[int, float]] = []
+
+    def build_app(self) -> web.Application:
+        self._new_update = {token: asyncio.Event() for token in self.tokens}
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.dispatch)
+        return app
+
+    @property
+    def api_url(self) -> str:
+        """
+        telebot.asyncio_helper.API_URL 格式
+        """
+        return f"{self.url}/bot{{0}}/{{1}}"
+
+    def build_update(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def push_message(self,
+                     text: str,
+                     *,
+                     chat_id: int,
+                     user_id: int,
+                     chat_type: str = "group",
+                     date: Optional[int] = None,
+                     token: Optional[str] = None
+                     ) -> Delivery:
+        """
+        线程安全，投递一条用户消息
+        :param token: 接收消息的 Bot，默认第一个
+        """
+        message_id = next(self._message_ids)
+        command = text.split(" ", 1)[0]
+        message = {
+            "message_id": message_id,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat": {"id": chat_id, "type": chat_type, "title": f"chat{chat_id}"}
+            if chat_type != "private" else {"id": chat_id, "type": "private", "first_name": f"user{user_id}"},
+            "date": date or int(time.time()),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}] if text.startswith("/") else [],
+        }
+        delivery = Delivery(message_id, chat_id, user_id, text, time.perf_counter())
+        self.deliveries[message_id] = delivery
+        self.push_update(self.build_update(message), token=token)
+        return delivery
+
+    def push_update(self, update: Dict[str, Any], token: Optional[str] = None):
+        token = token or self.token
+
+        def _push():
+            self._updates[token].append(update)
+            self._new_update[token].set()
+
+        self.loop.call_soon_threadsafe(_push)
+
+    def _message(self, chat_id, **extra) -> Dict[str, Any]:
+        message = {
+            "message_id": next(self._message_ids),
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": self.username, "username": self.username},
+            "chat": {"id": int(chat_id), "type": "group", "title": f"chat{chat_id}"},
+            "date": int(time.time()),
+        }
+        message.update(extra)
+        return message
+
+    def _file(self, field) -> Dict[str, Any]:
+        if isinstance(field, web.FileField):
+            digest = hashlib.md5(field.file.read()).hexdigest()
+            file_id = f"stub-{next(self._file_ids)}-{digest[:8]}"
+        else:
+            file_id = str(field)
+        return {"file_id": file_id, "file_unique_id": file_id[-8:]}
+
+    @staticmethod
+    def _reply_to(params) -> Optional[int]:
+        if params.get("reply_to_message_id"):
+            return int(params["reply_to_message_id"])
+        if params.get("reply_parameters"):
+            return json.loads(params["reply_parameters"]).get("message_id")
+        return None
+
+    def _record(self, reply_to, kind: str, method: str, text: Optional[str] = None):
+        if reply_to is None:
+            return
+        delivery = self.deliveries.get(int(reply_to))
+        if delivery is None:
+            return
+        delivery.replies.append(Reply(kind, method, time.perf_counter(), text))
+        if kind in FINAL_KINDS and not delivery.done.done():
+            delivery.done.set_result(delivery)
+
+    async def dispatch(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        token = request.match_info["token"]
+        if token not in self._updates:
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            elif request.content_type == "application/x-www-form-urlencoded":
+                # telebot 会用 GET 携带表单，aiohttp 的 post() 只解析 POST
+                params.update(parse_qsl(await request.text()))
+            else:
+                params.update(await request.post())
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        params["_token"] = token
+        return web.json_response({"ok": True, "result": await handler(params)})
+
+    async def api_getMe(self, params):
+        index = self.tokens.index(params["_token"])
+        username = self.username if not index else f"{self.username}{index}"
+        return {"id": self.bot_id + index, "is_bot": True, "first_name": username, "username": username}
+
+    async def api_getUpdates(self, params):
+        self.polled.set()
+        token = params["_token"]
+        offset = int(params.get("offset", 0) or 0)
+        timeout = min(float(params.get("timeout", 1) or 1), 1.0)
+        if offset < 0:
+            return self._updates[token][offset:]
+        self._updates[token] = [update for update in self._updates[token] if update["update_id"] >= offset]
+        if not self._updates[token]:
+            self._new_update[token].clear()
+            try:
+                await asyncio.wait_for(self._new_update[token].wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[token][:100]
+
+    async def api_sendMessage(self, params):
+        text = params.get("text", "")
+        reply_to = self._reply_to(params)
+        kind = "queued" if text.startswith(STATUS_PREFIXES) else "error"
+        self._record(reply_to, kind, "sendMessage", text)
+        return self._message(params.get("chat_id", 0), text=text)
+
+    async def api_sendDocument(self, params):
+        document = self._file(params.get("document"))
+        self._record(self._reply_to(params), "document", "sendDocument")
+        return self._message(params.get("chat_id", 0), document=document)
+
+    async def api_sendPhoto(self, params):
+        photo = self._file(params.get("photo"))
+        reply_to = self._reply_to(params)
+        self._record(reply_to, "preview", "sendPhoto")
+        message = self._message(params.get("chat_id", 0), photo=[dict(photo, width=1, height=1)])
+        if reply_to is not None:
+            self._placeholders[message["message_id"]] = reply_to
+        return message
+
+    async def api_sendMediaGroup(self, params):
+        media = json.loads(params.get("media", "[]"))
+        self._record(self._reply_to(params), "media_group", "sendMediaGroup")
+        return [
+            self._message(params.get("chat_id", 0), document=self._file(params.get(item["media"][9:], item["media"])))
+            for item in media
+        ]
+
+    async def api_editMessageMedia(self, params):
+        media = json.loads(params.get("media", "{}"))
+        chat_id = int(params.get("chat_id", 0))
+        reply_to = self._placeholders.get(int(params.get("message_id", 0)))
+        field = params.get(media.get("media", "")[9:], media.get("media"))
+        if media.get("type") == "document":
+            self._record(reply_to, "document", "editMessageMedia")
+            return self._message(chat_id, document=self._file(field))
+        self.edits.append((chat_id, time.perf_counter()))
+        self._record(reply_to, "preview", "editMessageMedia")
+        return self._message(chat_id, photo=[dict(self._file(field), width=1, height=1)])
+
+    async def api_editMessageText(self, params):
+        return self._message(params.get("chat_id", 0), text=params.get("text", ""))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/15 下午2:05
+# @Author  : sudoskys
+# @File    : tokenizer.py
+# @Software: PyCharm
+"""
+提示词检查基准，python -m benchmark.tokenizer --vocab bpe_simple_vocab_16e6.txt.gz
+分别测量冷启动（清空提示词 LRU 和 BPE 缓存）与命中 LRU 的单条耗时，目标低于 1ms
+不指定 --vocab 时测量估算分词
+"""
+import argparse
+import random
+import timeit
+
+from app.tokenizer import check_prompt, get_tokenizer
+
+TAGS = [
+    "1girl", "solo", "long hair", "looking at viewer", "smile", "blush", "open mouth", "bangs", "blue eyes",
+    "skirt", "shirt", "long sleeves", "hair ornament", "holding", "jewelry", "school uniform", "white background",
+    "{{masterpiece}}", "[sketch]", "best quality", "amazing quality", "very aesthetic", "absurdres", "cherry blossoms",
+    "night sky", "full moon", "cinematic lighting", "depth of field", "cat ears", "maid headdress", "detailed eyes",
+    "chromatic aberration", "watercolor (medium)", "from above", "dutch angle", "wind", "floating hair",
+]
+
+
+def build_corpus(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [", ".join(rng.choice(TAGS) for _ in range(rng.randint(5, 60))) for _ in range(size)]
+
+
+def main(size: int, repeat: int, vocab: str):
+    tokenizer = get_tokenizer(vocab)
+    corpus = build_corpus(size)
+
+    def run():
+        for text in corpus:
+            check_prompt(text, overflow="trim", vocab_path=vocab)
+
+    def cold():
+        check_prompt.cache_clear()
+        if hasattr(tokenizer, "_pieces"):
+            tokenizer._pieces.cache_clear()
+        run()
+
+    print(f"tokenizer: {type(tokenizer).__name__}")
+    total = size * repeat
+    cold_cost = timeit.timeit(cold, number=repeat)
+    run()
+    cached_cost = timeit.timeit(run, number=repeat)
+    for name, cost in (("cold", cold_cost), ("lru", cached_cost)):
+        per = cost / total * 1e3
+        print(f"{name:<6} {per:8.4f} ms/prompt  {total / cost:10.0f} prompt/s  {'ok' if per < 1 else 'over budget'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--vocab", type=str, default=None, help="CLIP bpe_simple_vocab_16e6.txt.gz")
+    args = parser.parse_args()
+    main(args.size, args.repeat, args.vocab)
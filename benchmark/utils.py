@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/5 下午4:35
+# @Author  : sudoskys
+# @File    : utils.py
+# @Software: PyCharm
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(values: Sequence[float], digits: int = 4) -> Dict[str, Optional[float]]:
+    def _round(value):
+        return round(value, digits) if value is not None else None
+
+    return {
+        "count": len(values),
+        "p50": _round(percentile(values, 50)),
+        "p95": _round(percentile(values, 95)),
+        "p99": _round(percentile(values, 99)),
+        "max": _round(max(values) if values else None),
+    }
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位为字节，Linux 为 KB
+    if sys.platform == "darwin":
+        return round(peak / 1024 / 1024, 2)
+    return round(peak / 1024, 2)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def write_report(report: dict, output: Optional[str]):
+    report.setdefault("revision", git_revision())
+    report.setdefault("timestamp", int(time.time()))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+class LoopLagMonitor(object):
+    """
+    事件循环延迟，按固定间隔休眠并记录实际唤醒的滞后
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
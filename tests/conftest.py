@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 上午10:20
+# @Author  : sudoskys
+# @File    : conftest.py
+# @Software: PyCharm
+"""
+端到端测试复用 benchmark 的桩服务，配置类在导入 app 时读取环境变量，所以桩服务在会话开始时启动
+"""
+import asyncio
+import os
+import sys
+from typing import List
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.harness import build_runner, prepare_env  # noqa: E402
+from benchmark.stub_novelai import StubNovelAi  # noqa: E402
+from benchmark.stub_telegram import Delivery, StubTelegram  # noqa: E402
+
+
+class Stubs(object):
+    def __init__(self, novelai: StubNovelAi, telegram: StubTelegram):
+        self.novelai = novelai
+        self.telegram = telegram
+
+    def runner(self, result_cache=None):
+        """
+        :param result_cache: 默认不使用结果缓存
+        """
+        return build_runner(self.telegram, result_cache=result_cache)
+
+    async def draw(self, texts: List[str], timeout: float = 30, result_cache=None, runner=None) -> List[Delivery]:
+        """
+        启动一个 BotRunner，同时投递多条消息，等待全部处理结束
+        """
+        runner = runner or self.runner(result_cache)
+        serve = asyncio.create_task(runner.serve())
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.telegram.polled.wait, 10)
+            deliveries = [
+                self.telegram.push_message(text, chat_id=-100, user_id=1000 + index)
+                for index, text in enumerate(texts)
+            ]
+            await asyncio.wait([asyncio.wrap_future(delivery.done) for delivery in deliveries], timeout=timeout)
+            # 最终回复之后处理器还有收尾工作，例如记住参数
+            await asyncio.sleep(0.1)
+        finally:
+            serve.cancel()
+            await asyncio.gather(serve, return_exceptions=True)
+        return deliveries
+
+
+@pytest.fixture(scope="session")
+def stubs():
+    novelai = StubNovelAi(latency=0.3, jitter=0.0)
+    telegram = StubTelegram()
+    novelai.start()
+    telegram.start()
+    prepare_env(novelai, telegram, concurrency=4)
+    yield Stubs(novelai, telegram)
+    telegram.stop()
+    novelai.stop()
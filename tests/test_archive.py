@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 下午4:20
+# @Author  : sudoskys
+# @File    : test_archive.py
+# @Software: PyCharm
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+from pydantic import BaseModel
+
+from app.archive import ArchiveItem, S3Archiver
+
+
+class Params(BaseModel):
+    seed: int = 1
+
+
+class FlakyClient(object):
+    """
+    假的 S3 客户端，前 failures 次 put_object 失败，delay 模拟慢上传
+    """
+
+    def __init__(self, failures: int = 0, delay: float = 0.0):
+        self.failures = failures
+        self.delay = delay
+        self.objects = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, Body, Bucket, Key):
+        with self._lock:
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise ConnectionError("upload failed")
+        time.sleep(self.delay)
+        self.objects[Key] = Body
+
+
+def spill_files(path) -> list:
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+def test_retry_with_backoff(tmp_path):
+    async def main():
+        client = FlakyClient(failures=2)
+        archiver = S3Archiver(bucket="test", client=client, workers=1, backoff=0.05, spill_dir=str(tmp_path))
+        start = time.monotonic()
+        archiver.submit(b"png", 1700000000, Params())
+        await archiver.close(timeout=5)
+        return archiver.stats, client, time.monotonic() - start
+
+    stats, client, elapsed = asyncio.run(main())
+    assert stats.retried == 2
+    assert stats.uploaded == 1
+    assert stats.spilled == 0
+    # 两次退避 0.05 + 0.1
+    assert elapsed >= 0.15
+    assert sorted(os.path.splitext(key)[1] for key in client.objects) == [".json", ".png"]
+
+
+def test_spill_when_queue_full(tmp_path):
+    async def main():
+        archiver = S3Archiver(
+            bucket="test", client=FlakyClient(delay=0.2), workers=1, max_queue=1,
+            spill_dir=str(tmp_path), drain_interval=3600
+        )
+        accepted = [archiver.submit(b"png", 1700000000, Params()) for _ in range(4)]
+        await archiver.close(timeout=5)
+        return accepted, archiver.stats
+
+    accepted, stats = asyncio.run(main())
+    assert accepted == [True, False, False, False]
+    assert stats.spilled == 3
+    assert stats.uploaded == 1
+    assert len(spill_files(tmp_path)) == 6
+
+
+def test_spill_after_upload_failures(tmp_path):
+    async def main():
+        archiver = S3Archiver(
+            bucket="test", client=FlakyClient(failures=100), workers=1, max_retries=1, backoff=0.01,
+            spill_dir=str(tmp_path), drain_interval=3600
+        )
+        archiver.submit(b"png", 1700000000, Params())
+        await archiver.close(timeout=5)
+        return archiver.stats
+
+    stats = asyncio.run(main())
+    assert stats.failed == 1
+    assert stats.spilled == 1
+    names = spill_files(tmp_path)
+    assert [os.path.splitext(name)[1] for name in names] == [".bin", ".json"]
+
+
+def test_restore_and_drain(tmp_path):
+    async def main():
+        archiver = S3Archiver(
+            bucket="test", client=FlakyClient(), workers=1, spill_dir=str(tmp_path), drain_interval=0.01
+        )
+        archiver.start()
+        for index in range(3):
+            await archiver._spill_later(ArchiveItem(key=f"telegram/{index}.png", body=b"png", params="{}"))
+        # 不完整的条目只有图片没有元数据，不回放
+        with open(os.path.join(tmp_path, "broken.bin"), "wb") as f:
+            f.write(b"png")
+        for _ in range(100):
+            if archiver.stats.uploaded == 3:
+                break
+            await asyncio.sleep(0.02)
+        await archiver.close(timeout=5)
+        return archiver.stats, archiver.client
+
+    stats, client = asyncio.run(main())
+    assert stats.restored == 3
+    assert stats.uploaded == 3
+    assert sorted(client.objects) == [f"telegram/{index}{suffix}" for index in range(3) for suffix in (".json", ".png")]
+    assert spill_files(tmp_path) == ["broken.bin"]
+
+
+def test_upload_to_mocked_s3(tmp_path):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+
+    async def main(client):
+        archiver = S3Archiver(bucket="test", client=client, workers=2, spill_dir=str(tmp_path))
+        for _ in range(3):
+            archiver.submit(b"png", 1700000000, Params(seed=7))
+        await archiver.close(timeout=10)
+        return archiver.stats
+
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="x", aws_secret_access_key="x")
+        client.create_bucket(Bucket="test")
+        stats = asyncio.run(main(client))
+        keys = [item["Key"] for item in client.list_objects_v2(Bucket="test")["Contents"]]
+        body = client.get_object(Bucket="test", Key=[key for key in keys if key.endswith(".json")][0])["Body"].read()
+    assert stats.uploaded == 3
+    assert len(keys) == 6
+    assert body == b'{"seed":7}'
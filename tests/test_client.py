@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 下午7:00
+# @Author  : sudoskys
+# @File    : test_client.py
+# @Software: PyCharm
+import asyncio
+import socket
+
+from aiohttp import web
+
+from app.core.client import NovelAiSession
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_stats_counts_proxy_connections():
+    async def main():
+        release = asyncio.Event()
+
+        async def handle(request):
+            # 作为 HTTP 代理收到绝对地址的请求
+            await release.wait()
+            return web.Response(text="ok")
+
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        port = free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        session = await NovelAiSession(proxy=f"http://127.0.0.1:{port}").start()
+        try:
+            request = asyncio.create_task(session.client.get("http://novelai.invalid/"))
+            for _ in range(100):
+                if session.stats().in_use:
+                    break
+                await asyncio.sleep(0.01)
+            busy = session.stats()
+            release.set()
+            response = await request
+            idle = session.stats()
+        finally:
+            await session.close()
+            await runner.cleanup()
+        return busy, idle, response.text
+
+    busy, idle, text = asyncio.run(main())
+    assert text == "ok"
+    assert (busy.in_use, busy.idle) == (1, 0)
+    assert (idle.in_use, idle.idle) == (0, 1)
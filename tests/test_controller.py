@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 上午10:40
+# @Author  : sudoskys
+# @File    : test_controller.py
+# @Software: PyCharm
+import asyncio
+
+
+def test_unseeded_identical_prompts_are_not_coalesced(stubs):
+    before = stubs.novelai.requests
+    deliveries = asyncio.run(stubs.draw(["/draw 1girl, solo, smile"] * 2))
+    assert [delivery.outcome for delivery in deliveries] == ["document", "document"]
+    assert stubs.novelai.requests - before == 2
+
+
+def test_seeded_identical_prompts_are_coalesced(stubs):
+    before = stubs.novelai.requests
+    deliveries = asyncio.run(stubs.draw(["/draw 1girl, solo, smile -s 42"] * 2))
+    assert [delivery.outcome for delivery in deliveries] == ["document", "document"]
+    assert stubs.novelai.requests - before == 1
+
+
+def test_postprocess_preview_without_stream_preview(stubs, monkeypatch):
+    from app.schema import DrawQueueSetting, PostProcessSetting
+    monkeypatch.setattr(PostProcessSetting, "preview", True)
+    monkeypatch.setattr(DrawQueueSetting, "stream_preview", False)
+    deliveries = asyncio.run(stubs.draw(["/draw 1girl, solo, smile"]))
+    assert deliveries[0].outcome == "document"
+    assert [reply.kind for reply in deliveries[0].replies].count("preview") == 1
+
+
+def test_stream_preview_not_sent_when_queue_full(stubs, monkeypatch):
+    from app.schema import DrawQueueSetting
+    monkeypatch.setattr(DrawQueueSetting, "stream_preview", True)
+    monkeypatch.setattr(DrawQueueSetting, "max_queue", 0)
+    deliveries = asyncio.run(stubs.draw(["/draw 1girl, solo, smile"]))
+    assert deliveries[0].outcome == "error"
+    assert "preview" not in [reply.kind for reply in deliveries[0].replies]
+
+
+def test_cached_variations_skip_full_queue(stubs, monkeypatch, tmp_path):
+    from app.cache.result import ResultCache
+    from app.scheduler import DrawScheduler, QueueFullError
+    result_cache = ResultCache(disk_path=str(tmp_path))
+    text = "/draw 1girl, solo, smile -s 7 -n 2"
+    first = asyncio.run(stubs.draw([text], result_cache=result_cache))
+    assert first[0].outcome == "media_group"
+    # 两个种子都已缓存，队列满时也不需要排队
+
+    def full(*args, **kwargs):
+        raise QueueFullError(msg="Draw queue is full")
+
+    monkeypatch.setattr(DrawScheduler, "submit_many", full)
+    before = stubs.novelai.requests
+    second = asyncio.run(stubs.draw([text], result_cache=result_cache))
+    assert second[0].outcome == "media_group"
+    assert stubs.novelai.requests == before
+
+
+def test_params_remembered_only_after_success(stubs):
+    failed = stubs.runner()
+    deliveries = asyncio.run(stubs.draw(["/draw 1girl, solo, smile -s 5 -n 99"], runner=failed))
+    assert deliveries[0].outcome == "error"
+    assert asyncio.run(failed.param_memory.get(-100, 1000)) == {}
+
+    succeeded = stubs.runner()
+    deliveries = asyncio.run(stubs.draw(["/draw 1girl, solo, smile -s 5"], runner=succeeded))
+    assert deliveries[0].outcome == "document"
+    assert asyncio.run(succeeded.param_memory.get(-100, 1000))["seed"] == 5
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 下午5:40
+# @Author  : sudoskys
+# @File    : test_dataset.py
+# @Software: PyCharm
+import asyncio
+import os
+import time
+
+from app.dataset import ShardArchiver
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.uploaded = []
+
+    def upload_file(self, path, bucket, key):
+        with open(path, "rb") as f:
+            f.read()
+        self.uploaded.append(key)
+
+
+def sealed_shard(archiver: ShardArchiver) -> str:
+    archiver.writer.write("nai_tg_sample_1700000000", ".png", b"png", b"{}")
+    archiver.writer.seal()
+    return [name for name in os.listdir(archiver.directory) if name.endswith(".tar")][0]
+
+
+def test_stale_uploading_shard_is_retried(tmp_path):
+    async def main():
+        client = FakeClient()
+        archiver = ShardArchiver(bucket="test", directory=str(tmp_path), client=client, upload_stale=60)
+        archiver.start()
+        name = sealed_shard(archiver)
+        path = os.path.join(tmp_path, name)
+        # 上传进程崩溃后留下的分片
+        os.rename(path, f"{path}.uploading")
+        await archiver._upload_all()
+        fresh = list(client.uploaded)
+        old = time.time() - 120
+        os.utime(f"{path}.uploading", (old, old))
+        await archiver._upload_all()
+        await archiver.close(timeout=5)
+        return name, fresh, client.uploaded, archiver.stats
+
+    name, fresh, uploaded, stats = asyncio.run(main())
+    # 刚改名的 .uploading 可能仍在上传，不抢占
+    assert fresh == []
+    assert uploaded == [f"telegram/{name}", f"telegram/{name[:-len('.tar')]}.idx"]
+    assert stats.released == 1
+    assert stats.uploaded == 1
+    assert os.listdir(tmp_path) == []
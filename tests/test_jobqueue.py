@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 下午2:10
+# @Author  : sudoskys
+# @File    : test_jobqueue.py
+# @Software: PyCharm
+import asyncio
+
+from app.jobqueue import JobWorker, SqliteJobQueue
+
+
+def test_final_failure_reaches_on_dead(tmp_path):
+    async def main():
+        queue = SqliteJobQueue(str(tmp_path / "jobs.db"), max_attempts=2)
+        await queue.put({"message": 1}, user_id=1)
+        dead = []
+
+        async def handler(payload):
+            raise ValueError("boom")
+
+        async def on_dead(payload):
+            dead.append(payload)
+
+        worker = JobWorker(queue, handler, concurrency=1, poll_interval=0.01, on_dead=on_dead)
+        for _ in range(2):
+            await worker._process(await queue.lease())
+        stats = await queue.stats()
+        await queue.close()
+        return dead, stats
+
+    dead, stats = asyncio.run(main())
+    assert dead == [{"message": 1}]
+    assert stats.failed == 1
+
+
+def test_finish_requires_lease_owner(tmp_path):
+    async def main():
+        queue = SqliteJobQueue(str(tmp_path / "jobs.db"), lease_seconds=0.01)
+        await queue.put({"message": 1})
+        job = await queue.lease()
+        await asyncio.sleep(0.02)
+        # 租约过期后被其他进程租用
+        queue.worker_id = "other"
+        other = await queue.lease()
+        queue.worker_id = "first"
+        lost = await queue.ack(job), await queue.fail(job, "late")
+        queue.worker_id = "other"
+        owned = await queue.ack(other)
+        stats = await queue.stats()
+        await queue.close()
+        return lost, owned, stats
+
+    lost, owned, stats = asyncio.run(main())
+    assert lost == (False, None)
+    assert owned is True
+    assert stats.done == 1
+
+
+def test_purge_keeps_recent_jobs(tmp_path):
+    async def main():
+        queue = SqliteJobQueue(str(tmp_path / "jobs.db"))
+        for _ in range(2):
+            await queue.put({"message": 1})
+            await queue.ack(await queue.lease())
+        kept = await queue.purge(3600)
+        purged = await queue.purge(-1)
+        await queue.close()
+        return kept, purged
+
+    assert asyncio.run(main()) == (0, 2)
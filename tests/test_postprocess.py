@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 下午6:10
+# @Author  : sudoskys
+# @File    : test_postprocess.py
+# @Software: PyCharm
+import asyncio
+import time
+from functools import partial
+
+import pytest
+
+from app.postprocess import PostProcessError, PostProcessor
+
+
+def test_timeout_keeps_slot_until_job_finishes():
+    async def main():
+        processor = PostProcessor(workers=1, timeout=0.2, max_pending=1)
+        # 预热进程池，避免把启动耗时算进超时
+        await processor.run(partial(time.sleep, 0))
+        with pytest.raises(PostProcessError):
+            await processor.run(partial(time.sleep, 1.0))
+        busy = processor.pending
+        with pytest.raises(PostProcessError, match="queue is full"):
+            await processor.run(partial(time.sleep, 0))
+        for _ in range(100):
+            if not processor.pending:
+                break
+            await asyncio.sleep(0.05)
+        idle = processor.pending
+        result = await processor.run(partial(sum, [1, 2]))
+        processor.close()
+        return busy, idle, result
+
+    assert asyncio.run(main()) == (1, 0, 3)
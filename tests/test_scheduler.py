@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 下午3:00
+# @Author  : sudoskys
+# @File    : test_scheduler.py
+# @Software: PyCharm
+import asyncio
+
+import pytest
+
+from app.scheduler import LANE_PRIVATE, DrawScheduler, QueueFullError
+
+
+def fake_inference(tag, order=None, gate: asyncio.Event = None):
+    """
+    假的上游调用，记录执行顺序，gate 未打开时一直占用并发槽位
+    """
+
+    async def _run():
+        if order is not None:
+            order.append(tag)
+        if gate is not None:
+            await gate.wait()
+        return tag
+
+    return _run
+
+
+async def occupy(scheduler: DrawScheduler):
+    """
+    提交一个阻塞任务占满唯一的并发槽位
+    """
+    gate = asyncio.Event()
+    ticket = scheduler.submit(fake_inference("blocker", gate=gate), user_id=0, chat_id=0)
+    await asyncio.sleep(0)
+    assert scheduler.running == 1
+    return gate, ticket
+
+
+def test_round_robin_between_users():
+    async def main():
+        scheduler = DrawScheduler(concurrency=1, max_pending_per_user=None)
+        gate, blocker = await occupy(scheduler)
+        order = []
+        tickets = [
+            scheduler.submit(fake_inference(tag, order), user_id=user_id, chat_id=100)
+            for tag, user_id in (("a1", 1), ("a2", 1), ("a3", 1), ("b1", 2))
+        ]
+        gate.set()
+        results = await asyncio.gather(blocker, *tickets)
+        await scheduler.close()
+        return order, results
+
+    order, results = asyncio.run(main())
+    assert order == ["a1", "b1", "a2", "a3"]
+    assert results == ["blocker", "a1", "a2", "a3", "b1"]
+
+
+def test_position_and_estimated_wait():
+    async def main():
+        scheduler = DrawScheduler(concurrency=1, default_duration=10.0, max_pending_per_user=None)
+        gate, blocker = await occupy(scheduler)
+        group = [scheduler.submit(fake_inference(index), user_id=1, chat_id=100) for index in range(2)]
+        private = scheduler.submit(fake_inference("private"), user_id=2, chat_id=2, lane=LANE_PRIVATE)
+        positions = [(ticket.position, ticket.estimated_wait, ticket.queued) for ticket in (*group, private)]
+        gate.set()
+        await asyncio.gather(blocker, *group, private)
+        await scheduler.close()
+        return blocker, positions
+
+    blocker, positions = asyncio.run(main())
+    assert not blocker.queued
+    assert positions == [(1, 10.0, True), (2, 20.0, True), (1, 10.0, True)]
+
+
+def test_queue_full():
+    async def main():
+        scheduler = DrawScheduler(concurrency=1, max_queue=2, max_pending_per_user=2)
+        gate, blocker = await occupy(scheduler)
+        scheduler.submit(fake_inference(1), user_id=1, chat_id=100)
+        scheduler.submit(fake_inference(2), user_id=1, chat_id=100)
+        with pytest.raises(QueueFullError):
+            # 用户待处理任务已满
+            scheduler.submit(fake_inference(3), user_id=1, chat_id=100)
+        with pytest.raises(QueueFullError):
+            # 队列已满
+            scheduler.submit(fake_inference(4), user_id=2, chat_id=100)
+        with pytest.raises(QueueFullError):
+            # 一次提交多个任务时全部拒绝
+            scheduler.submit_many([fake_inference(5)] * 2, user_id=3, chat_id=100)
+        size = scheduler.size
+        gate.set()
+        await scheduler.close()
+        return size
+
+    assert asyncio.run(main()) == 2
+
+
+def test_cancel_queued_ticket_releases_slot():
+    async def main():
+        scheduler = DrawScheduler(concurrency=1, max_queue=1, max_pending_per_user=1)
+        gate, blocker = await occupy(scheduler)
+        order = []
+        ticket = scheduler.submit(fake_inference("cancelled", order), user_id=1, chat_id=100)
+        ticket.cancel()
+        await asyncio.sleep(0)
+        size = scheduler.size
+        # 取消后不再占用队列和用户配额
+        again = scheduler.submit(fake_inference("again", order), user_id=1, chat_id=100)
+        gate.set()
+        result = await again
+        await blocker
+        await scheduler.close()
+        return size, order, result
+
+    size, order, result = asyncio.run(main())
+    assert size == 0
+    assert order == ["again"]
+    assert result == "again"
+
+
+def test_cancel_running_ticket_cancels_job():
+    async def main():
+        scheduler = DrawScheduler(concurrency=1)
+        cancelled = asyncio.Event()
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        ticket = scheduler.submit(slow, user_id=1, chat_id=100)
+        await started.wait()
+        ticket.cancel()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        await asyncio.sleep(0)
+        running = scheduler.running
+        # 并发槽位已释放，后续任务可以执行
+        result = await asyncio.wait_for(scheduler.submit(fake_inference("next"), user_id=1, chat_id=100), timeout=1)
+        await scheduler.close()
+        return running, result
+
+    assert asyncio.run(main()) == (0, "next")
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 上午11:30
+# @Author  : sudoskys
+# @File    : test_tokenizer.py
+# @Software: PyCharm
+from app.tokenizer import check_prompt, normalize_tags
+
+
+def test_normalize_tags_keeps_kaomoji():
+    assert normalize_tags("long_hair, ^_^, >_<,  looking_at_viewer") == [
+        "long hair", "^_^", ">_<", "looking at viewer"
+    ]
+
+
+def test_estimated_count_does_not_reject():
+    text = ", ".join(f"very long descriptive tag {index}" for index in range(80))
+    checked = check_prompt(text, limit=225, overflow="reject", vocab_path="missing_vocab.txt.gz")
+    assert checked.tokens > 225
+    assert checked.dropped == 0
+
+
+def test_normalize_tags_keeps_emphasis():
+    assert normalize_tags("smile, {smile}, Smile, {smile}, [[smile]]") == ["smile", "{smile}", "[[smile]]"]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/17 下午5:00
+# @Author  : sudoskys
+# @File    : test_webhook.py
+# @Software: PyCharm
+import asyncio
+import socket
+
+import aiohttp
+
+from app.webhook import SECRET_HEADER, WebhookServer
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "from": {"id": 1000, "is_bot": False, "first_name": "user"},
+        "chat": {"id": 1000, "type": "private", "first_name": "user"},
+        "date": 1700000000,
+        "text": "/draw 1girl",
+    },
+}
+
+
+class FakeBot(object):
+    def __init__(self):
+        self.updates = []
+        self.received = asyncio.Event()
+
+    async def process_new_updates(self, updates):
+        self.updates.extend(updates)
+        self.received.set()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_webhook_routes_updates():
+    async def main():
+        bot, other = FakeBot(), FakeBot()
+        port = free_port()
+        server = WebhookServer(bot, host="127.0.0.1", port=port, path="/hook/main", secret_token="secret")
+        server.add_route(other, "/hook/other")
+        await server.start()
+        base = f"http://127.0.0.1:{port}"
+        secret = {SECRET_HEADER: "secret"}
+        try:
+            async with aiohttp.ClientSession() as session:
+                statuses = {}
+                async with session.post(f"{base}/hook/main", json=UPDATE) as response:
+                    statuses["missing_secret"] = response.status
+                wrong = {SECRET_HEADER: "wrong"}
+                async with session.post(f"{base}/hook/main", json=UPDATE, headers=wrong) as response:
+                    statuses["wrong_secret"] = response.status
+                async with session.post(f"{base}/hook/main", data=b"not json", headers=secret) as response:
+                    statuses["bad_body"] = response.status
+                async with session.post(f"{base}/hook/main", json=UPDATE, headers=secret) as response:
+                    statuses["ok"] = response.status
+                async with session.post(f"{base}/hook/other", json=UPDATE) as response:
+                    statuses["other"] = response.status
+            await asyncio.wait_for(asyncio.gather(bot.received.wait(), other.received.wait()), timeout=5)
+        finally:
+            await server.close()
+        return statuses, bot, other, server
+
+    statuses, bot, other, server = asyncio.run(main())
+    assert statuses == {"missing_secret": 403, "wrong_secret": 403, "bad_body": 400, "ok": 200, "other": 200}
+    assert server.rejected == 2
+    assert server.received == 2
+    assert [update.message.text for update in bot.updates] == ["/draw 1girl"]
+    assert len(other.updates) == 1